@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Control de admision de las peticiones que lanzan trabajo en Spark.
+
+Los endpoints se agrupan en clases (entrenamiento, lote, online) con un limite propio de peticiones en curso y
+una cola acotada de espera, de modo que una rafaga de ``/evaluar/`` no ocupe el SparkContext compartido que
+atienden tambien las peticiones online. Si la cola esta llena la peticion se rechaza con 429 y si espera mas
+de lo permitido con 503, ambas con la cabecera ``Retry-After``.
+"""
+
+import logging
+import threading
+import time
+
+import metricas
+from configuracion import opcion
+
+logger = logging.getLogger(__name__)
+
+CLASES = {
+    "main.entrenar_juez": "entrenamiento",
+    "main.entrenar_spam": "entrenamiento",
+    "main.evaluar": "lote",
+    "main.reevaluar": "lote",
+    "main.evaluar_online": "online",
+}
+
+DEFECTOS = dict(entrenamiento=(1, 0), lote=(2, 4), online=(4, 16))
+
+
+class Rechazo(Exception):
+    """Peticion no admitida; ``codigo`` es 429 si la cola estaba llena o 503 si se agoto la espera"""
+
+    def __init__(self, clase, codigo, reintentar):
+        Exception.__init__(self, "Peticion de clase %s rechazada con %d" % (clase, codigo))
+        self.clase = clase
+        self.codigo = codigo
+        self.reintentar = reintentar
+
+
+class ClaseAdmision(object):
+    """Limite de peticiones en curso de una clase con una cola de espera acotada
+    """
+
+    def __init__(self, nombre, limite, cola, espera, reintentar):
+        self.nombre = nombre
+        self.limite = limite
+        self.cola = cola
+        self.espera = espera
+        self.reintentar = reintentar
+        self.activas = 0
+        self.en_cola = 0
+        self.condicion = threading.Condition()
+
+    def entrar(self):
+        inicio = time.time()
+        with self.condicion:
+            if self.activas >= self.limite:
+                if self.en_cola >= self.cola:
+                    self.rechazar(429, "cola_llena")
+                self.en_cola += 1
+                self.publicar()
+                try:
+                    while self.activas >= self.limite:
+                        restante = inicio + self.espera - time.time()
+                        if restante <= 0:
+                            self.rechazar(503, "espera_agotada")
+                        self.condicion.wait(restante)
+                finally:
+                    self.en_cola -= 1
+                    self.publicar()
+            self.activas += 1
+            self.publicar()
+        metricas.REGISTRO.observar("twitterjudge_admision_espera_segundos", time.time() - inicio,
+                                   "Tiempo en la cola de admision", clase=self.nombre)
+
+    def salir(self):
+        with self.condicion:
+            self.activas -= 1
+            self.publicar()
+            self.condicion.notify()
+
+    def rechazar(self, codigo, motivo):
+        metricas.REGISTRO.incrementar("twitterjudge_admision_rechazos_total", 1,
+                                      "Peticiones rechazadas por el control de admision", clase=self.nombre,
+                                      motivo=motivo)
+        self.publicar()
+        raise Rechazo(self.nombre, codigo, self.reintentar)
+
+    def publicar(self):
+        metricas.REGISTRO.fijar("twitterjudge_admision_activas", self.activas, "Peticiones en curso por clase",
+                                clase=self.nombre)
+        metricas.REGISTRO.fijar("twitterjudge_admision_en_cola", self.en_cola,
+                                "Peticiones esperando admision por clase", clase=self.nombre)
+
+    def estado(self):
+        with self.condicion:
+            return dict(limite=self.limite, cola=self.cola, activas=self.activas, en_cola=self.en_cola)
+
+
+class ControlAdmision(object):
+    """Clases de admision configuradas en la seccion ``[admision]`` de config.ini
+    """
+
+    def __init__(self):
+        espera = float(opcion("admision", "espera", "30"))
+        reintentar = int(opcion("admision", "reintentar", "5"))
+        self.clases = {}
+        for nombre, (limite, cola) in DEFECTOS.items():
+            self.clases[nombre] = ClaseAdmision(nombre, int(opcion("admision", "limite_" + nombre, limite)),
+                                                int(opcion("admision", "cola_" + nombre, cola)), espera, reintentar)
+            self.clases[nombre].publicar()
+
+    def admitir(self, endpoint):
+        """
+        Espera un lugar para la peticion segun la clase de su endpoint
+        Returns
+        -------
+        clase : ClaseAdmision
+            Clase a liberar al terminar la peticion, None si el endpoint no esta limitado
+        Raises
+        ------
+        Rechazo
+            Si la cola de la clase esta llena o se agoto la espera
+        """
+        clase = self.clases.get(CLASES.get(endpoint))
+        if clase is not None:
+            clase.entrar()
+        return clase
+
+    def estado(self):
+        return dict((nombre, clase.estado()) for nombre, clase in self.clases.items())
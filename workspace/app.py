@@ -1,11 +1,23 @@
+import io
 import json
 import logging
 import os
+import time
+import uuid
+import zlib
 
 from flask import Blueprint
-from flask import Flask, request
+from flask import Flask, Response, g, request, send_from_directory, stream_with_context
+from werkzeug.wsgi import LimitedStream
 
+import admision
+import compresion
 import engine
+from configuracion import opcion
+import ingesta
+import metricas
+import perfilador
+import pools
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
@@ -15,6 +27,204 @@ logging.basicConfig(filename="logs/engine.log", format='%(levelname)s:%(message)
 logger = logging.getLogger(__name__)
 
 
+def opcion_peticion(nombre):
+    """Indica si la peticion activo una opcion, ya sea en la URL (?nombre=1) o en el cuerpo JSON"""
+    datos = request.get_json(silent=True) or {}
+    return bool(request.args.get(nombre) or (isinstance(datos, dict) and datos.get(nombre)))
+
+
+def entero(valor, nombre, minimo=1):
+    """
+    Parametro numerico de la peticion
+    Returns
+    -------
+    valor : int
+        None si no se indico
+    Raises
+    ------
+    ValueError
+        Con el motivo, si no es un entero mayor o igual que ``minimo``
+    """
+    if valor is None:
+        return None
+    try:
+        numero = int(valor)
+    except (TypeError, ValueError):
+        raise ValueError("%s debe ser un entero: %r" % (nombre, valor))
+    if numero < minimo or (not isinstance(valor, (int, long)) and str(numero) != str(valor).strip()):
+        raise ValueError("%s debe ser un entero mayor o igual que %d: %r" % (nombre, minimo, valor))
+    return numero
+
+
+def limites_peticion(datos):
+    """
+    ``tope_tweets`` y ``ventana_dias`` de la peticion, None si no se indican y 0 para no limitar
+    Raises
+    ------
+    ValueError
+        Si alguno no es un entero mayor o igual que 0
+    """
+    return entero(datos.get("tope_tweets"), "tope_tweets", 0), entero(datos.get("ventana_dias"), "ventana_dias", 0)
+
+
+def responder(respuesta):
+    """Serializa la respuesta a JSON, agregando las metricas de la peticion si se activo el modo debug"""
+    if opcion_peticion("debug"):
+        respuesta["metricas"] = metricas.etapas_peticion()
+        respuesta["anotaciones"] = metricas.anotaciones_peticion()
+    with metricas.medir("serializacion"):
+        return json.dumps(respuesta)
+
+
+GZIP_MINIMO = 1024
+
+
+class DescompresionGzip(object):
+    """
+    Middleware WSGI que descomprime los cuerpos de peticion enviados con ``Content-Encoding: gzip``, con o sin
+    Content-Length (chunked). Corre antes que Flask, y por lo tanto antes del control de admision: un cuerpo que no
+    es gzip valido se rechaza con 400 y uno que descomprimido supera ``maximo`` bytes con 413, sin descomprimir
+    el resto. Los cuerpos NDJSON no se descomprimen aca sino a medida que ``evaluar_online_ndjson`` los lee, de
+    modo que el cuerpo descomprimido nunca esta completo en memoria; sus errores se responden igual al leerlos
+    """
+
+    def __init__(self, wsgi_app, maximo):
+        self.wsgi_app = wsgi_app
+        self.maximo = maximo
+
+    def __call__(self, environ, start_response):
+        if environ.get("HTTP_CONTENT_ENCODING", "").lower() == "gzip":
+            if environ.get("CONTENT_TYPE", "").split(";")[0].strip().lower() == "application/x-ndjson":
+                environ["wsgi.input"] = compresion.abrir_gzip(entrada_peticion(environ), self.maximo)
+                environ["wsgi.input_terminated"] = True
+                environ.pop("CONTENT_LENGTH", None)
+                del environ["HTTP_CONTENT_ENCODING"]
+                return self.wsgi_app(environ, start_response)
+            try:
+                with metricas.medir("descompresion"):
+                    cuerpo = compresion.abrir_gzip(entrada_peticion(environ), self.maximo).read()
+            except compresion.CuerpoExcedido as error:
+                return rechazar_cuerpo(start_response, "413 Request Entity Too Large", error)
+            except zlib.error as error:
+                return rechazar_cuerpo(start_response, "400 Bad Request", error)
+            environ["wsgi.input"] = io.BytesIO(cuerpo)
+            environ["CONTENT_LENGTH"] = str(len(cuerpo))
+            del environ["HTTP_CONTENT_ENCODING"]
+        return self.wsgi_app(environ, start_response)
+
+
+def entrada_peticion(environ):
+    """Cuerpo de la peticion acotado a su Content-Length, el flujo del servidor si es chunked o vacio si no tiene"""
+    if environ.get("CONTENT_LENGTH"):
+        return LimitedStream(environ["wsgi.input"], int(environ["CONTENT_LENGTH"]))
+    if "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower():
+        return environ["wsgi.input"]
+    return io.BytesIO()
+
+
+def cuerpo_peticion():
+    """Flujo del cuerpo de la peticion; el de ``DescompresionGzip`` si lo descomprime a medida que se lee, ya que
+    sin Content-Length las versiones de werkzeug que no conocen ``wsgi.input_terminated`` lo entregarian vacio"""
+    if request.environ.get("wsgi.input_terminated"):
+        return request.environ["wsgi.input"]
+    return request.stream
+
+
+def contar_rechazo(estado, error):
+    logger.warn("Cuerpo gzip rechazado (%s): %s", estado, error)
+    metricas.REGISTRO.incrementar("twitterjudge_cuerpos_rechazados_total", 1,
+                                  "Cuerpos gzip rechazados por invalidos o demasiado grandes",
+                                  codigo=estado.split(" ")[0])
+
+
+def rechazar_cuerpo(start_response, estado, error):
+    contar_rechazo(estado, error)
+    cuerpo = json.dumps(dict(resultado=False, error=str(error)))
+    start_response(estado, [("Content-Type", "application/json"), ("Content-Length", str(len(cuerpo)))])
+    return [cuerpo]
+
+
+def comprimir_respuesta(response):
+    """Comprime con gzip las respuestas completas si el cliente lo acepta y superan ``GZIP_MINIMO`` bytes"""
+    if (response.direct_passthrough or response.is_streamed or "Content-Encoding" in response.headers or
+            "gzip" not in request.headers.get("Accept-Encoding", "").lower()):
+        return response
+    datos = response.get_data()
+    if len(datos) < GZIP_MINIMO:
+        return response
+    with metricas.medir("compresion"):
+        response.set_data(compresion.comprimir_gzip(datos))
+    response.headers["Content-Encoding"] = "gzip"
+    response.headers.add("Vary", "Accept-Encoding")
+    return response
+
+
+ENDPOINTS_SIN_PERFIL = ("main.perfil", "main.descargar_perfil", "main.metrics", "main.estado")
+
+# Endpoints que pueden lanzar jobs de Spark; solo estos se registran en el historial de /requests/<id>/spark
+ENDPOINTS_SPARK = ("main.entrenar_juez", "main.entrenar_spam", "main.evaluar", "main.evaluar_online",
+                   "main.guardar_juez", "main.cargar_juez")
+
+
+@main.before_request
+def iniciar_metricas():
+    metricas.iniciar_peticion()
+    g.inicio_peticion = time.time()
+    g.id_peticion = request.headers.get("X-Request-Id") or uuid.uuid4().hex
+    try:
+        g.clase_admision = control_admision.admitir(request.endpoint)
+    except admision.Rechazo as rechazo:
+        logger.warn("%s: %s", g.id_peticion, rechazo)
+        respuesta = Response(json.dumps(dict(resultado=False, error="sobrecarga", clase=rechazo.clase)),
+                             status=rechazo.codigo, mimetype="application/json")
+        respuesta.headers["Retry-After"] = str(rechazo.reintentar)
+        return respuesta
+    if request.endpoint not in ENDPOINTS_SIN_PERFIL and perfilador.activo_para(opcion_peticion("perfil")):
+        # Los workers se miden para una sola peticion a la vez: si la pidio explicitamente se rechaza, y si se
+        # perfila por configuracion se perfila solo el driver
+        if perfilador.perfila_workers(motor_clasificador.sc):
+            if perfilador.iniciar_workers(motor_clasificador.sc, g.id_peticion):
+                g.perfil_workers = True
+            elif opcion_peticion("perfil"):
+                logger.warn("%s: rechazada, otra peticion perfilada esta midiendo los workers", g.id_peticion)
+                return responder(dict(resultado=False, error="perfil en curso")), 409
+            else:
+                logger.info("%s: otra peticion perfilada esta midiendo los workers, solo se perfila el driver",
+                            g.id_peticion)
+        g.perfil = perfilador.iniciar()
+    if request.endpoint in ENDPOINTS_SPARK:
+        motor_clasificador.historial_spark.iniciar(g.id_peticion, request.path,
+                                                   pools.pool_endpoint(request.endpoint))
+        g.historial_spark = True
+
+
+@main.after_request
+def registrar_metricas(response):
+    g.codigo_respuesta = response.status_code
+    response.headers["X-Request-Id"] = g.id_peticion
+    return comprimir_respuesta(response)
+
+
+@main.teardown_request
+def finalizar_peticion_spark(excepcion=None):
+    # Las excepciones no controladas no pasan por after_request y se registran como 500
+    if "inicio_peticion" in g:
+        endpoint = request.endpoint or "desconocido"
+        metricas.REGISTRO.observar("twitterjudge_peticion_segundos", time.time() - g.inicio_peticion,
+                                   "Duracion total de las peticiones HTTP", endpoint=endpoint)
+        metricas.REGISTRO.incrementar("twitterjudge_peticiones_total", 1, "Peticiones HTTP atendidas",
+                                      endpoint=endpoint,
+                                      codigo=500 if excepcion is not None else g.get("codigo_respuesta", 500))
+    if "perfil" in g:
+        perfilador.finalizar(g.perfil, g.id_peticion)
+    if "perfil_workers" in g:
+        perfilador.finalizar_workers(motor_clasificador.sc, g.id_peticion)
+    if "historial_spark" in g:
+        motor_clasificador.historial_spark.finalizar(g.id_peticion, request.path)
+    if g.get("clase_admision") is not None:
+        g.clase_admision.salir()
+
+
 @main.route("/entrenar_juez/", methods=["POST"])
 def entrenar_juez():
     """
@@ -29,32 +239,52 @@ def entrenar_juez():
     > curl -H "Content-Type: application/json" -X POST -d
         '{"bots":"/carpeta/con/bots","humanos":"/carpeta/con/humanos","ciborgs":"/carpeta/con/ciborg", "dir_juez": "./jueces/test1"}'
          http://[host]:[port]/entrenar_juez/
+
+    Con "almacen" las caracteristicas de los usuarios nuevos se agregan a un almacen en Parquet y el juez se
+    entrena con el almacen completo; sin directorios se entrena solo con el almacen, sin extraer caracteristicas:
+
+    > curl -H "Content-Type: application/json" -X POST -d
+        '{"almacen":"/almacen/juez", "dir_juez": "./jueces/test2", "num_trees": 50, "max_depth": 10}'
+         http://[host]:[port]/entrenar_juez/
     """
     logger.debug("Iniciando carga inicial...")
     data = request.json
     logging.info(data)
+    if data.get("almacen") and not any(k in data for k in ("bots", "humanos", "ciborgs")):
+        if "dir_juez" not in data:
+            logging.error("No se especifico la direccion de la carpeta para guardar el juez entrenado")
+            return responder(dict(resultado=False))
+        accuracy, matrix = motor_clasificador.entrenar_juez_almacen(data["almacen"], data["dir_juez"],
+                                                                    data.get("num_trees", 30),
+                                                                    data.get("max_depth", 8))
+        return responder(dict(accuracy=accuracy, matrix=matrix))
     if "bots" not in data:
         logging.error("No se especifico la direccion de la carpeta para los bots")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     if "humanos" not in data:
         logging.error("No se especifico la direccion de la carpeta para los humanos")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     if "ciborgs" not in data:
         logging.error("No se especifico la direccion de la carpeta para los ciborgs")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     if "dir_juez" not in data:
         logging.error("No se especifico la direccion de la carpeta para guardar el juez entrenado")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     if "num_trees" not in data:
         logging.warn("No se especifico numero de arboles, se utilizaran 3 por defecto")
     if "max_depth" not in data:
         logging.warn("No se especifico profundidad del bosque, se utilizara 2 por defecto")
+    try:
+        tope, dias = limites_peticion(data)
+    except ValueError as error:
+        logger.error("%s: %s", g.id_peticion, error)
+        return responder(dict(resultado=False, error=str(error)))
     logger.debug("Ejecutando carga y entrenamiento")
     accuracy, matrix = motor_clasificador.entrenar_juez(data.get("humanos"), data.get("ciborgs"), data.get("bots"),
                                                         data.get("dir_juez"), data.get("num_trees", 30),
-                                                        data.get("max_depth", 8))
+                                                        data.get("max_depth", 8), tope, dias, data.get("almacen"))
     logger.debug("Finalizando carga y entrenamiento")
-    return json.dumps(dict(accuracy=accuracy, matrix=matrix))
+    return responder(dict(accuracy=accuracy, matrix=matrix))
 
 
 @main.route("/entrenar_spam/", methods=["POST"])
@@ -79,10 +309,10 @@ def entrenar_spam():
     logging.info(data)
     if "spam" not in data:
         logging.error("No se especifico la direccion del archivo de SPAM")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     if "no_spam" not in data:
         logging.error("No se especifico la direccion del archivo de NOSPAM")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     if "num_trees" not in data:
         logging.warn("No se especifico numero de arboles, se utilizaran 3 por defecto")
     if "max_depth" not in data:
@@ -91,7 +321,7 @@ def entrenar_spam():
     resultado = motor_clasificador.entrenar_spam(data["spam"], data["no_spam"], data.get("num_trees", 30),
                                                  data.get("max_depth", 8))
     logger.debug("Finalizando carga y entrenamiento")
-    return json.dumps(dict(resultado=resultado))
+    return responder(dict(resultado=resultado))
 
 
 @main.route("/evaluar/", methods=["POST"])
@@ -111,14 +341,118 @@ def evaluar():
     http://[host]:[port]/evaluar/
 
     {"resultado": [[3455637141, [1.0, 0.0, 0.0]]}
+
+    > curl -H "Content-Type: application/json" -X POST -d
+    '{"directorio":"/carpeta/con/timelines/*", "modo": "local"}'
+    http://[host]:[port]/evaluar/
+
+    > curl -H "Content-Type: application/json" -X POST -d
+    '{"directorio":"/carpeta/con/timelines/*", "tope_tweets": 200, "ventana_dias": 90}'
+    http://[host]:[port]/evaluar/
+
+    Con "flujo": true los resultados se envian como JSON delimitado por lineas (chunked) a medida que se leen.
+    La evaluacion termina antes de responder; si falla la lectura posterior la respuesta termina con una linea
+    {"error": "..."}:
+
+    > curl -H "Content-Type: application/json" -X POST -d
+    '{"directorio":"/carpeta/con/timelines/*", "flujo": true}'
+    http://[host]:[port]/evaluar/
+
+    [3455637141, [1.0, 0.0, 0.0]]
+    [2213543761, [0.1, 0.7, 0.2]]
+
+    Con "paginado": true solo se guardan las predicciones y se responde con el identificador de la evaluacion,
+    que luego se lee por paginas en /resultados/<id_evaluacion>/:
+
+    > curl -H "Content-Type: application/json" -X POST -d
+    '{"directorio":"/carpeta/con/timelines/*", "paginado": true}'
+    http://[host]:[port]/evaluar/
+
+    {"resultado": {"id_evaluacion": "0f8e5b1c9d...", "usuarios": 2000000}}
+
+    Con "salida": "parquet" o "jsonl" las predicciones se escriben desde los executors en "ruta" en lugar de
+    mongo, y solo se responde un resumen:
+
+    > curl -H "Content-Type: application/json" -X POST -d
+    '{"directorio":"/carpeta/con/timelines/*", "salida": "parquet", "ruta": "hdfs:///predicciones/2017-01-01"}'
+    http://[host]:[port]/evaluar/
+
+    {"resultado": {"formato": "parquet", "ruta": "hdfs:///predicciones/2017-01-01", "usuarios": 3,
+                   "categorias": {"0": 2, "1": 1}, "segundos": 41.2}}
     """
     if not request.json.get("directorio"):
         logging.error("No se especifico el parametro 'directorio' para evaluar")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     directorio = request.json.get("directorio")
     logger.info("Iniciando evaluacion sobre: %s", directorio)
-    resultado = motor_clasificador.evaluar(directorio)
-    return json.dumps(dict(resultado=resultado))
+    try:
+        tope, dias = limites_peticion(request.json)
+    except ValueError as error:
+        logger.error("%s: %s", g.id_peticion, error)
+        return responder(dict(resultado=False, error=str(error)))
+    argumentos = (directorio, request.json.get("modo"), tope, dias, g.id_peticion)
+    error = motor_clasificador.validar_limites(*argumentos[1:4])
+    if error:
+        logger.error("%s: %s", g.id_peticion, error)
+        return responder(dict(resultado=False, error=error))
+    if request.json.get("salida"):
+        if not request.json.get("ruta"):
+            logging.error("No se especifico el parametro 'ruta' para la salida")
+            return responder(dict(resultado=False))
+        error = motor_clasificador.validar_salida(request.json.get("salida"), request.json.get("modo"))
+        if error:
+            logger.error("%s: %s", g.id_peticion, error)
+            return responder(dict(resultado=False, error=error))
+        resumen = motor_clasificador.evaluar_a_archivo(directorio, request.json.get("salida"),
+                                                       request.json.get("ruta"), *argumentos[1:])
+        return responder(dict(resultado=resumen))
+    if opcion_peticion("flujo"):
+        filas = motor_clasificador.evaluar_flujo(*argumentos)
+        return Response(stream_with_context(lineas_flujo(filas)), mimetype="application/x-ndjson")
+    if opcion_peticion("paginado"):
+        usuarios = motor_clasificador.evaluar_sin_recolectar(*argumentos)
+        return responder(dict(resultado=dict(id_evaluacion=g.id_peticion, usuarios=usuarios)))
+    resultado = motor_clasificador.evaluar(*argumentos)
+    return responder(dict(resultado=resultado))
+
+
+def lineas_flujo(filas):
+    """Lineas NDJSON de los resultados; si la lectura falla con la respuesta ya iniciada se termina con una linea
+    {"error": ...}, ya que el codigo de estado ya se envio"""
+    try:
+        for fila in filas:
+            yield json.dumps(fila) + "\n"
+    except Exception as error:
+        logger.exception("%s: flujo de resultados interrumpido", g.id_peticion)
+        metricas.REGISTRO.incrementar("twitterjudge_flujos_interrumpidos_total", 1,
+                                      "Respuestas NDJSON de /evaluar/ terminadas con una linea de error")
+        yield json.dumps(dict(error=str(error))) + "\n"
+
+
+@main.route("/resultados/<id_evaluacion>/", methods=["GET"])
+def resultados(id_evaluacion):
+    """
+    Lee por paginas las predicciones guardadas de una evaluacion previa
+    Returns
+    -------
+    resultado : diccionario
+        Pares [user_id, probabilidades] de la pagina y el cursor "siguiente" para pedir la proxima, null en la ultima
+    Examples
+    --------
+    > curl http://[host]:[port]/resultados/0f8e5b1c9d.../?limite=1000
+    > curl http://[host]:[port]/resultados/0f8e5b1c9d.../?limite=1000&despues=5a1f0c...
+
+    {"resultado": [[3455637141, [1.0, 0.0, 0.0]]], "siguiente": "5a1f0d..."}
+
+    "limite" se acota entre 1 y 10000; un "limite" que no es entero o un cursor "despues" invalido responden 400
+    """
+    try:
+        limite = max(1, min(int(request.args.get("limite", 1000)), 10000))
+        resultado, siguiente = motor_clasificador.resultados(id_evaluacion, request.args.get("despues"), limite)
+    except ValueError as error:
+        logger.error("%s: parametros de pagina invalidos: %s", g.id_peticion, error)
+        return responder(dict(resultado=False, error=str(error))), 400
+    return responder(dict(resultado=resultado, siguiente=siguiente))
 
 
 @main.route("/evaluar_online/", methods=["POST"])
@@ -137,19 +471,88 @@ def evaluar_online():
     http://[host]:[port]/evaluar/
 
     {"resultado": [[3455637141, [1.0, 0.0, 0.0]]}
+
+    Con Content-Type application/x-ndjson el cuerpo es el timeline en JSON por lineas y las opciones van en la URL:
+    > curl -H "Content-Type: application/x-ndjson" --data-binary @timeline.json
+    "http://[host]:[port]/evaluar_online/?tope_tweets=200&incremental=1"
     """
+    if request.mimetype == "application/x-ndjson":
+        return evaluar_online_ndjson()
     if not request.json.get("timeline"):
         logging.error("No se especifico el parametro 'timeline' para evaluar")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
+    try:
+        tope, dias = limites_peticion(request.json)
+    except ValueError as error:
+        logger.error("%s: %s", g.id_peticion, error)
+        return responder(dict(resultado=False, error=str(error)))
     timeline = request.json.get("timeline")
-    logger.info("Iniciando evaluacion sobre: %s", timeline)
-    resultado = motor_clasificador.evaluar_online(timeline)
-    return json.dumps(dict(resultado=resultado))
+    logger.info("Iniciando evaluacion sobre un timeline de %d bytes", len(timeline))
+    resultado = motor_clasificador.evaluar_online(timeline, tope, dias, opcion_peticion("incremental"))
+    return responder(dict(resultado=resultado))
+
+
+def evaluar_online_ndjson():
+    """Lee el timeline NDJSON del cuerpo linea por linea, conservando solo los campos que usan las caracteristicas.
+    Un cuerpo gzip se descomprime a medida que se lee; si es invalido se responde 400 y si supera ``cuerpo_maximo``
+    descomprimido, 413"""
+    try:
+        tope, dias = limites_peticion(request.args)
+    except ValueError as error:
+        logger.error("%s: %s", g.id_peticion, error)
+        return responder(dict(resultado=False, error=str(error)))
+    try:
+        with metricas.medir("lectura_ndjson"):
+            tweets, resumen = ingesta.leer_ndjson(cuerpo_peticion())
+    except compresion.CuerpoExcedido as error:
+        contar_rechazo("413 Request Entity Too Large", error)
+        return responder(dict(resultado=False, error=str(error))), 413
+    except zlib.error as error:
+        contar_rechazo("400 Bad Request", error)
+        return responder(dict(resultado=False, error=str(error))), 400
+    usuarios = ",".join(str(u) for u in sorted(resumen.usuarios)[:5]) + ("..." if len(resumen.usuarios) > 5 else "")
+    logger.info("Iniciando evaluacion NDJSON: usuarios %s, %d tweets, %d bytes, %d lineas descartadas", usuarios,
+                resumen.tweets, resumen.bytes, resumen.descartadas)
+    if not tweets:
+        logging.error("El cuerpo NDJSON no contiene tweets para evaluar")
+        return responder(dict(resultado=False))
+    resultado = motor_clasificador.evaluar_online_tweets(tweets, resumen.bytes, tope, dias,
+                                                         opcion_peticion("incremental"))
+    return responder(dict(resultado=resultado))
+
+
+@main.route("/reevaluar/", methods=["POST"])
+def reevaluar():
+    """
+    Aplica el juez cargado a los vectores de caracteristicas guardados de todos los usuarios evaluados y guarda
+    sus predicciones en la coleccion ``coleccion`` de [matriz], sin volver a leer los timelines. Requiere
+    activo = true en [matriz] de config.ini.
+    Returns
+    -------
+    resultado : diccionario
+        Usuarios reevaluados, usuarios por categoria predicha y segundos. Sera False si la matriz no esta activa
+        o el lote no es un entero positivo.
+    Examples
+    --------
+    > curl -X POST http://[host]:[port]/reevaluar/
+
+    {"resultado": {"usuarios": 2000000, "categorias": {"0": 1500000, "1": 300000, "2": 200000}, "segundos": 95.1}}
+    """
+    if motor_clasificador.matriz is None:
+        logging.error("La matriz de caracteristicas no esta activa")
+        return responder(dict(resultado=False))
+    datos = request.get_json(silent=True) or {}
+    try:
+        lote = entero(datos.get("lote"), "lote")
+    except ValueError as error:
+        logger.error("%s: %s", g.id_peticion, error)
+        return responder(dict(resultado=False, error=str(error)))
+    return responder(dict(resultado=motor_clasificador.reevaluar(lote)))
 
 
 @main.route("/features_importance/", methods=["GET"])
 def features_importances_juez():
-    return json.dumps(dict(resultado=motor_clasificador.features_importances_juez()))
+    return responder(dict(resultado=motor_clasificador.features_importances_juez()))
 
 
 @main.route("/guardar_juez/", methods=["POST"])
@@ -171,13 +574,13 @@ def guardar_juez():
     logging.info(data)
     if "tipo_juez" not in data:
         logging.error("No se especifico el tipo de juez a almacenar")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     if "path" not in data:
         logging.error("No se especifico el directorio a utilizar")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     tipo_juez = data.get("tipo_juez")
     path = data.get("path")
-    return json.dumps(dict(resultado=motor_clasificador.guardar_juez(tipo_juez, path)))
+    return responder(dict(resultado=motor_clasificador.guardar_juez(tipo_juez, path)))
 
 
 @main.route("/cargar_juez/", methods=["POST"])
@@ -199,24 +602,129 @@ def cargar_juez():
     logging.info(data)
     if "tipo_juez" not in data:
         logging.error("No se especifico el tipo de juez a almacenar")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     if "path" not in data:
         logging.error("No se especifico el directorio a utilizar")
-        return json.dumps(dict(resultado=False))
+        return responder(dict(resultado=False))
     tipo_juez = request.json.get("tipo_juez")
     path = request.json.get("path")
-    return json.dumps(dict(resultado=motor_clasificador.cargar_juez(tipo_juez, path)))
+    return responder(dict(resultado=motor_clasificador.cargar_juez(tipo_juez, path)))
+
+
+@main.route("/requests/<id_peticion>/spark", methods=["GET"])
+def spark_peticion(id_peticion):
+    """
+    Perfil de Spark de una peticion previa, identificada por la cabecera X-Request-Id de su respuesta
+    Returns
+    -------
+    resultado : diccionario
+        Jobs, etapas, tareas, bytes de shuffle, spill y tiempo de ejecucion atribuibles a la peticion.
+        Sera False si la peticion no disparo jobs o ya salio del historial.
+    Examples
+    --------
+    > curl http://[host]:[port]/requests/0f8e5b1c9d.../spark
+    """
+    perfil = motor_clasificador.historial_spark.consultar(id_peticion)
+    if perfil is None:
+        return responder(dict(resultado=False)), 404
+    return responder(dict(resultado=perfil))
+
+
+@main.route("/perfil/", methods=["GET"])
+def perfil():
+    """
+    Funciones con mayor tiempo acumulado en el driver y en los workers.
+    Los perfiles del driver se generan para las peticiones con "perfil": true (o ?perfil=1), o para todas si
+    se activa la seccion [perfil] de config.ini. Los de los workers requieren udf = true en la misma seccion;
+    con ?id= se devuelven los de esa peticion y sin id lo acumulado desde la ultima peticion perfilada.
+    Returns
+    -------
+    resultado : diccionario
+        Listas "driver" y "workers" ordenadas por tiempo acumulado
+    Examples
+    --------
+    > curl http://[host]:[port]/perfil/?top=20
+    > curl http://[host]:[port]/perfil/?id=0f8e5b1c9d...
+
+    Un "top" que no es un entero positivo responde 400
+    """
+    try:
+        limite = entero(request.args.get("top", 30), "top")
+    except ValueError as error:
+        logger.error("%s: %s", g.id_peticion, error)
+        return responder(dict(resultado=False, error=str(error))), 400
+    id_peticion = request.args.get("id")
+    driver = perfilador.estadisticas_driver(id_peticion)
+    if id_peticion:
+        workers = perfilador.estadisticas_peticion_workers(id_peticion)
+    else:
+        workers = perfilador.estadisticas_workers(motor_clasificador.sc)
+    return responder(dict(resultado=dict(driver=perfilador.funciones_principales(driver, limite),
+                                         workers=perfilador.funciones_principales(workers, limite))))
+
+
+@main.route("/perfil/<nombre>.pstats", methods=["GET"])
+def descargar_perfil(nombre):
+    """
+    Descarga el archivo pstats de una peticion (por su X-Request-Id) o el combinado de los workers
+    Examples
+    --------
+    > curl -O http://[host]:[port]/perfil/0f8e5b1c9d....pstats
+    > curl -O http://[host]:[port]/perfil/workers.pstats
+    """
+    if nombre == "workers":
+        workers = perfilador.estadisticas_workers(motor_clasificador.sc)
+        if workers is None:
+            return responder(dict(resultado=False)), 404
+        perfilador.guardar(workers, "workers")
+    if not os.path.isfile(perfilador.ruta(nombre)):
+        return responder(dict(resultado=False)), 404
+    return send_from_directory(os.path.abspath(perfilador.DIRECTORIO), os.path.basename(nombre) + ".pstats",
+                               as_attachment=True)
+
+
+@main.route("/estado/", methods=["GET"])
+def estado():
+    """
+    Estado de los pools del fair scheduler y del control de admision
+    Returns
+    -------
+    resultado : diccionario
+        Por pool: peso, cuota minima, tareas y etapas en ejecucion segun Spark; peticiones en curso, jobs en
+        ejecucion y en cola; y el limite, peticiones activas y en cola de su clase de admision
+    Examples
+    --------
+    > curl http://[host]:[port]/estado/
+
+    {"resultado": {"online": {"peso": 4, "minimo": 2, "tareas_en_ejecucion": 2, "etapas_activas": 1,
+                              "peticiones": 1, "jobs_en_ejecucion": 1, "jobs_en_cola": 0,
+                              "admision": {"limite": 4, "cola": 16, "activas": 1, "en_cola": 0}}, ...}}
+    """
+    resultado = pools.estado(motor_clasificador.sc)
+    for nombre, jobs in motor_clasificador.historial_spark.jobs_por_pool().items():
+        resultado.setdefault(nombre, {}).update(jobs)
+    for nombre, clase in control_admision.estado().items():
+        resultado.setdefault(nombre, {})["admision"] = clase
+    return responder(dict(resultado=resultado))
+
+
+@main.route("/metrics", methods=["GET"])
+def metrics():
+    """Expone los contadores e histogramas por etapa en el formato de texto de Prometheus"""
+    return Response(metricas.REGISTRO.exportar(), mimetype="text/plain; version=0.0.4")
 
 
 @main.route("/alive/", methods=["GET"])
 def alive():
     """Funcion para verificar disponibilidad del servidor"""
-    return json.dumps(dict(resultado="I'm Alive!"))
+    return responder(dict(resultado="I'm Alive!"))
 
 
 def create_app():
-    global motor_clasificador
+    global motor_clasificador, control_admision
     motor_clasificador = engine.MotorClasificador()
+    control_admision = admision.ControlAdmision()
     app = Flask(__name__)
     app.register_blueprint(main)
+    app.wsgi_app = DescompresionGzip(app.wsgi_app, int(opcion("server", "cuerpo_maximo", 256 * 1024 * 1024)))
     return app
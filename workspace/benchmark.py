@@ -0,0 +1,785 @@
+# -*- coding: utf-8 -*-
+"""Herramientas de medicion de rendimiento del Twitter Judge.
+
+Ejecutar desde el directorio de Spark, igual que el servidor:
+
+> bin/spark-submit workspace/benchmark.py carga --mongod --juez_spam jueces/spam --juez jueces/test1
+    --endpoints evaluar_online:8,evaluar:1,alive:1 --concurrencia 8 --tasa 5 --duracion 60
+> bin/spark-submit workspace/benchmark.py tope --juez_spam jueces/spam --topes 0,50,100,200
+> bin/spark-submit workspace/benchmark.py ingesta --repeticiones 200
+> python workspace/benchmark.py mongo --mongod --documentos 100000
+> python workspace/benchmark.py mongo --bson --documentos 100000
+> bin/spark-submit workspace/benchmark.py aproximado --juez_spam jueces/spam --juez jueces/test1 --muestras 16,64,256
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import bz2
+import glob
+import gzip
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import Queue as queue
+    import urllib2 as urllib_request
+except ImportError:
+    import queue
+    import urllib.request as urllib_request
+
+logger = logging.getLogger(__name__)
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentil(valores, p):
+    """
+    Percentil por rango mas cercano de una lista ya ordenada.
+    Parameters
+    ----------
+    valores : [float, ] list
+        Valores ordenados de forma ascendente
+    p : float
+        Percentil a calcular, entre 0 y 100
+    Returns
+    -------
+    valor : float
+        Valor del percentil, None si la lista esta vacia
+    Examples
+    --------
+    > percentil([1, 2, 3, 4], 50)
+    2
+    """
+    if not valores:
+        return None
+    indice = max(0, int(math.ceil(p / 100.0 * len(valores))) - 1)
+    return valores[min(indice, len(valores) - 1)]
+
+
+def puerto_libre():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    puerto = s.getsockname()[1]
+    s.close()
+    return puerto
+
+
+def esperar_puerto(host, puerto, timeout=30):
+    limite = time.time() + timeout
+    while time.time() < limite:
+        try:
+            socket.create_connection((host, puerto), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.2)
+    return False
+
+
+class MongoLocal(object):
+    """Instancia desechable de ``mongod`` que reemplaza la base de datos de produccion durante la prueba
+    """
+
+    def __init__(self, binario="mongod"):
+        self.binario = binario
+        self.puerto = puerto_libre()
+        self.directorio = None
+        self.proceso = None
+
+    def __enter__(self):
+        self.directorio = tempfile.mkdtemp(prefix="mongo_benchmark_")
+        self.proceso = subprocess.Popen([self.binario, "--dbpath", self.directorio, "--port", str(self.puerto),
+                                         "--bind_ip", "127.0.0.1"],
+                                        stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+        if not esperar_puerto("127.0.0.1", self.puerto):
+            self.__exit__()
+            raise RuntimeError("No se pudo iniciar mongod en el puerto %d" % self.puerto)
+        return self
+
+    def __exit__(self, *args):
+        if self.proceso:
+            self.proceso.terminate()
+            self.proceso.wait()
+        if self.directorio:
+            shutil.rmtree(self.directorio, ignore_errors=True)
+
+
+class ServidorLocal(object):
+    """Levanta ``app.create_app()`` sobre CherryPy en un puerto local para poder comparar configuraciones
+    """
+
+    def __init__(self, mongo_host=None, mongo_port=None, opciones=None):
+        self.mongo_host = mongo_host
+        self.mongo_port = mongo_port
+        self.opciones = opciones or {}
+        self.puerto = puerto_libre()
+        self.url = "http://127.0.0.1:%d" % self.puerto
+
+    def __enter__(self):
+        import cherrypy
+        import engine
+        if self.mongo_host:
+            engine.configParser.set("database", "host", self.mongo_host)
+        if self.mongo_port:
+            engine.configParser.set("database", "port", str(self.mongo_port))
+        import server
+        app = server.create_app()
+        opciones = {
+            'engine.autoreload.on': False,
+            'log.screen': False,
+            'server.socket_port': self.puerto,
+            'server.socket_host': "127.0.0.1"
+        }
+        opciones.update(self.opciones)
+        server.montar_servidor(app, opciones)
+        cherrypy.engine.start()
+        cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+        return self
+
+    def __exit__(self, *args):
+        import cherrypy
+        cherrypy.engine.exit()
+
+
+def post_json(url, datos, timeout):
+    peticion = urllib_request.Request(url, json.dumps(datos).encode("utf-8"),
+                                      {"Content-Type": "application/json"})
+    respuesta = urllib_request.urlopen(peticion, timeout=timeout)
+    return respuesta.getcode(), respuesta.read()
+
+
+def get(url, timeout):
+    respuesta = urllib_request.urlopen(url, timeout=timeout)
+    return respuesta.getcode(), respuesta.read()
+
+
+class Escenario(object):
+    """Genera las peticiones de cada endpoint a partir de los timelines de ``workspace/evaluar``
+    """
+
+    def __init__(self, timelines):
+        self.archivos = sorted(f for patron in timelines for f in glob.glob(patron) if os.path.isfile(f))
+        if not self.archivos:
+            raise ValueError("No se encontraron timelines en %s" % timelines)
+        self.contenidos = {}
+
+    def contenido(self, archivo):
+        if archivo not in self.contenidos:
+            with open(archivo) as f:
+                self.contenidos[archivo] = f.read()
+        return self.contenidos[archivo]
+
+    def peticion(self, endpoint):
+        archivo = random.choice(self.archivos)
+        if endpoint == "evaluar_online":
+            return "POST", "/evaluar_online/", dict(timeline=self.contenido(archivo))
+        elif endpoint == "evaluar":
+            return "POST", "/evaluar/", dict(directorio=os.path.abspath(archivo))
+        elif endpoint == "alive":
+            return "GET", "/alive/", None
+        raise ValueError("Endpoint desconocido: %s" % endpoint)
+
+
+def es_error(codigo, cuerpo):
+    if codigo != 200:
+        return True
+    try:
+        return json.loads(cuerpo).get("resultado") is False
+    except ValueError:
+        return True
+
+
+def ejecutar_carga(url, escenario, pesos, concurrencia, tasa, duracion, timeout=300):
+    """
+    Reproduce peticiones con llegadas de Poisson a la tasa indicada y las atiende con ``concurrencia`` clientes.
+    La latencia se mide desde el instante de llegada programado, por lo que incluye la espera por un cliente libre.
+    Parameters
+    ----------
+    url : str
+        Direccion base del servidor
+    escenario : Escenario
+        Generador de las peticiones
+    pesos : [(str, int), ] list
+        Endpoints y su peso relativo en la mezcla
+    concurrencia : int
+        Numero de clientes simultaneos
+    tasa : float
+        Peticiones por segundo, 0 para enviar en lazo cerrado lo mas rapido posible
+    duracion : float
+        Segundos durante los que se generan peticiones
+    Returns
+    -------
+    muestras : [(str, float, float, bool), ] list
+        Endpoint, instante de llegada, latencia y si hubo error para cada peticion
+    """
+    endpoints = [e for e, peso in pesos for _ in range(peso)]
+    pendientes = queue.Queue()
+    muestras = []
+    bloqueo = threading.Lock()
+    inicio = time.time()
+
+    def cliente():
+        while True:
+            trabajo = pendientes.get()
+            if trabajo is None:
+                return
+            endpoint, llegada = trabajo
+            metodo, ruta, datos = escenario.peticion(endpoint)
+            try:
+                if metodo == "POST":
+                    codigo, cuerpo = post_json(url + ruta, datos, timeout)
+                else:
+                    codigo, cuerpo = get(url + ruta, timeout)
+                error = es_error(codigo, cuerpo)
+            except Exception as e:
+                logger.warning("Error en %s: %s", ruta, e)
+                error = True
+            with bloqueo:
+                muestras.append((endpoint, llegada - inicio, time.time() - llegada, error))
+            if not tasa:
+                pendientes.put((random.choice(endpoints), time.time()) if time.time() - inicio < duracion else None)
+
+    hilos = [threading.Thread(target=cliente) for _ in range(concurrencia)]
+    for hilo in hilos:
+        hilo.daemon = True
+        hilo.start()
+
+    if tasa:
+        llegada = inicio
+        while llegada - inicio < duracion:
+            llegada += random.expovariate(tasa)
+            espera = llegada - time.time()
+            if espera > 0:
+                time.sleep(espera)
+            pendientes.put((random.choice(endpoints), llegada))
+        for _ in hilos:
+            pendientes.put(None)
+    else:
+        for _ in hilos:
+            pendientes.put((random.choice(endpoints), time.time()))
+
+    for hilo in hilos:
+        hilo.join()
+    return muestras
+
+
+def resumir(muestras, duracion):
+    """Agrupa las muestras por endpoint y calcula rendimiento, percentiles de latencia y tasa de error"""
+    resumen = {}
+    for endpoint in sorted(set(m[0] for m in muestras)):
+        latencias = sorted(m[2] for m in muestras if m[0] == endpoint)
+        errores = sum(1 for m in muestras if m[0] == endpoint and m[3])
+        resumen[endpoint] = dict(peticiones=len(latencias),
+                                 throughput=len(latencias) / duracion if duracion else 0,
+                                 p50=percentil(latencias, 50),
+                                 p95=percentil(latencias, 95),
+                                 p99=percentil(latencias, 99),
+                                 max=latencias[-1],
+                                 tasa_error=errores / len(latencias))
+    return resumen
+
+
+def imprimir_resumen(resumen):
+    print("%-16s %10s %10s %10s %10s %10s %10s %8s" % ("endpoint", "peticiones", "req/s", "p50(s)", "p95(s)",
+                                                       "p99(s)", "max(s)", "error"))
+    for endpoint, r in sorted(resumen.items()):
+        print("%-16s %10d %10.2f %10.3f %10.3f %10.3f %10.3f %7.1f%%" % (
+            endpoint, r["peticiones"], r["throughput"], r["p50"], r["p95"], r["p99"], r["max"],
+            100 * r["tasa_error"]))
+
+
+def leer_pesos(texto):
+    pesos = []
+    for parte in texto.split(","):
+        nombre, _, peso = parte.partition(":")
+        pesos.append((nombre.strip(), int(peso or 1)))
+    return pesos
+
+
+def preparar_jueces(url, args):
+    if args.juez_spam:
+        post_json(url + "/cargar_juez/", dict(tipo_juez=0, path=args.juez_spam), None)
+    if args.juez:
+        post_json(url + "/cargar_juez/", dict(tipo_juez=1, path=args.juez), None)
+
+
+def comando_carga(args):
+    pesos = leer_pesos(args.endpoints)
+    escenario = Escenario(args.timelines)
+    opciones = dict(json.loads(args.opciones_servidor)) if args.opciones_servidor else {}
+    if args.hilos:
+        opciones["server.thread_pool"] = args.hilos
+
+    def correr(url):
+        preparar_jueces(url, args)
+        inicio = time.time()
+        muestras = ejecutar_carga(url, escenario, pesos, args.concurrencia, args.tasa, args.duracion, args.timeout)
+        return resumir(muestras, time.time() - inicio)
+
+    if args.url:
+        resumen = correr(args.url)
+    elif args.mongod:
+        with MongoLocal(args.mongod) as mongo:
+            with ServidorLocal("127.0.0.1", mongo.puerto, opciones) as servidor:
+                resumen = correr(servidor.url)
+    else:
+        with ServidorLocal(args.mongo_host, args.mongo_port, opciones) as servidor:
+            resumen = correr(servidor.url)
+
+    imprimir_resumen(resumen)
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(dict(parametros=vars(args), resultado=resumen), f, indent=2, default=str)
+    return resumen
+
+
+CATEGORIAS = (("Humanos", 0.0), ("Bots", 1.0), ("Ciborgs", 2.0))
+
+
+def leer_enteros(texto):
+    return [int(parte) for parte in texto.split(",") if parte.strip()]
+
+
+def dividir_archivos(archivos, fraccion):
+    """
+    Separa los timelines de una categoria en entrenamiento y validacion segun el crc32 del nombre de cada archivo,
+    de modo que la division no depende del orden ni cambia entre ejecuciones
+    Returns
+    -------
+    entrenamiento, validacion : (list, list)
+        Con al menos un archivo en cada parte si hay dos o mas
+    """
+    orden = sorted(archivos, key=lambda a: (zlib.crc32(os.path.basename(a).encode("utf-8")) & 0xffffffff, a))
+    apartados = max(1, int(round(len(orden) * fraccion))) if len(orden) > 1 else 0
+    return orden[apartados:], orden[:apartados]
+
+
+def conjuntos_tope(args, sc, sql_context, juez_spam, temporal):
+    """
+    Juez y timelines de validacion de ``comando_tope``. Con ``--validacion`` se usa ``--juez`` sobre esos
+    timelines; si no, se aparta ``--fraccion_validacion`` de los archivos de cada categoria de
+    ``--entrenamiento`` y se entrena un juez con el resto, para no medir la exactitud sobre los timelines con los
+    que se entreno
+    Returns
+    -------
+    juez, validacion : (PipelineModel, [(str, float), ] list)
+        Juez y directorios o archivos separados por comas de cada categoria con su etiqueta
+    """
+    import ejecutor_local
+    import tools
+    if args.validacion:
+        if not args.juez:
+            raise SystemExit("--validacion requiere --juez")
+        return (tools.cargar_juez(args.juez, 1),
+                [(os.path.join(args.validacion, carpeta, "*"), categoria) for carpeta, categoria in CATEGORIAS])
+    entrenamiento = {}
+    validacion = []
+    for carpeta, categoria in CATEGORIAS:
+        archivos = ejecutor_local.expandir_directorio(os.path.join(args.entrenamiento, carpeta))
+        entrenamiento[carpeta], apartados = dividir_archivos(archivos, args.fraccion_validacion)
+        if apartados:
+            validacion.append((",".join(apartados), categoria))
+        logger.info("%s: %d timelines de entrenamiento, %d de validacion", carpeta, len(entrenamiento[carpeta]),
+                    len(apartados))
+    juez, accuracy, _ = tools.entrenar_juez(sc, sql_context, juez_spam, ",".join(entrenamiento["Humanos"]),
+                                            ",".join(entrenamiento["Ciborgs"]), ",".join(entrenamiento["Bots"]),
+                                            os.path.join(temporal, "juez"))
+    logger.info("Juez entrenado sin los timelines de validacion, accuracy %.3f", accuracy)
+    return juez, validacion
+
+
+def medir_topes(sc, sql_context, juez_spam, juez, validacion, topes, dias=None):
+    """Exactitud, concordancia con la evaluacion sin tope y tiempo de cada tope sobre los timelines de
+    ``validacion``"""
+    import tools
+    referencia = None
+    resultados = []
+    for tope in [0] + [t for t in topes if t]:
+        inicio = time.time()
+        predichas = {}
+        etiquetas = {}
+        tweets = 0
+        for directorio, categoria in validacion:
+            try:
+                filas = (tools.evaluar(sc, sql_context, juez_spam, juez, directorio, None, tope or None, dias)
+                         .select("user_id", "nroTweets", "Predicted_categoria").collect())
+            finally:
+                tools.liberar_cache()
+            for fila in filas:
+                predichas[fila.user_id] = fila.Predicted_categoria
+                etiquetas[fila.user_id] = categoria
+                tweets += fila.nroTweets
+        segundos = time.time() - inicio
+        if referencia is None:
+            referencia = predichas
+        usuarios = len(predichas)
+        comunes = [u for u in predichas if u in referencia]
+        resultados.append(dict(
+            tope=tope, ventana_dias=dias, usuarios=usuarios, segundos=segundos,
+            tweets_por_usuario=tweets / usuarios if usuarios else 0,
+            exactitud=sum(predichas[u] == etiquetas[u] for u in predichas) / usuarios if usuarios else 0,
+            concordancia=sum(predichas[u] == referencia[u] for u in comunes) / len(comunes) if comunes else 0))
+    return resultados
+
+
+def comando_tope(args):
+    """
+    Exactitud y tiempo de evaluacion con distintos topes de tweets por usuario sobre timelines etiquetados que el
+    juez no vio al entrenar (``conjuntos_tope``). La concordancia se mide contra la evaluacion sin tope.
+    """
+    import tools
+    sc = tools.iniciar_spark_context(app_name="BenchmarkTope")
+    sql_context = tools.spark_session()
+    juez_spam = tools.cargar_juez(args.juez_spam, 0)
+    dias = args.ventana_dias or None
+    temporal = tempfile.mkdtemp(prefix="tope_")
+    try:
+        juez, validacion = conjuntos_tope(args, sc, sql_context, juez_spam, temporal)
+        resultados = medir_topes(sc, sql_context, juez_spam, juez, validacion, leer_enteros(args.topes), dias)
+    finally:
+        tools.liberar_cache()
+        shutil.rmtree(temporal, ignore_errors=True)
+
+    print("%8s %10s %12s %10s %13s %10s" % ("tope", "usuarios", "tweets/usr", "exactitud", "concordancia",
+                                             "tiempo(s)"))
+    for r in resultados:
+        print("%8s %10d %12.1f %9.1f%% %12.1f%% %10.2f" % (
+            r["tope"] or "-", r["usuarios"], r["tweets_por_usuario"], 100 * r["exactitud"],
+            100 * r["concordancia"], r["segundos"]))
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(dict(parametros=vars(args), resultado=resultados), f, indent=2, default=str)
+    return resultados
+
+
+def escribir_variantes(timelines, directorio, repeticiones):
+    """
+    Concatena ``repeticiones`` veces los timelines en un archivo por codec
+    Returns
+    -------
+    variantes : [(str, str), ] list
+        Codec y ruta de cada archivo generado; zstd solo si el paquete zstandard esta instalado
+    """
+    import compresion
+    contenido = b"".join(open(archivo, "rb").read().rstrip(b"\n") + b"\n"
+                         for patron in timelines for archivo in sorted(glob.glob(patron)) if os.path.isfile(archivo))
+    abridores = [("plano", ".json", lambda ruta: open(ruta, "wb")),
+                 ("gzip", ".json.gz", lambda ruta: gzip.open(ruta, "wb")),
+                 ("bzip2", ".json.bz2", lambda ruta: bz2.BZ2File(ruta, "wb"))]
+    variantes = []
+    for codec, extension, abridor in abridores:
+        ruta = os.path.join(directorio, codec, "timelines" + extension)
+        os.makedirs(os.path.dirname(ruta))
+        with abridor(ruta) as f:
+            for _ in range(repeticiones):
+                f.write(contenido)
+        variantes.append((codec, ruta))
+    if compresion.zstandard is not None:
+        ruta = os.path.join(directorio, "zstd", "timelines.json.zst")
+        os.makedirs(os.path.dirname(ruta))
+        with open(ruta, "wb") as f:
+            f.write(compresion.zstandard.ZstdCompressor().compress(contenido * repeticiones))
+        variantes.append(("zstd", ruta))
+    else:
+        logger.warn("zstandard no esta instalado, se omite zstd")
+    return variantes, len(contenido) * repeticiones
+
+
+def comando_ingesta(args):
+    """Throughput de lectura de timelines planos y comprimidos con Spark (``tools.cargar_datos``) y con el
+    lector del ejecutor local"""
+    import ejecutor_local
+    import tools
+    sc = tools.iniciar_spark_context(app_name="BenchmarkIngesta")
+    sql_context = tools.spark_session()
+    temporal = tempfile.mkdtemp(prefix="ingesta_")
+    resultados = []
+    try:
+        variantes, tamano = escribir_variantes(args.timelines, temporal, args.repeticiones)
+        for codec, ruta in variantes:
+            inicio = time.time()
+            df = tools.cargar_datos(sc, sql_context, ruta)
+            tweets = df.count()
+            spark = time.time() - inicio
+            inicio = time.time()
+            sum(1 for _ in ejecutor_local.leer_tweets(ruta))
+            local = time.time() - inicio
+            resultados.append(dict(codec=codec, bytes=os.path.getsize(ruta), tweets=tweets,
+                                   particiones=tools.leer_lineas(sc, ruta).getNumPartitions(),
+                                   spark_mb_s=tamano / spark / 1e6, local_mb_s=tamano / local / 1e6,
+                                   spark_segundos=spark, local_segundos=local))
+    finally:
+        shutil.rmtree(temporal, ignore_errors=True)
+
+    print("Entrada sin comprimir: %.1f MB" % (tamano / 1e6))
+    print("%-8s %12s %8s %10s %11s %13s %13s" % ("codec", "tamano(MB)", "ratio", "tweets", "particiones",
+                                                  "spark(MB/s)", "local(MB/s)"))
+    for r in resultados:
+        print("%-8s %12.1f %8.2f %10d %11d %13.1f %13.1f" % (
+            r["codec"], r["bytes"] / 1e6, tamano / r["bytes"], r["tweets"], r["particiones"], r["spark_mb_s"],
+            r["local_mb_s"]))
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(dict(parametros=vars(args), resultado=resultados), f, indent=2, default=str)
+    return resultados
+
+
+def documento_sintetico(user_id):
+    """Prediccion con la forma de las de ``tools.predecir`` y caracteristicas aleatorias"""
+    import datetime
+    import documentos
+    documento = dict((clave, random.random()) for clave in documentos.CLAVES)
+    documento.update(user_id=user_id, ano_registro=random.randint(2006, 2017), nroTweets=random.randint(1, 3200),
+                     nombre_usuario="usuario_%d" % user_id, Predicted_categoria=float(random.randint(0, 2)),
+                     probabilidades=[random.random() for _ in range(3)], createdAt=datetime.datetime.utcnow(),
+                     cuenta_creada=datetime.datetime(2010, 1, 1), id_evaluacion="benchmark", tope_tweets=None,
+                     ventana_dias=None)
+    return documento
+
+
+def medir_formato(coleccion, formato, originales, lote):
+    """Escritura, tamano en disco y lectura con decodificacion de los documentos en un formato"""
+    import documentos
+    coleccion.drop()
+    convertir = documentos.compactar if formato == "compacto" else dict
+    inicio = time.time()
+    for i in range(0, len(originales), lote):
+        coleccion.insert_many([convertir(d) for d in originales[i:i + lote]])
+    escritura = time.time() - inicio
+    estadisticas = coleccion.database.command("collstats", coleccion.name)
+    inicio = time.time()
+    leidos = sum(1 for d in coleccion.find() if documentos.decodificar(d))
+    lectura = time.time() - inicio
+    return dict(formato=formato, documentos=leidos, bytes=estadisticas["size"],
+                bytes_disco=estadisticas["storageSize"], bytes_documento=estadisticas["avgObjSize"],
+                escritura_docs_s=len(originales) / escritura, lectura_docs_s=leidos / lectura)
+
+
+def medir_bson(formato, originales):
+    """Tamano BSON y throughput de codificacion y decodificacion de los documentos en un formato, sin servidor de
+    mongo: no incluye la compresion por bloques del motor de almacenamiento, los indices ni la red"""
+    import bson
+    import documentos
+    convertir = documentos.compactar if formato == "compacto" else dict
+    inicio = time.time()
+    codificados = [bson.BSON.encode(convertir(d)) for d in originales]
+    escritura = time.time() - inicio
+    inicio = time.time()
+    leidos = sum(1 for c in codificados if documentos.decodificar(bson.BSON(c).decode()))
+    lectura = time.time() - inicio
+    total = sum(len(c) for c in codificados)
+    return dict(formato=formato, documentos=leidos, bytes=total, bytes_disco=None,
+                bytes_documento=total // len(codificados), escritura_docs_s=len(originales) / escritura,
+                lectura_docs_s=leidos / lectura)
+
+
+def comando_mongo(args):
+    """Tamano de la coleccion y throughput de escritura y lectura de las predicciones en cada formato de
+    ``documentos``"""
+    import pymongo
+    random.seed(args.semilla)
+    originales = [documento_sintetico(1000000 + i) for i in range(args.documentos)]
+
+    def correr(host, puerto):
+        client = pymongo.MongoClient(host, puerto)
+        try:
+            coleccion = client["benchmark"]["caracteristicas"]
+            resultados = [medir_formato(coleccion, formato, originales, args.lote) for formato in args.formatos]
+            coleccion.drop()
+            return resultados
+        finally:
+            client.close()
+
+    if args.bson:
+        resultados = [medir_bson(formato, originales) for formato in args.formatos]
+    elif args.mongod:
+        with MongoLocal(args.mongod) as mongo:
+            resultados = correr("127.0.0.1", mongo.puerto)
+    else:
+        resultados = correr(args.mongo_host, args.mongo_port)
+
+    print("%-9s %10s %11s %11s %11s %15s %14s" % ("formato", "documentos", "datos(MB)", "disco(MB)", "bytes/doc",
+                                                   "escritura(d/s)", "lectura(d/s)"))
+    for r in resultados:
+        print("%-9s %10d %11.1f %11s %11d %15.0f %14.0f" % (
+            r["formato"], r["documentos"], r["bytes"] / 1e6,
+            "-" if r["bytes_disco"] is None else "%.1f" % (r["bytes_disco"] / 1e6), r["bytes_documento"],
+            r["escritura_docs_s"], r["lectura_docs_s"]))
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(dict(parametros=vars(args), resultado=resultados), f, indent=2, default=str)
+    return resultados
+
+
+# Bosque de spam de una sola hoja, para comparar las caracteristicas sin jueces entrenados: avg_spam queda en 0
+BOSQUE_NULO = dict(columnas=None, clases=2, arboles=[dict(caracteristica=[-1], umbral=[0.0], izquierdo=[-1],
+                                                          derecho=[-1], valores=[[1.0, 0.0]])])
+
+
+def comando_aproximado(args):
+    """
+    Caracteristicas y predicciones del modo aproximado del ejecutor local (``BocetoUsuario``) contra el modo exacto
+    sobre los timelines etiquetados, para cada tamano de muestra. Con ``--sin_jueces`` no usa Spark y solo compara
+    las caracteristicas, con un bosque de spam nulo
+    """
+    import ejecutor_local
+    from calculos import COLUMNAS_CARACTERISTICAS
+    if args.sin_jueces:
+        bosque_spam, bosque_juez = BOSQUE_NULO, None
+    elif not args.juez_spam or not args.juez:
+        raise SystemExit("--juez_spam y --juez son obligatorios sin --sin_jueces")
+    else:
+        import tools
+        tools.iniciar_spark_context(app_name="BenchmarkAproximado")
+        bosque_spam = ejecutor_local.exportar_bosque(tools.cargar_juez(args.juez_spam, 0))
+        bosque_juez = ejecutor_local.exportar_bosque(tools.cargar_juez(args.juez, 1))
+    archivos = [(archivo, categoria) for carpeta, categoria in CATEGORIAS
+                for archivo in ejecutor_local.expandir_directorio(os.path.join(args.entrenamiento, carpeta, "*"))]
+
+    def documento(c):
+        return ejecutor_local.documento_prediccion(c, bosque_juez) if bosque_juez else c
+
+    def exactitud(documentos, usuarios, referencia):
+        if not bosque_juez or not usuarios:
+            return None
+        return sum(documentos[u]["Predicted_categoria"] == referencia(u) for u in usuarios) / len(usuarios)
+
+    inicio = time.time()
+    exactas = {}
+    etiquetas = {}
+    for archivo, categoria in archivos:
+        for c in ejecutor_local.caracteristicas_archivo(archivo, bosque_spam)[0]:
+            exactas[c["user_id"]] = documento(c)
+            etiquetas[c["user_id"]] = categoria
+    resultados = [dict(muestra="exacto", segundos=time.time() - inicio, usuarios=len(exactas),
+                       exactitud=exactitud(exactas, list(exactas), etiquetas.get),
+                       concordancia=1.0 if bosque_juez else None, errores={})]
+
+    muestreadas = ["avg_palabras", "avg_diversidad_lex", "avg_diversidad_palabras", "avg_spam", "nroTweets"]
+    columnas = muestreadas + [c for c in COLUMNAS_CARACTERISTICAS if c not in muestreadas and not c.isdigit()]
+    for muestra in leer_enteros(args.muestras):
+        inicio = time.time()
+        aproximadas = {}
+        for archivo, _ in archivos:
+            for user_id, boceto in ejecutor_local.bocetos_archivo(archivo, bosque_spam, muestra,
+                                                                  args.precision)[0].items():
+                c = boceto.caracteristicas()
+                if c is not None:
+                    aproximadas[user_id] = documento(c)
+        segundos = time.time() - inicio
+        comunes = [u for u in aproximadas if u in exactas]
+        errores = {}
+        for columna in columnas:
+            diferencias = [abs(aproximadas[u][columna] - exactas[u][columna]) for u in comunes
+                           if columna in exactas[u]]
+            if diferencias:
+                errores[columna] = dict(media=sum(diferencias) / len(diferencias), maximo=max(diferencias))
+        resultados.append(dict(
+            muestra=muestra, segundos=segundos, usuarios=len(aproximadas),
+            exactitud=exactitud(aproximadas, comunes, etiquetas.get),
+            concordancia=exactitud(aproximadas, comunes, lambda u: exactas[u]["Predicted_categoria"]),
+            errores=errores))
+
+    print("%8s %10s %10s %13s %10s  %s" % ("muestra", "usuarios", "exactitud", "concordancia", "tiempo(s)",
+                                           "error medio/maximo"))
+    for r in resultados:
+        print("%8s %10d %10s %13s %10.2f  %s" % (
+            r["muestra"], r["usuarios"], "-" if r["exactitud"] is None else "%.1f%%" % (100 * r["exactitud"]),
+            "-" if r["concordancia"] is None else "%.1f%%" % (100 * r["concordancia"]), r["segundos"],
+            " ".join("%s=%.4f/%.4f" % (c, e["media"], e["maximo"]) for c, e in sorted(r["errores"].items())
+                     if e["maximo"] > 0)))
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(dict(parametros=vars(args), resultado=resultados), f, indent=2, default=str)
+    return resultados
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Mediciones de rendimiento del Twitter Judge")
+    comandos = parser.add_subparsers(dest="comando")
+
+    carga = comandos.add_parser("carga", help="Prueba de carga HTTP con percentiles de latencia por endpoint")
+    carga.add_argument("--url", help="Servidor ya levantado; si se omite se inicia uno local con create_app()")
+    carga.add_argument("--mongod", nargs="?", const="mongod",
+                       help="Levanta un mongod temporal (ruta opcional al binario) en lugar de la base configurada")
+    carga.add_argument("--mongo_host", help="Host de MongoDB para el servidor local")
+    carga.add_argument("--mongo_port", type=int, help="Puerto de MongoDB para el servidor local")
+    carga.add_argument("--timelines", nargs="+", default=[os.path.join(DIRECTORIO, "evaluar", "*")])
+    carga.add_argument("--endpoints", default="evaluar_online:1",
+                       help="Mezcla de endpoints con pesos, p.ej. evaluar_online:8,evaluar:1,alive:1")
+    carga.add_argument("--concurrencia", type=int, default=4)
+    carga.add_argument("--tasa", type=float, default=0, help="Peticiones por segundo, 0 para lazo cerrado")
+    carga.add_argument("--duracion", type=float, default=60)
+    carga.add_argument("--timeout", type=float, default=300)
+    carga.add_argument("--hilos", type=int, help="server.thread_pool de CherryPy para el servidor local")
+    carga.add_argument("--opciones_servidor", help="JSON con configuracion adicional de CherryPy")
+    carga.add_argument("--juez_spam", help="Juez de spam a cargar antes de la prueba")
+    carga.add_argument("--juez", help="Juez de timelines a cargar antes de la prueba")
+    carga.add_argument("--salida", help="Archivo JSON donde guardar parametros y resultados para comparar")
+    carga.set_defaults(funcion=comando_carga)
+
+    tope = comandos.add_parser("tope", help="Exactitud contra tiempo de evaluacion segun el tope de tweets por usuario")
+    tope.add_argument("--juez_spam", required=True)
+    tope.add_argument("--juez", help="Juez a medir con --validacion; sin --validacion se entrena uno")
+    tope.add_argument("--entrenamiento", default=os.path.join(DIRECTORIO, "entrenamiento"),
+                      help="Directorio con las carpetas Humanos, Bots y Ciborgs")
+    tope.add_argument("--validacion", help="Directorio con las carpetas Humanos, Bots y Ciborgs que --juez no vio "
+                                           "al entrenar; sin el se aparta una parte de --entrenamiento")
+    tope.add_argument("--fraccion_validacion", type=float, default=0.3,
+                      help="Fraccion de los timelines de cada categoria que se aparta para medir")
+    tope.add_argument("--topes", default="50,100,200,500", help="Topes a comparar, siempre se incluye sin tope")
+    tope.add_argument("--ventana_dias", type=int, default=0)
+    tope.add_argument("--salida", help="Archivo JSON donde guardar parametros y resultados para comparar")
+    tope.set_defaults(funcion=comando_tope)
+
+    ingesta = comandos.add_parser("ingesta", help="Throughput de ingesta de timelines planos y comprimidos")
+    ingesta.add_argument("--timelines", nargs="+", default=[os.path.join(DIRECTORIO, "evaluar", "*")])
+    ingesta.add_argument("--repeticiones", type=int, default=100,
+                         help="Veces que se repiten los timelines para generar la entrada")
+    ingesta.add_argument("--salida", help="Archivo JSON donde guardar parametros y resultados para comparar")
+    ingesta.set_defaults(funcion=comando_ingesta)
+
+    mongo = comandos.add_parser("mongo", help="Tamano y throughput de las predicciones en mongo por formato")
+    mongo.add_argument("--mongod", nargs="?", const="mongod",
+                       help="Levanta un mongod temporal (ruta opcional al binario) en lugar de --mongo_host")
+    mongo.add_argument("--bson", action="store_true",
+                       help="Sin servidor: mide solo el tamano BSON y la codificacion y decodificacion")
+    mongo.add_argument("--mongo_host", default="localhost")
+    mongo.add_argument("--mongo_port", type=int, default=27017)
+    mongo.add_argument("--documentos", type=int, default=100000)
+    mongo.add_argument("--lote", type=int, default=1000, help="Documentos por insert_many, como el ejecutor local")
+    mongo.add_argument("--formatos", nargs="+", default=["campos", "compacto"])
+    mongo.add_argument("--semilla", type=int, default=1)
+    mongo.add_argument("--salida", help="Archivo JSON donde guardar parametros y resultados para comparar")
+    mongo.set_defaults(funcion=comando_mongo)
+
+    aproximado = comandos.add_parser("aproximado", help="Exactitud y error de las caracteristicas del modo aproximado "
+                                                        "contra el modo exacto")
+    aproximado.add_argument("--juez_spam")
+    aproximado.add_argument("--juez")
+    aproximado.add_argument("--sin_jueces", action="store_true",
+                            help="Compara solo las caracteristicas, sin Spark ni jueces entrenados")
+    aproximado.add_argument("--entrenamiento", default=os.path.join(DIRECTORIO, "entrenamiento"),
+                            help="Directorio con las carpetas Humanos, Bots y Ciborgs")
+    aproximado.add_argument("--muestras", default="16,64,256", help="Tamanos de muestra a comparar")
+    aproximado.add_argument("--precision", type=int, default=12, help="Precision del HyperLogLog")
+    aproximado.add_argument("--salida", help="Archivo JSON donde guardar parametros y resultados para comparar")
+    aproximado.set_defaults(funcion=comando_aproximado)
+
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+    argumentos = crear_parser().parse_args()
+    argumentos.funcion(argumentos)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Bocetos (sketches) combinables para calcular caracteristicas con memoria acotada.
+
+Todos se alimentan con hashes de 64 bits del id del tweet (``hashes``), por lo que son deterministicos entre
+procesos y dos bocetos del mismo usuario se combinan con ``fusionar`` sin importar en que orden o en que archivo
+se vieron sus tweets. ``HyperLogLog``, ``MuestraMinima`` y ``Menores`` no cambian si se les agrega dos veces el
+mismo tweet; los conteos exactos que los acompanan en ``ejecutor_local.BocetoUsuario`` si, por lo que los
+repetidos se descartan antes. ``FiltroBloom`` lo usan los filtros de tweets vistos de ``deduplicacion``.
+"""
+
+from __future__ import division
+
+import hashlib
+import heapq
+import math
+import struct
+
+MASCARA_64 = (1 << 64) - 1
+
+
+def hashes(clave):
+    """Dos hashes independientes de 64 bits de una clave, tomados del md5 de su representacion"""
+    return struct.unpack("<QQ", hashlib.md5(str(clave).encode("utf-8")).digest())
+
+
+class HyperLogLog(object):
+    """Estimador de elementos distintos con ``2 ** precision`` registros de un byte. El error relativo estandar
+    es ``1.04 / sqrt(2 ** precision)``, 1.6% con la precision por defecto
+    """
+
+    def __init__(self, precision=12, registros=None):
+        self.precision = precision
+        self.registros = bytearray(registros) if registros is not None else bytearray(1 << precision)
+
+    def agregar(self, h):
+        indice = h >> (64 - self.precision)
+        resto = (h << self.precision) & MASCARA_64
+        rango = min(64 - self.precision, 64 - resto.bit_length()) + 1
+        if rango > self.registros[indice]:
+            self.registros[indice] = rango
+
+    def fusionar(self, otro):
+        if otro.precision != self.precision:
+            raise ValueError("No se pueden combinar HyperLogLog de precision %d y %d" % (self.precision,
+                                                                                           otro.precision))
+        for i, rango in enumerate(otro.registros):
+            if rango > self.registros[i]:
+                self.registros[i] = rango
+        return self
+
+    def estimar(self):
+        m = len(self.registros)
+        estimacion = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registros)
+        ceros = self.registros.count(b"\x00")
+        if estimacion <= 2.5 * m and ceros:
+            # Conteo lineal, mas preciso con pocos elementos
+            estimacion = m * math.log(m / ceros)
+        return estimacion
+
+
+class MuestraMinima(object):
+    """Los ``k`` elementos de menor hash (bottom-k): una muestra uniforme sin reemplazo que no depende del orden
+    de llegada. Los valores de un elemento solo se calculan si ``admite`` su hash
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.monticulo = []
+        self.valores = {}
+
+    def __len__(self):
+        return len(self.valores)
+
+    def admite(self, h):
+        return h not in self.valores and (len(self.monticulo) < self.k or h < -self.monticulo[0])
+
+    def agregar(self, h, valores):
+        if not self.admite(h):
+            return
+        self.valores[h] = valores
+        if len(self.monticulo) < self.k:
+            heapq.heappush(self.monticulo, -h)
+        else:
+            del self.valores[-heapq.heapreplace(self.monticulo, -h)]
+
+    def fusionar(self, otra):
+        for h, valores in otra.valores.items():
+            self.agregar(h, valores)
+        return self
+
+    def medias(self, columnas):
+        """Media de cada una de las ``columnas`` de los valores de la muestra, None si esta vacia"""
+        if not self.valores:
+            return None
+        return [sum(v[i] for v in self.valores.values()) / len(self.valores) for i in range(columnas)]
+
+
+class Menores(object):
+    """Los ``k`` menores valores distintos, por ejemplo los primeros tiempos de un usuario. Es exacto: al combinar
+    se conservan los ``k`` menores de la union
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.monticulo = []
+        self.presentes = set()
+
+    def agregar(self, valor, clave=None):
+        if (valor, clave) in self.presentes:
+            return
+        if len(self.monticulo) < self.k:
+            heapq.heappush(self.monticulo, (-valor, clave))
+        elif valor < -self.monticulo[0][0]:
+            mayor, clave_mayor = heapq.heapreplace(self.monticulo, (-valor, clave))
+            self.presentes.discard((-mayor, clave_mayor))
+        else:
+            return
+        self.presentes.add((valor, clave))
+
+    def fusionar(self, otros):
+        for valor, clave in otros.presentes:
+            self.agregar(valor, clave)
+        return self
+
+    def ordenados(self):
+        return sorted(valor for valor, _ in self.presentes)
+
+
+class FiltroBloom(object):
+    """Filtro de Bloom con doble hashing sobre ``hashes`` de la clave
+    """
+
+    def __init__(self, bits, funciones, datos=None, elementos=0):
+        self.bits = bits
+        self.funciones = funciones
+        self.datos = bytearray(datos) if datos is not None else bytearray((bits + 7) // 8)
+        self.elementos = elementos
+
+    @classmethod
+    def para(cls, capacidad, error):
+        """Filtro con el tamano optimo para ``capacidad`` elementos y tasa de falsos positivos ``error``"""
+        bits = int(math.ceil(-capacidad * math.log(error) / math.log(2) ** 2))
+        return cls(bits, max(1, int(round(bits / capacidad * math.log(2)))))
+
+    def _posiciones(self, clave):
+        h1, h2 = hashes(clave)
+        return [(h1 + i * h2) % self.bits for i in range(self.funciones)]
+
+    def __contains__(self, clave):
+        return all(self.datos[p >> 3] & (1 << (p & 7)) for p in self._posiciones(clave))
+
+    def agregar(self, clave):
+        """Agrega la clave; devuelve False si ya estaba (o es un falso positivo)"""
+        posiciones = self._posiciones(clave)
+        if all(self.datos[p >> 3] & (1 << (p & 7)) for p in posiciones):
+            return False
+        for p in posiciones:
+            self.datos[p >> 3] |= 1 << (p & 7)
+        self.elementos += 1
+        return True
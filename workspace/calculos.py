@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Calculos en Python puro de las caracteristicas, compartidos por las UDFs de Spark y el ejecutor local."""
+
+from __future__ import division
+
+import math
+import sys
+
+import numpy as np
+
+COLUMNAS_CARACTERISTICAS = [
+    "ano_registro", "con_descripcion", "con_geo_activo", "con_imagen_default", "con_imagen_fondo",
+    "con_perfil_verificado", "entropia", "followers_ratio", "n_favoritos", "n_listas", "n_tweets", "reputacion",
+    "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday", "0", "1", "2", "3", "4", "5", "6",
+    "7", "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20", "21", "22", "23", "uso_mobil",
+    "uso_terceros", "uso_web", "avg_diversidad_lex", "avg_long_tweets", "reply_ratio", "avg_hashtags",
+    "mention_ratio", "avg_palabras", "avg_diversidad_palabras", "url_ratio", "avg_spam"
+]
+
+NUM_CARACTERISTICAS_SPAM = 140
+
+# Se incrementa cada vez que cambia la definicion o el calculo de alguna caracteristica, para que el almacen de
+# caracteristicas no mezcle filas calculadas de formas distintas
+VERSION_CARACTERISTICAS = 1
+
+
+def quantize(signal, partitions, codebook):
+    indices = []
+    quanta = []
+    for datum in signal:
+        index = 0
+        while index < len(partitions) and datum > partitions[index]:
+            index += 1
+        indices.append(index)
+        quanta.append(codebook[index])
+    return indices, quanta
+
+
+def pattern_mat(x, m):
+    """
+    Construct a matrix of `m`-length segments of `x`.
+    Parameters
+    ----------
+    x : (N, ) array_like
+        Array of input data.
+    m : int
+        Length of segment. Must be at least 1. In the case that `m` is 1, the
+        input array is returned.
+    Returns
+    -------
+    patterns : (m, N-m+1)
+        Matrix whose first column is the first `m` elements of `x`, the second
+        column is `x[1:m+1]`, etc.
+    Examples
+    --------
+    > p = pattern_mat([1, 2, 3, 4, 5, 6, 7], 3])
+    array([[ 1.,  2.,  3.,	4.,	 5.],
+           [ 2.,  3.,  4.,	5.,	 6.],
+           [ 3.,  4.,  5.,	6.,	 7.]])
+    """
+    x = np.asarray(x).ravel()
+    if m == 1:
+        return x
+    else:
+        n = len(x)
+        patterns = np.zeros((m, n - m + 1))
+        for i in range(m):
+            patterns[i, :] = x[i:n - m + i + 1]
+        return patterns
+
+
+def en_shannon(series, l, num_int):
+    if not series:
+        raise ValueError("No hay serie definida")
+    if not l:
+        raise ValueError("No hay dimension (L) definida")
+    if not num_int:
+        raise ValueError("num_int sin definir")
+    # Normalizacion
+    series = (series - np.mean(series)) / np.std(series)
+    # We the values of the parameters required for the quantification:
+    epsilon = (max(series) - min(series)) / num_int
+    partition = np.arange(min(series), math.ceil(max(series)), epsilon)
+    codebook = np.arange(-1, num_int + 1)
+    # Uniform quantification of the time series:
+    _, quants = quantize(series, partition, codebook)
+    # The minimum value of the signal quantified assert passes -1 to 0:
+    quants = [0 if x == -1 else x for x in quants]
+    n = len(quants)
+    # We compose the patterns of length 'L':
+    X = pattern_mat(quants, l)
+    # We get the number of repetitions of each pattern:
+    num = np.ones(n - l + 1)
+    # This loop goes over the columns of 'X':
+    if l == 1:
+        X = np.atleast_2d(X)
+    for j in range(0, n - l + 1):
+        for i2 in range(j + 1, n - l + 1):
+            tmp = [0 if x == -1 else 1 for x in X[:, j]]
+            if (tmp[0] == 1) and (X[:, j] == X[:, i2]).all():
+                num[j] += 1
+                X[:, i2] = -1
+            tmp = -1
+
+    # We get those patterns which are not NaN:
+    aux = [0 if x == -1 else 1 for x in X[0, :]]
+    # Now, we can compute the number of different patterns:
+    new_num = []
+    for j, a in enumerate(aux):
+        if a != 0:
+            new_num.append(num[j])
+    new_num = np.asarray(new_num)
+
+    # We get the number of patterns which have appeared only once:
+    unique = sum(new_num[new_num == 1])
+    # We compute the probability of each pattern:
+    p_i = new_num / (n - l + 1)
+    # Finally, the Shannon Entropy is computed as:
+    SE = np.dot((- 1) * p_i, np.log(p_i))
+
+    return SE, unique
+
+
+def cond_en(series, l, num_int):
+    if not series:
+        raise ValueError("No hay serie definida")
+    if not l:
+        raise ValueError("No hay dimension (L) definida")
+    if not num_int:
+        raise ValueError("num_int sin definir")
+    # Processing:
+    # First, we call the Shannon Entropy function:
+    # 'L' as embedding dimension:
+    se, unique = en_shannon(series, l, num_int)
+    # 'L-1' as embedding dimension:
+    se_1, _ = en_shannon(series, l - 1, num_int)
+    # The Conditional Entropy is defined as a differential entropy:
+    ce = se - se_1
+    return ce, unique
+
+
+def correc_cond_en(series, lmax, num_int):
+    if not series:
+        raise ValueError("No hay serie definida")
+    if not lmax:
+        raise ValueError("No hay dimension (L) definida")
+    if not num_int:
+        raise ValueError("num_int sin definir")
+    N = len(series)
+    # We will use this for the correction term: (L=1)
+    e_est_1, _ = en_shannon(series, 1, num_int)
+    # Incializacin de la primera posicin del vector que almacena la CCE a un
+    # numero elevado para evitar que se salga del bucle en L=2 (primera
+    # iteracin):
+    # CCE is a vector that will contian the several CCE values computed:
+    CCE = sys.maxsize * np.ones(lmax + 1)
+    CCE[0] = 100
+    CE = np.ones(lmax + 1)
+    uniques = np.ones(lmax + 1)
+    correc_term = np.ones(lmax + 1)
+    for L in range(2, lmax + 1):
+        # First, we compute the CE for the current embedding dimension: ('L')
+        CE[L], uniques[L] = cond_en(series, L, num_int)
+        # Second, we compute the percentage of patterns which are not repeated:
+        perc_l = uniques[L] / (N - L + 1)
+        correc_term[L] = perc_l * e_est_1
+        # Third, the CCE is the CE plus the correction term:
+        CCE[L] = CE[L] + correc_term[L]
+
+    # Finally, the best estimation of the CCE is the minimum value of all the
+    # CCE that have been computed:
+    cce_min = min(CCE)
+    return cce_min
+
+
+FUENTES_MOVILES = ["http://twitter.com/download/android", "Twitter for Android", "http://blackberry.com/twitter",
+                   "Twitter for BlackBerry", "https://mobile.twitter.com", "Mobile Web",
+                   "http://twitter.com/download/iphone", "iOS", "http://twitter.com/#!/download/ipad",
+                   "Huawei Social Phone", "Windows Phone", "Twitter for Nokia S40"]
+
+
+def intertweet(tiempos):
+    """
+    Segundos entre tweets consecutivos
+    Parameters
+    ----------
+    tiempos : [int, ] list
+        Epoch de cada tweet del usuario, ordenados de forma ascendente
+    Examples
+    --------
+    > intertweet([10, 15, 35])
+    [5, 20]
+    """
+    return [tiempos[i] - tiempos[i - 1] for i in range(1, len(tiempos))]
+
+
+def fuente(source):
+    if "Twitter Web Client" in source:
+        return 'uso_web'
+    elif any(string in source for string in FUENTES_MOVILES):
+        return 'uso_mobil'
+    else:
+        return 'uso_terceros'
+
+
+month_map = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6, 'Jul': 7,
+    'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+}
+
+
+def parse_time(s):
+    return "{0:04d}-{1:02d}-{2:02d} {3:02d}:{4:02d}:{5:02d}".format(
+        int(s[-4:]),
+        month_map[s[4:7]],
+        int(s[8:10]),
+        int(s[11:13]),
+        int(s[14:16]),
+        int(s[17:19])
+    )
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Lectura de timelines comprimidos y compresion gzip de las peticiones HTTP.
+
+Hadoop lee gzip y bzip2 directamente con ``sc.textFile``; de ellos solo bzip2 se puede dividir en varias
+tareas, gzip se procesa con una tarea por archivo. zstd no esta disponible en el Hadoop de Spark 2.0, por lo que
+esos archivos se leen completos con ``sc.binaryFiles`` y se descomprimen en los executors, a medida que se
+recorren sus lineas, con el paquete opcional ``zstandard``.
+"""
+
+import bz2
+import gzip
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONES_ZSTD = (".zst", ".zstd")
+
+# Codecs que Hadoop no puede dividir: cada archivo se lee en una sola tarea
+EXTENSIONES_NO_DIVISIBLES = (".gz", ".deflate", ".snappy", ".lz4") + EXTENSIONES_ZSTD
+
+TAMANO_BLOQUE = 128 * 1024 * 1024
+
+
+def es_zstd(ruta):
+    return ruta.lower().endswith(EXTENSIONES_ZSTD)
+
+
+def divisible(ruta):
+    """Indica si Hadoop puede repartir el archivo en varias tareas (texto plano o bzip2)"""
+    return not ruta.lower().endswith(EXTENSIONES_NO_DIVISIBLES)
+
+
+def abrir_zstd(entrada):
+    """Flujo zstd que se descomprime a medida que se lee, con buffer para leerlo por lineas"""
+    if zstandard is None:
+        raise ImportError("Se requiere el paquete zstandard para leer archivos .zst")
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(entrada))
+
+
+def lineas_zstd(datos):
+    """
+    Lineas de texto de un archivo zstd completo, como las entregaria ``sc.textFile``: se separan solo por ``\n``
+    (no por los demas separadores de ``unicode.splitlines``, que pueden aparecer dentro de un tweet) y se
+    descomprimen a medida que se recorren
+    """
+    with abrir_zstd(io.BytesIO(datos)) as f:
+        for linea in f:
+            yield linea.rstrip(b"\r\n").decode("utf-8")
+
+
+def abrir(ruta):
+    """Abre un archivo de timeline local, descomprimiendolo segun su extension"""
+    minusculas = ruta.lower()
+    if minusculas.endswith(".gz"):
+        return gzip.open(ruta, "rb")
+    if minusculas.endswith(".bz2"):
+        return bz2.BZ2File(ruta, "rb")
+    if es_zstd(ruta):
+        return abrir_zstd(open(ruta, "rb"))
+    return open(ruta, "rb")
+
+
+def comprimir_gzip(datos, nivel=6):
+    compresor = zlib.compressobj(nivel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compresor.compress(datos) + compresor.flush()
+
+
+class CuerpoExcedido(ValueError):
+    """El contenido descomprimido supera el maximo permitido"""
+
+
+class LectorGzip(io.RawIOBase):
+    """
+    Descomprime un flujo gzip a medida que se lee, tomando de la entrada ``bloque`` bytes comprimidos por vez,
+    por lo que sirve tanto para cuerpos con Content-Length como chunked
+    Parameters
+    ----------
+    entrada : file
+        Flujo comprimido, leido hasta que devuelve b""
+    maximo : int
+        Bytes descomprimidos permitidos; al superarlo se lanza ``CuerpoExcedido`` sin descomprimir el resto
+    Raises
+    ------
+    zlib.error
+        Si el flujo no es gzip valido o esta truncado
+    """
+
+    def __init__(self, entrada, maximo=None, bloque=64 * 1024):
+        self.entrada = entrada
+        self.maximo = maximo
+        self.bloque = bloque
+        self.descompresor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pendiente = b""
+        self.entregados = 0
+        self.terminado = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, destino):
+        datos = self._descomprimir(len(destino))
+        destino[:len(datos)] = datos
+        return len(datos)
+
+    def _descomprimir(self, tamano):
+        while not self.terminado:
+            if not self.pendiente:
+                self.pendiente = self.entrada.read(self.bloque)
+                if not self.pendiente:
+                    self._finalizar()
+                    break
+            datos = self.descompresor.decompress(self.pendiente, tamano)
+            self.pendiente = self.descompresor.unconsumed_tail
+            if datos:
+                self.entregados += len(datos)
+                if self.maximo is not None and self.entregados > self.maximo:
+                    raise CuerpoExcedido("El cuerpo descomprimido supera %d bytes" % self.maximo)
+                return datos
+        return b""
+
+    def _finalizar(self):
+        self.terminado = True
+        if hasattr(self.descompresor, "eof"):
+            completo = self.descompresor.eof
+        else:
+            # Python 2 no tiene ``eof``: un flujo completo deja en ``unused_data`` lo que se agregue despues
+            self.descompresor.decompress(b"\x00")
+            completo = bool(self.descompresor.unused_data)
+        if not completo:
+            raise zlib.error("El flujo gzip esta incompleto")
+
+
+def abrir_gzip(entrada, maximo=None):
+    """``LectorGzip`` con buffer, que ademas permite leer por lineas o iterar"""
+    return io.BufferedReader(LectorGzip(entrada, maximo))
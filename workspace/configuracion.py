@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""Lectura de config.ini compartida por los modulos que tienen valores por defecto para sus opciones"""
+
+import ConfigParser
+import os
+
+configParser = ConfigParser.RawConfigParser()
+configParser.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.ini"))
+
+
+def opcion(seccion, nombre, defecto):
+    """Valor de ``nombre`` en ``seccion``, o ``defecto`` si config.ini no lo define"""
+    if configParser.has_option(seccion, nombre):
+        return configParser.get(seccion, nombre)
+    return defecto
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Filtros de Bloom por usuario con los ids de tweets ya ingeridos, para cargas incrementales.
+
+Cada usuario tiene un filtro dimensionado para ``capacidad`` tweets (3200 es el maximo que entrega el timeline
+de la API de Twitter) con una tasa de falsos positivos ``error``. Un falso positivo descarta un tweet nuevo como
+si fuera repetido; un tweet ya confirmado no se acepta dos veces. Los filtros se guardan en una coleccion de mongo.
+"""
+
+from __future__ import division
+
+import json
+import logging
+
+from bson.binary import Binary
+from pymongo.errors import DuplicateKeyError
+
+from bocetos import FiltroBloom
+
+logger = logging.getLogger(__name__)
+
+
+def claves_json(tweet):
+    return tweet["user"]["id"], tweet["id"]
+
+
+class TweetsVistos(object):
+    """Filtros de Bloom por usuario guardados en una coleccion de mongo, con el user_id como ``_id``
+
+    ``filtrar`` solo consulta los filtros; los tweets nuevos se agregan a los filtros guardados con ``confirmar``,
+    una vez que la evaluacion termino, para que una evaluacion fallida no los marque como vistos. Cada documento
+    tiene un campo ``version`` y ``confirmar`` solo lo reemplaza si no cambio desde que lo leyo; si otra peticion
+    lo modifico, vuelve a leerlo y agrega los tweets sobre esa version.
+    """
+
+    def __init__(self, coleccion, capacidad=3200, error=0.001, reintentos=5):
+        self.coleccion = coleccion
+        self.capacidad = capacidad
+        self.error = error
+        self.reintentos = reintentos
+        self.filtros = {}
+        self.pendientes = {}
+
+    def _leer(self, documento):
+        filtro = FiltroBloom(documento["bits"], documento["funciones"], documento["datos"], documento["elementos"])
+        return filtro, documento.get("version")
+
+    def filtrar(self, tweets, claves=claves_json):
+        """
+        Descarta los tweets ya vistos en cargas anteriores o repetidos en la misma carga, sin registrar los nuevos
+        Parameters
+        ----------
+        tweets : list
+            Tweets decodificados con ``id`` y ``user.id``, u otra representacion segun ``claves``
+        claves : function
+            Devuelve el user_id y el id de un tweet
+        Returns
+        -------
+        nuevos, duplicados : ([dict, ] list, int)
+            Tweets no vistos, en el orden original, y cantidad de descartados
+        """
+        usuarios = set(claves(t)[0] for t in tweets) - set(self.filtros)
+        for documento in self.coleccion.find({"_id": {"$in": list(usuarios)}}):
+            self.filtros[documento["_id"]] = self._leer(documento)
+        nuevos = []
+        for tweet in tweets:
+            user_id, id_tweet = claves(tweet)
+            if user_id not in self.filtros:
+                self.filtros[user_id] = (FiltroBloom.para(self.capacidad, self.error), None)
+            if self.filtros[user_id][0].agregar(id_tweet):
+                self.pendientes.setdefault(user_id, []).append(id_tweet)
+                nuevos.append(tweet)
+        return nuevos, len(tweets) - len(nuevos)
+
+    def confirmar(self):
+        """
+        Agrega a los filtros guardados los tweets nuevos de ``filtrar``
+        Returns
+        -------
+        usuarios : int
+            Filtros actualizados
+        """
+        actualizados = 0
+        for user_id, ids in self.pendientes.items():
+            filtro, version = self.filtros[user_id]
+            for _ in range(self.reintentos):
+                datos = dict(bits=filtro.bits, funciones=filtro.funciones, datos=Binary(bytes(filtro.datos)),
+                             elementos=filtro.elementos, version=(version or 0) + 1)
+                if version is None:
+                    try:
+                        self.coleccion.insert_one(dict(datos, _id=user_id))
+                        break
+                    except DuplicateKeyError:
+                        pass
+                elif self.coleccion.replace_one({"_id": user_id, "version": version}, datos).modified_count:
+                    break
+                # Otra peticion modifico el filtro: se agregan los tweets nuevos sobre la version guardada
+                documento = self.coleccion.find_one({"_id": user_id})
+                if documento is None:
+                    filtro, version = FiltroBloom.para(self.capacidad, self.error), None
+                else:
+                    filtro, version = self._leer(documento)
+                    version = version or 0
+                for id_tweet in ids:
+                    filtro.agregar(id_tweet)
+            else:
+                logger.warn("No se pudo actualizar el filtro del usuario %s tras %d intentos", user_id,
+                            self.reintentos)
+                continue
+            if filtro.elementos > self.capacidad:
+                logger.warn("El filtro del usuario %s tiene %d tweets, mas que su capacidad de %d; aumentan los "
+                            "falsos positivos", user_id, filtro.elementos, self.capacidad)
+            actualizados += 1
+        self.pendientes = {}
+        return actualizados
+
+    def filtrar_timeline(self, timeline):
+        """
+        ``filtrar`` sobre un timeline en JSON por lineas, como el que recibe ``evaluar_online``
+        Returns
+        -------
+        timeline, duplicados : (str, int)
+            Lineas con los tweets nuevos y cantidad de descartados. Las lineas sin id o user.id se conservan
+            y las que no son JSON se descartan, como lo haria ``read.json``.
+        """
+        lineas = []
+        tweets = []
+        for linea in timeline.splitlines():
+            try:
+                tweet = json.loads(linea)
+            except ValueError:
+                continue
+            if isinstance(tweet, dict) and tweet.get("id") is not None and (tweet.get("user") or {}).get("id"):
+                tweet["_linea"] = len(lineas)
+                tweets.append(tweet)
+            lineas.append(linea)
+        nuevos, duplicados = self.filtrar(tweets)
+        descartadas = set(t["_linea"] for t in tweets) - set(t["_linea"] for t in nuevos)
+        return "\n".join(l for i, l in enumerate(lineas) if i not in descartadas), duplicados
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Formato de los documentos de caracteristicas guardados en mongo.
+
+Con ``formato = campos`` (por defecto) cada caracteristica es un campo del documento, como siempre se guardaron.
+Con ``formato = compacto`` las columnas de ``COLUMNAS_CARACTERISTICAS`` se reemplazan por un unico campo binario
+``caracteristicas`` con el vector en float32 little-endian y el campo ``version_caracteristicas``, que referencia
+el documento de la coleccion de esquemas con el orden de las columnas de esa version. user_id, la prediccion, las
+probabilidades, las fechas y los datos de la evaluacion siguen siendo campos del documento, por lo que los
+indices, el TTL de ``createdAt``, ``/resultados/`` y ``/reevaluar/`` funcionan igual en ambos formatos.
+
+Para convertir los documentos ya guardados:
+
+> python workspace/documentos.py --formato compacto
+"""
+
+from __future__ import division
+
+import argparse
+import logging
+
+import numpy as np
+from bson.binary import Binary
+
+from calculos import COLUMNAS_CARACTERISTICAS, VERSION_CARACTERISTICAS
+from configuracion import configParser, opcion
+
+logger = logging.getLogger(__name__)
+
+FORMATOS = ("campos", "compacto")
+
+FORMATO = opcion("database", "formato", "campos")
+if FORMATO not in FORMATOS:
+    raise ValueError("Formato de documentos desconocido en [database]: %s" % FORMATO)
+COMPACTO = FORMATO == "compacto"
+
+COLECCION_ESQUEMAS = opcion("database", "collection_esquemas", "esquemas_caracteristicas")
+
+# Las columnas de horas se guardan en las predicciones como hora_N y en el set de entrenamiento como N
+CLAVES = [("hora_" + c) if c.isdigit() else c for c in COLUMNAS_CARACTERISTICAS]
+
+TIPO = np.dtype("<f4")
+
+
+def codificar(valores):
+    """Vector de caracteristicas como binario float32 little-endian"""
+    return Binary(np.asarray(valores, dtype=TIPO).tobytes())
+
+
+def vector(documento):
+    """Vector float32 de solo lectura sobre el binario de un documento compacto, sin copiarlo"""
+    return np.frombuffer(documento["caracteristicas"], dtype=TIPO)
+
+
+def compactar(documento):
+    """
+    Documento compacto equivalente, sin modificar el original
+    Parameters
+    ----------
+    documento : dict
+        Prediccion o fila del set de entrenamiento con todas las caracteristicas como campos
+    Returns
+    -------
+    compacto : dict
+        Los mismos campos sin las caracteristicas, mas ``caracteristicas`` y ``version_caracteristicas``
+    """
+    compacto = dict(documento)
+    valores = []
+    for columna, clave in zip(COLUMNAS_CARACTERISTICAS, CLAVES):
+        valor = compacto.pop(clave, None)
+        if columna != clave:
+            valor = compacto.pop(columna, valor)
+        valores.append(valor or 0)
+    compacto["caracteristicas"] = codificar(valores)
+    compacto["version_caracteristicas"] = VERSION_CARACTERISTICAS
+    return compacto
+
+
+def preparar(documento):
+    """Documento en el formato configurado para insertarlo en mongo"""
+    return compactar(documento) if COMPACTO else documento
+
+
+def decodificar(documento, esquemas=None):
+    """
+    Documento con las caracteristicas como campos, con los nombres de las predicciones
+    Parameters
+    ----------
+    documento : dict
+        Documento leido de mongo, en cualquiera de los dos formatos
+    esquemas : dict
+        Claves por ``version_caracteristicas``, como las devuelve ``leer_esquemas``. Por defecto solo la version
+        actual
+    Returns
+    -------
+    documento : dict
+        Copia del documento; los documentos que no son compactos se devuelven sin cambios
+    Raises
+    ------
+    ValueError
+        Si no se conoce el esquema de la version del documento
+    """
+    if "caracteristicas" not in documento:
+        return documento
+    version = documento.get("version_caracteristicas")
+    claves = (esquemas or {VERSION_CARACTERISTICAS: CLAVES}).get(version)
+    if claves is None:
+        raise ValueError("No se conoce el esquema de la version %s de las caracteristicas" % version)
+    valores = vector(documento)
+    if len(valores) != len(claves):
+        raise ValueError("El documento %s tiene %d caracteristicas y su esquema %d" % (
+            documento.get("_id"), len(valores), len(claves)))
+    decodificado = dict((k, v) for k, v in documento.items() if k not in ("caracteristicas", "version_caracteristicas"))
+    decodificado.update(zip(claves, valores.tolist()))
+    return decodificado
+
+
+def registrar_esquema(coleccion):
+    """Guarda en la coleccion de esquemas el orden de las columnas de la version actual"""
+    coleccion.replace_one({"_id": VERSION_CARACTERISTICAS}, dict(claves=CLAVES), upsert=True)
+
+
+def leer_esquemas(coleccion):
+    """Claves de cada version de las caracteristicas registrada en la coleccion de esquemas"""
+    esquemas = dict((d["_id"], d["claves"]) for d in coleccion.find())
+    esquemas.setdefault(VERSION_CARACTERISTICAS, CLAVES)
+    return esquemas
+
+
+def migrar(coleccion, formato, esquemas=None, lote=1000):
+    """
+    Reescribe en ``formato`` los documentos de la coleccion que estan en el otro formato, conservando su _id
+    Returns
+    -------
+    migrados : int
+        Cantidad de documentos reescritos
+    """
+    from pymongo import ReplaceOne
+    if formato not in FORMATOS:
+        raise ValueError("Formato de documentos desconocido: %s" % formato)
+    if formato == "compacto":
+        filtro = {"caracteristicas": {"$exists": False}, CLAVES[0]: {"$exists": True}}
+        convertir = compactar
+    else:
+        filtro = {"caracteristicas": {"$exists": True}}
+        convertir = lambda d: decodificar(d, esquemas)
+    migrados = 0
+    operaciones = []
+    for documento in coleccion.find(filtro):
+        operaciones.append(ReplaceOne({"_id": documento["_id"]}, convertir(documento)))
+        if len(operaciones) >= lote:
+            migrados += coleccion.bulk_write(operaciones, ordered=False).modified_count
+            operaciones = []
+    if operaciones:
+        migrados += coleccion.bulk_write(operaciones, ordered=False).modified_count
+    logger.info("%d documentos de %s migrados a %s", migrados, coleccion.full_name, formato)
+    return migrados
+
+
+if __name__ == "__main__":
+    import pymongo
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Convierte los documentos de caracteristicas guardados en mongo")
+    parser.add_argument("--formato", choices=FORMATOS, default="compacto")
+    parser.add_argument("--colecciones", nargs="+",
+                        default=[configParser.get("database", "collection"),
+                                 configParser.get("database", "collection_training")])
+    parser.add_argument("--lote", type=int, default=1000)
+    args = parser.parse_args()
+    client = pymongo.MongoClient("mongodb://" + configParser.get("database", "host") + ":" +
+                                 configParser.get("database", "port"))
+    try:
+        db = client[configParser.get("database", "db")]
+        registrar_esquema(db[COLECCION_ESQUEMAS])
+        esquemas = leer_esquemas(db[COLECCION_ESQUEMAS])
+        for nombre in args.colecciones:
+            migrar(db[nombre], args.formato, esquemas, args.lote)
+    finally:
+        client.close()
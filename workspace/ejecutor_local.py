@@ -0,0 +1,683 @@
+# -*- coding: utf-8 -*-
+"""Ejecutor local de ``evaluar`` sin Spark.
+
+Reparte los archivos de timelines entre un pool de procesos. Cada proceso recibe una sola vez los jueces
+exportados a estructuras de Python (``exportar_bosque``) y calcula en Python puro las mismas caracteristicas
+y probabilidades que el pipeline de Spark de ``tools.evaluar``, archivo por archivo.
+"""
+
+from __future__ import division
+
+import calendar
+import datetime
+import glob
+import gzip
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import struct
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+import bocetos
+import compresion
+from calculos import (COLUMNAS_CARACTERISTICAS, NUM_CARACTERISTICAS_SPAM, correc_cond_en, fuente, intertweet,
+                      parse_time)
+
+logger = logging.getLogger(__name__)
+
+DIAS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+FUENTES = ["uso_web", "uso_mobil", "uso_terceros"]
+
+_MASCARA = 0xFFFFFFFF
+
+# Separadores de \s en las expresiones regulares de Java, usados por el Tokenizer de Spark
+_SEPARADOR = re.compile(u"[ \t\n\x0b\x0c\r]")
+
+
+def _rotl(x, r):
+    return ((x << r) | (x >> (32 - r))) & _MASCARA
+
+
+def _mezclar_k1(k1):
+    k1 = (k1 * 0xcc9e2d51) & _MASCARA
+    k1 = _rotl(k1, 15)
+    return (k1 * 0x1b873593) & _MASCARA
+
+
+def _mezclar_h1(h1, k1):
+    h1 ^= k1
+    h1 = _rotl(h1, 13)
+    return (h1 * 5 + 0xe6546b64) & _MASCARA
+
+
+def murmur3(datos, semilla=42):
+    """
+    Murmur3 x86 de 32 bits tal como lo aplica Spark a los bytes UTF-8 de un String
+    (``Murmur3_x86_32.hashUnsafeBytes``, que mezcla los bytes finales uno a uno).
+    Returns
+    -------
+    hash : int
+        Entero de 32 bits con signo
+    Examples
+    --------
+    > murmur3(b"Spark")
+    228093765
+    """
+    n = len(datos)
+    alineado = n - n % 4
+    h1 = semilla & _MASCARA
+    for i in range(0, alineado, 4):
+        h1 = _mezclar_h1(h1, _mezclar_k1(struct.unpack_from("<I", datos, i)[0]))
+    for i in range(alineado, n):
+        h1 = _mezclar_h1(h1, _mezclar_k1(struct.unpack_from("b", datos, i)[0] & _MASCARA))
+    h1 ^= n
+    h1 ^= h1 >> 16
+    h1 = (h1 * 0x85ebca6b) & _MASCARA
+    h1 ^= h1 >> 13
+    h1 = (h1 * 0xc2b2ae35) & _MASCARA
+    h1 ^= h1 >> 16
+    return h1 - (1 << 32) if h1 & 0x80000000 else h1
+
+
+def tokenizar(texto):
+    """Equivalente al ``Tokenizer`` de Spark: minusculas y ``split("\\\\s")`` de Java"""
+    texto = texto.lower()
+    if not _SEPARADOR.search(texto):
+        return [texto]
+    palabras = _SEPARADOR.split(texto)
+    while palabras and palabras[-1] == "":
+        palabras.pop()
+    return palabras
+
+
+def vector_spam(texto, num_caracteristicas=NUM_CARACTERISTICAS_SPAM):
+    """Frecuencia de terminos con el mismo hashing que ``HashingTF``"""
+    x = [0.0] * num_caracteristicas
+    for palabra in tokenizar(texto):
+        x[murmur3(palabra.encode("utf-8")) % num_caracteristicas] += 1.0
+    return x
+
+
+def exportar_bosque(modelo):
+    """
+    Convierte un juez de Spark en una estructura de Python que se puede evaluar sin Spark
+    Parameters
+    ----------
+    modelo : PipelineModel
+        Juez cuya ultima etapa es un RandomForestClassificationModel, precedido opcionalmente por el
+        VectorAssembler que define el orden de las columnas
+    Returns
+    -------
+    bosque : dict
+        ``columnas`` (None si el modelo recibe el vector ya armado), ``clases`` y ``arboles``, cada uno con las
+        listas paralelas ``caracteristica``, ``umbral``, ``izquierdo``, ``derecho`` y ``valores``.
+        Las hojas tienen ``caracteristica`` -1 y en ``valores`` la distribucion normalizada de clases.
+    """
+    etapas = modelo.stages
+    columnas = list(etapas[0].getInputCols()) if len(etapas) > 1 else None
+    arboles = [_exportar_arbol(arbol.rootNode()) for arbol in etapas[-1]._java_obj.trees()]
+    return dict(columnas=columnas, clases=len(arboles[0]["valores"][_primera_hoja(arboles[0])]), arboles=arboles)
+
+
+def _primera_hoja(arbol):
+    return arbol["caracteristica"].index(-1)
+
+
+def _exportar_arbol(raiz):
+    arbol = dict(caracteristica=[], umbral=[], izquierdo=[], derecho=[], valores=[])
+
+    def agregar(nodo):
+        i = len(arbol["caracteristica"])
+        for lista in arbol.values():
+            lista.append(None)
+        if nodo.getClass().getSimpleName() == "InternalNode":
+            division = nodo.split()
+            if division.getClass().getSimpleName() != "ContinuousSplit":
+                raise ValueError("El ejecutor local solo soporta divisiones continuas")
+            arbol["caracteristica"][i] = division.featureIndex()
+            arbol["umbral"][i] = division.threshold()
+            arbol["izquierdo"][i] = agregar(nodo.leftChild())
+            arbol["derecho"][i] = agregar(nodo.rightChild())
+        else:
+            conteos = list(nodo.impurityStats().stats())
+            total = sum(conteos)
+            arbol["caracteristica"][i] = -1
+            arbol["valores"][i] = [c / total for c in conteos] if total else conteos
+        return i
+
+    agregar(raiz)
+    return arbol
+
+
+def probabilidades(bosque, x):
+    """
+    Probabilidad de cada clase como la calcula ``RandomForestClassificationModel``:
+    suma de las distribuciones normalizadas de las hojas, normalizada al final
+    """
+    votos = [0.0] * bosque["clases"]
+    for arbol in bosque["arboles"]:
+        caracteristica, umbral = arbol["caracteristica"], arbol["umbral"]
+        i = 0
+        while caracteristica[i] >= 0:
+            i = arbol["izquierdo"][i] if x[caracteristica[i]] <= umbral[i] else arbol["derecho"][i]
+        for clase, valor in enumerate(arbol["valores"][i]):
+            votos[clase] += valor
+    total = sum(votos)
+    return [v / total for v in votos] if total else votos
+
+
+def _arreglos_arbol(arbol, clases):
+    valores = np.zeros((len(arbol["caracteristica"]), clases))
+    for i, distribucion in enumerate(arbol["valores"]):
+        if distribucion is not None:
+            valores[i] = distribucion
+    indices = lambda lista: np.array([-1 if v is None else v for v in lista], dtype=np.int64)
+    return (indices(arbol["caracteristica"]), np.array([v or 0.0 for v in arbol["umbral"]]),
+            indices(arbol["izquierdo"]), indices(arbol["derecho"]), valores)
+
+
+def probabilidades_lote(bosque, X, columnas=None):
+    """
+    ``probabilidades`` vectorizado sobre una matriz con una fila por usuario
+    Parameters
+    ----------
+    X : numpy.ndarray
+        Caracteristicas en el orden de ``columnas``
+    columnas : list
+        Columnas de ``X``; si difieren de las del bosque se reordenan
+    Returns
+    -------
+    probabilidades : numpy.ndarray
+        Una fila por usuario y una columna por clase
+    """
+    if columnas is not None and bosque["columnas"] and list(columnas) != bosque["columnas"]:
+        X = X[:, [list(columnas).index(c) for c in bosque["columnas"]]]
+    X = np.asarray(X, dtype=np.float64)
+    filas = np.arange(len(X))
+    votos = np.zeros((len(X), bosque["clases"]))
+    arreglos = bosque.get("_arreglos")
+    if arreglos is None:
+        arreglos = bosque["_arreglos"] = [_arreglos_arbol(a, bosque["clases"]) for a in bosque["arboles"]]
+    for caracteristica, umbral, izquierdo, derecho, valores in arreglos:
+        nodos = np.zeros(len(X), dtype=np.int64)
+        activos = caracteristica[nodos] >= 0
+        while activos.any():
+            n = nodos[activos]
+            izquierda = X[filas[activos], caracteristica[n]] <= umbral[n]
+            nodos[activos] = np.where(izquierda, izquierdo[n], derecho[n])
+            activos = caracteristica[nodos] >= 0
+        votos += valores[nodos]
+    total = votos.sum(axis=1, keepdims=True)
+    return np.where(total > 0, votos / np.where(total > 0, total, 1), votos)
+
+
+def prediccion(probabilidad):
+    return float(max(range(len(probabilidad)), key=lambda c: (probabilidad[c], -c)))
+
+
+def leer_tweets(archivo):
+    """Tweets de un archivo de timeline, plano o comprimido, descartando lineas invalidas y tweets sin texto como
+    ``preparar_df``"""
+    with compresion.abrir(archivo) as f:
+        for linea in f:
+            linea = linea.strip()
+            if not linea:
+                continue
+            try:
+                tweet = json.loads(linea)
+            except ValueError:
+                continue
+            if isinstance(tweet, dict) and tweet.get("text") and (tweet.get("user") or {}).get("id") is not None:
+                yield tweet
+
+
+def _fecha(created_at):
+    return datetime.datetime.strptime(parse_time(created_at), "%Y-%m-%d %H:%M:%S")
+
+
+def _tamano(lista):
+    # F.size devuelve -1 para arreglos nulos
+    return len(lista) if lista is not None else -1
+
+
+def _numero(valor):
+    if valor is None or (isinstance(valor, float) and math.isnan(valor)):
+        return 0
+    return valor
+
+
+METRICAS_TEXTO = ("palabras", "diversidad_lex", "diversidad_palabras", "spam")
+
+
+def metricas_texto(texto, bosque_spam):
+    """Palabras, diversidad lexicografica, diversidad de palabras y prediccion de spam de un tweet"""
+    palabras = texto.split(" ")
+    return (len(palabras), len(set(texto)) / len(texto), len(set(palabras)) / len(palabras),
+            prediccion(probabilidades(bosque_spam, vector_spam(texto))))
+
+
+class Usuario(object):
+    """Acumula los tweets de un usuario y calcula sus caracteristicas
+    """
+
+    def __init__(self, perfil):
+        self.perfil = perfil
+        self.tiempos = []
+        self.n = 0
+        self.dias = dict((d, 0) for d in DIAS)
+        self.horas = [0] * 24
+        self.fuentes = dict((f, 0) for f in FUENTES)
+        self.sumas = dict(url=0, diversidad_lex=0.0, longitud=0, reply=0, hashtags=0, menciones=0, palabras=0,
+                          diversidad_palabras=0.0, spam=0.0)
+
+    def agregar(self, tweet, bosque_spam):
+        fecha = _fecha(tweet["created_at"])
+        self.tiempos.append(calendar.timegm(fecha.timetuple()))
+        self.contar(tweet, fecha)
+        for clave, valor in zip(METRICAS_TEXTO, metricas_texto(tweet["text"], bosque_spam)):
+            self.sumas[clave] += valor
+
+    def contar(self, tweet, fecha):
+        """Acumula los conteos del tweet que no requieren analizar su texto"""
+        entidades = tweet.get("entities") or {}
+        self.n += 1
+        self.dias[DIAS[fecha.weekday()]] += 1
+        self.horas[fecha.hour] += 1
+        self.fuentes[fuente(tweet.get("source") or "")] += 1
+        self.sumas["url"] += _tamano(entidades.get("urls"))
+        self.sumas["longitud"] += len(tweet["text"])
+        self.sumas["reply"] += 1 if tweet.get("in_reply_to_status_id") else 0
+        self.sumas["hashtags"] += len(entidades.get("hashtags") or [])
+        self.sumas["menciones"] += len(entidades.get("user_mentions") or [])
+
+    def caracteristicas(self):
+        """
+        Caracteristicas del usuario con los nombres de ``predecir``, o None si tiene muy pocos tweets,
+        igual que el filtro de ``preparar_df``
+        """
+        lista_intertweet = intertweet(sorted(self.tiempos))
+        if len(lista_intertweet) <= 3:
+            return None
+        serie = lista_intertweet[1:110]
+        perfil = self.perfil
+        seguidores, amigos = perfil.get("followers_count") or 0, perfil.get("friends_count") or 0
+        cuenta_creada = _fecha(perfil["created_at"])
+        n = self.n
+        resultado = dict(
+            user_id=perfil["id"],
+            nombre_usuario=perfil.get("screen_name"),
+            nroTweets=n,
+            cuenta_creada=cuenta_creada,
+            ano_registro=cuenta_creada.year,
+            con_imagen_fondo=1 if perfil.get("profile_use_background_image") else 0,
+            n_favoritos=perfil.get("favourites_count"),
+            con_descripcion=1 if perfil.get("description") else 0,
+            con_perfil_verificado=1 if perfil.get("verified") else 0,
+            con_imagen_default=1 if perfil.get("default_profile_image") else 0,
+            n_listas=perfil.get("listed_count"),
+            con_geo_activo=1 if perfil.get("geo_enabled") else 0,
+            reputacion=float(seguidores) / (seguidores + amigos) if seguidores + amigos > 0 else 0,
+            n_tweets=perfil.get("statuses_count"),
+            followers_ratio=float(seguidores) / amigos if amigos > 0 else 0,
+            entropia=float(correc_cond_en(serie, len(serie), len(serie))),
+            url_ratio=self.sumas["url"] / n,
+            avg_diversidad_lex=self.sumas["diversidad_lex"] / n,
+            avg_long_tweets=self.sumas["longitud"] / n,
+            reply_ratio=self.sumas["reply"] / n,
+            avg_hashtags=self.sumas["hashtags"] / n,
+            mention_ratio=self.sumas["menciones"] / n,
+            avg_palabras=self.sumas["palabras"] / n,
+            avg_diversidad_palabras=self.sumas["diversidad_palabras"] / n,
+            avg_spam=self.sumas["spam"] / n)
+        for dia, conteo in self.dias.items():
+            resultado[dia] = conteo / n
+        for hora, conteo in enumerate(self.horas):
+            resultado[str(hora)] = conteo / n
+        for origen, conteo in self.fuentes.items():
+            resultado[origen] = conteo / n
+        for clave, valor in resultado.items():
+            if clave not in ("nombre_usuario", "cuenta_creada"):
+                resultado[clave] = _numero(valor)
+        return resultado
+
+
+# La entropia usa los intervalos 1 a 109 de la serie ordenada, es decir los primeros 111 tiempos
+TIEMPOS_ENTROPIA = 111
+
+
+class BocetoUsuario(Usuario):
+    """Estado acotado de un usuario para el modo aproximado, combinable con ``fusionar``.
+
+    Dias, horas, fuentes, urls, longitud, respuestas, hashtags y menciones se cuentan de forma exacta y la
+    entropia usa los primeros ``TIEMPOS_ENTROPIA`` tiempos, tambien exactos. Palabras, diversidades y spam se
+    promedian sobre una muestra de ``muestra`` tweets elegidos por hash de su id, y nroTweets se estima con un
+    HyperLogLog de los ids. ``bocetos_archivo`` descarta antes los tweets repetidos por id, como el modo exacto.
+    """
+
+    def __init__(self, perfil, muestra=256, precision=12):
+        Usuario.__init__(self, perfil)
+        self.primeros = bocetos.Menores(TIEMPOS_ENTROPIA)
+        self.muestra = bocetos.MuestraMinima(muestra)
+        self.distintos = bocetos.HyperLogLog(precision)
+
+    def agregar(self, tweet, bosque_spam):
+        fecha = _fecha(tweet["created_at"])
+        self.contar(tweet, fecha)
+        hash_muestra, hash_distintos = bocetos.hashes(tweet.get("id"))
+        self.distintos.agregar(hash_distintos)
+        self.primeros.agregar(calendar.timegm(fecha.timetuple()), tweet.get("id"))
+        if self.muestra.admite(hash_muestra):
+            self.muestra.agregar(hash_muestra, metricas_texto(tweet["text"], bosque_spam))
+
+    def fusionar(self, otro):
+        """Incorpora el estado de otro boceto del mismo usuario, calculado sobre otro archivo"""
+        self.n += otro.n
+        for dia, conteo in otro.dias.items():
+            self.dias[dia] += conteo
+        for hora, conteo in enumerate(otro.horas):
+            self.horas[hora] += conteo
+        for origen, conteo in otro.fuentes.items():
+            self.fuentes[origen] += conteo
+        for clave, valor in otro.sumas.items():
+            if clave not in METRICAS_TEXTO:
+                self.sumas[clave] += valor
+        self.primeros.fusionar(otro.primeros)
+        self.muestra.fusionar(otro.muestra)
+        self.distintos.fusionar(otro.distintos)
+        return self
+
+    def caracteristicas(self):
+        self.tiempos = self.primeros.ordenados()
+        medias = self.muestra.medias(len(METRICAS_TEXTO)) or [0] * len(METRICAS_TEXTO)
+        for clave, media in zip(METRICAS_TEXTO, medias):
+            self.sumas[clave] = media * self.n
+        resultado = Usuario.caracteristicas(self)
+        if resultado is not None:
+            resultado["nroTweets"] = int(round(self.distintos.estimar()))
+        return resultado
+
+
+def ids_archivo(archivo):
+    """Ids distintos de los tweets de un archivo, para ``repetidos_entre_archivos``"""
+    return np.unique(np.array([t["id"] for t in leer_tweets(archivo) if t.get("id") is not None], dtype=np.int64))
+
+
+def repetidos_entre_archivos(ids):
+    """
+    Ids que cada archivo debe omitir porque ya aparecen en un archivo anterior de la lista, de modo que cada tweet
+    se cuente una sola vez en toda la evaluacion
+    Parameters
+    ----------
+    ids : [np.ndarray, ] list
+        Ids distintos de cada archivo, de ``ids_archivo``
+    Returns
+    -------
+    omitir : [frozenset, ] list
+        Ids a descartar en cada archivo, en el mismo orden
+    """
+    omitir = [set() for _ in ids]
+    if ids:
+        todos = np.concatenate(ids)
+        origen = np.repeat(np.arange(len(ids)), [len(i) for i in ids])
+        orden = np.lexsort((origen, todos))
+        todos, origen = todos[orden], origen[orden]
+        repetido = np.zeros(len(todos), dtype=bool)
+        repetido[1:] = todos[1:] == todos[:-1]
+        for i, id_tweet in zip(origen[repetido], todos[repetido]):
+            omitir[i].add(int(id_tweet))
+    return [frozenset(o) for o in omitir]
+
+
+def bocetos_archivo(archivo, bosque_spam, muestra=256, precision=12, omitir=frozenset()):
+    """
+    Bocetos de los usuarios de un archivo de timeline, leido en flujo sin conservar sus tweets. Los repetidos se
+    descartan igual que en ``caracteristicas_archivo``
+    Returns
+    -------
+    usuarios, duplicados : (dict, int)
+        Bocetos por user_id y cantidad de tweets repetidos descartados
+    """
+    usuarios = {}
+    ids = set(omitir)
+    duplicados = 0
+    for tweet in leer_tweets(archivo):
+        if tweet.get("id") in ids:
+            duplicados += 1
+            continue
+        ids.add(tweet.get("id"))
+        perfil = tweet["user"]
+        boceto = usuarios.get(perfil["id"])
+        if boceto is None:
+            boceto = usuarios[perfil["id"]] = BocetoUsuario(perfil, muestra, precision)
+        boceto.agregar(tweet, bosque_spam)
+    return usuarios, duplicados
+
+
+def limitar_tweets(tweets, tope=None, dias=None):
+    """Mismo recorte que ``tools.limitar_tweets`` sobre los tweets ya parseados de un usuario"""
+    if not tope and not dias:
+        return tweets
+    tweets = sorted(tweets, key=lambda t: t[0], reverse=True)
+    if tope:
+        tweets = tweets[:tope]
+    if dias:
+        limite = tweets[0][0] - datetime.timedelta(days=int(dias))
+        tweets = [t for t in tweets if t[0] >= limite]
+    return tweets
+
+
+def caracteristicas_archivo(archivo, bosque_spam, tope=None, dias=None, omitir=frozenset()):
+    """
+    Caracteristicas de los usuarios de un archivo de timeline, sin tweets repetidos por id y con a lo sumo
+    ``tope`` tweets por usuario publicados en los ``dias`` previos a su ultimo tweet
+    Parameters
+    ----------
+    omitir : frozenset
+        Ids ya leidos en otro archivo de la evaluacion (``repetidos_entre_archivos``), que se descartan como
+        repetidos junto con los que se repiten dentro del archivo
+    Returns
+    -------
+    caracteristicas, duplicados : ([dict, ] list, int)
+        Caracteristicas de cada usuario y cantidad de tweets repetidos descartados
+    """
+    usuarios = {}
+    tweets = {}
+    ids = set(omitir)
+    duplicados = 0
+    for tweet in leer_tweets(archivo):
+        if tweet.get("id") in ids:
+            duplicados += 1
+            continue
+        ids.add(tweet.get("id"))
+        perfil = tweet["user"]
+        if perfil["id"] not in usuarios:
+            usuarios[perfil["id"]] = Usuario(perfil)
+            tweets[perfil["id"]] = []
+        tweets[perfil["id"]].append((_fecha(tweet["created_at"]), tweet))
+    for user_id, usuario in usuarios.items():
+        for _, tweet in limitar_tweets(tweets.pop(user_id), tope, dias):
+            usuario.agregar(tweet, bosque_spam)
+    return [c for c in (u.caracteristicas() for u in usuarios.values()) if c is not None], duplicados
+
+
+def documento_prediccion(caracteristicas, bosque_juez, tope=None, dias=None):
+    """Documento con el mismo formato que las filas de ``tools.predecir`` y ``tools.registrar_tope``"""
+    columnas = bosque_juez["columnas"] or COLUMNAS_CARACTERISTICAS
+    probabilidad = probabilidades(bosque_juez, [caracteristicas[c] for c in columnas])
+    documento = dict((("hora_" + c) if c.isdigit() else c, v) for c, v in caracteristicas.items())
+    documento.update(createdAt=datetime.datetime.utcnow(), Predicted_categoria=prediccion(probabilidad),
+                     probabilidades=probabilidad, tope_tweets=tope or None, ventana_dias=dias or None)
+    return documento
+
+
+def expandir_directorio(directorio):
+    """
+    Archivos locales que leeria ``sc.textFile(directorio)``: rutas separadas por comas, globs y directorios,
+    ignorando archivos ocultos como Hadoop
+    """
+    archivos = []
+    for patron in directorio.split(","):
+        if patron.startswith("file://"):
+            patron = patron[len("file://"):]
+        elif "://" in patron:
+            raise ValueError("El ejecutor local solo lee archivos locales: %s" % patron)
+        for ruta in sorted(glob.glob(patron)):
+            if os.path.isdir(ruta):
+                archivos.extend(sorted(os.path.join(ruta, a) for a in os.listdir(ruta)
+                                       if not a.startswith((".", "_")) and os.path.isfile(os.path.join(ruta, a))))
+            elif not os.path.basename(ruta).startswith((".", "_")):
+                archivos.append(ruta)
+    return archivos
+
+
+def escribir_jsonl(documentos, ruta):
+    """
+    Equivalente local de ``tools.escribir_predicciones`` en formato "jsonl": escribe los documentos en
+    ``<ruta>/part-00000.json.gz``
+    Returns
+    -------
+    resumen : dict
+        Formato, ruta, usuarios por categoria predicha y total
+    """
+    if os.path.exists(ruta):
+        raise ValueError("La ruta de salida ya existe: %s" % ruta)
+    os.makedirs(ruta)
+    categorias = {}
+    with gzip.open(os.path.join(ruta, "part-00000.json.gz"), "wb") as f:
+        for documento in documentos:
+            f.write(json.dumps(documento, default=str) + "\n")
+            categoria = int(documento["Predicted_categoria"])
+            categorias[categoria] = categorias.get(categoria, 0) + 1
+    return dict(formato="jsonl", ruta=ruta, categorias=categorias, usuarios=sum(categorias.values()))
+
+
+_jueces = {}
+
+
+def _iniciar_proceso(bosque_spam, bosque_juez):
+    _jueces["spam"] = bosque_spam
+    _jueces["juez"] = bosque_juez
+
+
+def _evaluar_archivo(argumentos):
+    archivo, tope, dias, omitir = argumentos
+    caracteristicas, duplicados = caracteristicas_archivo(archivo, _jueces["spam"], tope, dias, omitir)
+    return [documento_prediccion(c, _jueces["juez"], tope, dias) for c in caracteristicas], duplicados
+
+
+def _bocetos_archivo(argumentos):
+    archivo, muestra, precision, omitir = argumentos
+    return bocetos_archivo(archivo, _jueces["spam"], muestra, precision, omitir)
+
+
+class EjecutorLocal(object):
+    """Pool de procesos que conserva los jueces cargados mientras no cambien
+    """
+
+    def __init__(self, procesos=None, muestra=256, precision=12):
+        self.procesos = procesos or None
+        self.muestra = muestra
+        self.precision = precision
+        self.pool = None
+        self.jueces = (None, None)
+        self.bloqueo = threading.Lock()
+        # Evaluaciones en curso por pool, para no cerrar uno reemplazado mientras se lo usa
+        self.prestamos = {}
+
+    @contextmanager
+    def prestar(self, bosque_spam, bosque_juez):
+        """
+        Pool con los jueces indicados, reservado mientras dura el bloque. Si los jueces cambiaron se crea uno
+        nuevo; el anterior se cierra en segundo plano cuando lo devuelve la ultima evaluacion que lo estaba usando
+        """
+        with self.bloqueo:
+            if self.pool is None or self.jueces[0] is not bosque_spam or self.jueces[1] is not bosque_juez:
+                anterior = self.pool
+                logger.info("Iniciando pool local de procesos...")
+                self.pool = multiprocessing.Pool(self.procesos, _iniciar_proceso, (bosque_spam, bosque_juez))
+                self.jueces = (bosque_spam, bosque_juez)
+                if anterior is not None and not self.prestamos.get(anterior):
+                    _cerrar_en_segundo_plano(anterior)
+            pool = self.pool
+            self.prestamos[pool] = self.prestamos.get(pool, 0) + 1
+        try:
+            yield pool
+        finally:
+            with self.bloqueo:
+                self.prestamos[pool] -= 1
+                if not self.prestamos[pool]:
+                    del self.prestamos[pool]
+                    if pool is not self.pool:
+                        _cerrar_en_segundo_plano(pool)
+
+    def evaluar(self, archivos, bosque_spam, bosque_juez, tope=None, dias=None, resumen=None, aproximado=False):
+        """
+        Evalua los archivos en paralelo, con el tope de tweets y la ventana de ``caracteristicas_archivo``.
+        Un tweet repetido se conserva solo en el primer archivo de la lista en que aparece: con mas de un archivo,
+        una primera pasada en el pool lee los ids de cada uno (``ids_archivo``) y cada archivo descarta ademas los
+        ya leidos en uno anterior. Si se pasa el diccionario ``resumen``, se acumula en su clave ``duplicados`` la
+        cantidad de tweets repetidos descartados.
+        Con ``aproximado`` cada archivo se resume en bocetos por usuario (``BocetoUsuario``) que se combinan entre
+        archivos, por lo que un usuario puede estar repartido en varios; no admite tope ni ventana.
+        Returns
+        -------
+        documentos : generator
+            Documentos de prediccion a medida que cada archivo termina, o al final en modo aproximado
+        """
+        if aproximado and (tope or dias):
+            raise ValueError("El modo aproximado no admite tope_tweets ni ventana_dias")
+        with self.prestar(bosque_spam, bosque_juez) as pool:
+            omitir = [frozenset()] * len(archivos)
+            if len(archivos) > 1:
+                omitir = repetidos_entre_archivos(pool.map(ids_archivo, archivos))
+            if aproximado:
+                for documento in self.evaluar_aproximado(pool, archivos, bosque_juez, resumen, omitir):
+                    yield documento
+                return
+            for documentos, duplicados in pool.imap_unordered(_evaluar_archivo,
+                                                              [(a, tope, dias, o) for a, o in zip(archivos, omitir)]):
+                if resumen is not None:
+                    resumen["duplicados"] = resumen.get("duplicados", 0) + duplicados
+                for documento in documentos:
+                    yield documento
+
+    def evaluar_aproximado(self, pool, archivos, bosque_juez, resumen=None, omitir=None):
+        usuarios = {}
+        omitir = omitir or [frozenset()] * len(archivos)
+        argumentos = [(a, self.muestra, self.precision, o) for a, o in zip(archivos, omitir)]
+        for bocetos_usuarios, duplicados in pool.imap_unordered(_bocetos_archivo, argumentos):
+            if resumen is not None:
+                resumen["duplicados"] = resumen.get("duplicados", 0) + duplicados
+            for user_id, boceto in bocetos_usuarios.items():
+                if user_id in usuarios:
+                    usuarios[user_id].fusionar(boceto)
+                else:
+                    usuarios[user_id] = boceto
+        for user_id in list(usuarios):
+            caracteristicas = usuarios.pop(user_id).caracteristicas()
+            if caracteristicas is not None:
+                documento = documento_prediccion(caracteristicas, bosque_juez)
+                documento["aproximado"] = True
+                yield documento
+
+    def cerrar(self):
+        """Termina el pool actual sin esperar las evaluaciones en curso, que fallan"""
+        with self.bloqueo:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+
+
+def _cerrar_en_segundo_plano(pool):
+    """Cierra un pool reemplazado: no acepta tareas nuevas y sus procesos terminan al completar las pendientes"""
+    pool.close()
+    hilo = threading.Thread(target=pool.join, name="cierre-pool-local")
+    hilo.daemon = True
+    hilo.start()
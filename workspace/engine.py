@@ -1,8 +1,22 @@
+import atexit
+import datetime
+import itertools
 import logging
 import os
+import threading
+import time
+from contextlib import contextmanager
 
 import pymongo
 import ConfigParser
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+import documentos
+import metricas
+import plan
+import seguimiento
+from metricas import medir
 
 configParser = ConfigParser.RawConfigParser()
 configParser.read("workspace/config.ini")
@@ -11,6 +25,16 @@ os.chdir(os.path.dirname(os.path.abspath(__file__)))
 # logging.basicConfig(filename="logs/engine.log", format='%(levelname)s:%(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Modos de evaluacion que usan el ejecutor local en lugar de Spark
+MODOS_LOCALES = ("local", "aproximado")
+
+# Filas que se acumulan antes de escribirlas en la matriz de caracteristicas
+LOTE_MATRIZ = 1000
+
+# Formatos de ``evaluar_a_archivo`` con Spark y con el ejecutor local
+FORMATOS_SALIDA = ("parquet", "jsonl")
+FORMATOS_SALIDA_LOCAL = ("jsonl",)
+
 
 class MotorClasificador:
     """Motor del clasificador de cuentas
@@ -30,10 +54,30 @@ class MotorClasificador:
         self.mongodb_collection = configParser.get("database", "collection")
         self.mongodb_collection_trainingset = configParser.get("database", "collection_training")
         self.spark_session = tools.spark_session()
+        self.historial_spark = seguimiento.HistorialSpark(self.sc,
+                                                          int(configParser.get("spark", "historial_peticiones")))
+        self.modo_ejecucion = configParser.get("ejecucion", "modo")
+        self.tope_tweets = int(configParser.get("ingesta", "tope_tweets"))
+        self.ventana_dias = int(configParser.get("ingesta", "ventana_dias"))
+        self.ejecutor_local = None
+        self.bosques = (None, None, None)
+        self.bloqueo_local = threading.Lock()
+        self.matriz = None
+        if configParser.getboolean("matriz", "activo"):
+            import matriz
+            self.matriz = matriz.MatrizCaracteristicas(configParser.get("matriz", "directorio"))
+            self.intervalo_matriz = float(configParser.get("matriz", "intervalo_guardado"))
+            atexit.register(self.matriz.guardar)
         client = pymongo.MongoClient(self.mongodb_host + ":" + self.mongodb_port)
         db = client[self.mongodb_db]
         coleccion = db[self.mongodb_collection]
         coleccion.ensure_index("createdAt", expireAfterSeconds=int(configParser.get("database", "ttl")))
+        coleccion.ensure_index("id_evaluacion")
+        coleccion.ensure_index("user_id")
+        if self.matriz is not None:
+            db[configParser.get("matriz", "coleccion")].ensure_index("user_id", unique=True)
+        if documentos.COMPACTO:
+            documentos.registrar_esquema(db[documentos.COLECCION_ESQUEMAS])
         client.close()
 
     def entrenar_spam(self, dir_spam, dir_no_spam, num_trees, max_depth):
@@ -60,13 +104,38 @@ class MotorClasificador:
             """
         import tools
         sc = self.sc
-        spark_session = self.spark_session
+        spark_session = self.sesion_directorio(dir_spam + "," + dir_no_spam, "entrenar_spam")
         modelo, accuracy = tools.entrenar_spam(sc, spark_session, dir_spam, dir_no_spam, num_trees, max_depth)
         self.modelo_spam = modelo
 
         return accuracy
 
-    def entrenar_juez(self, humanos, ciborgs, bots, dir_juez, num_trees, max_depth):
+    def sesion_directorio(self, directorio, descripcion):
+        """Sesion de Spark con el plan de ejecucion para el tamano de los archivos de ``directorio``"""
+        import tools
+        if not plan.ACTIVO:
+            return self.spark_session
+        estimacion = plan.estimar_archivos(tools.listar_archivos(self.sc, directorio))
+        return plan.sesion(self.spark_session, estimacion, descripcion)
+
+    def limites(self, tope=None, dias=None, aproximado=False):
+        """Tope de tweets por usuario y ventana en dias de la peticion, o los de la seccion [ingesta] de config.ini.
+        0 indica sin limite. El modo aproximado no usa los de config.ini, ya que sus bocetos no los admiten.
+        Un valor negativo o que no es entero lanza ValueError."""
+        tope = (None if aproximado else self.tope_tweets) if tope is None else int(tope)
+        dias = (None if aproximado else self.ventana_dias) if dias is None else int(dias)
+        if (tope or 0) < 0 or (dias or 0) < 0:
+            raise ValueError("tope_tweets y ventana_dias no pueden ser negativos: %r, %r" % (tope, dias))
+        return tope or None, dias or None
+
+    def validar_limites(self, modo=None, tope=None, dias=None):
+        """Motivo por el que no se puede evaluar con el tope y la ventana de la peticion en el modo indicado, o None"""
+        if (modo or self.modo_ejecucion) == "aproximado" and (tope or dias):
+            return "El modo aproximado no admite tope_tweets ni ventana_dias"
+        return None
+
+    def entrenar_juez(self, humanos, ciborgs, bots, dir_juez, num_trees, max_depth, tope=None, dias=None,
+                      almacen=None):
         """
             Entrena el juez que clasifica los tweets spam
             Parameters
@@ -81,6 +150,13 @@ class MotorClasificador:
                 Numero de arboles a utilizar para entrenar el Random Forest
             max_depth : int
                 Maxima profundidad utilizada para el bosque del Random Forest
+            tope : int
+                Maximo de tweets mas recientes por usuario. Por defecto tope_tweets de [ingesta]
+            dias : int
+                Ventana en dias previa al ultimo tweet de cada usuario. Por defecto ventana_dias de [ingesta]
+            almacen : str
+                Almacen de caracteristicas en Parquet. Si se indica, los usuarios extraidos que no esten en el
+                almacen se agregan y el juez se entrena con el almacen completo
             Returns
             -------
             accuracy : Double
@@ -88,20 +164,22 @@ class MotorClasificador:
             Examples
             --------
             > entrenar_juez("/carpeta/humanos", "/carpeta/ciborgs", "/carpeta/bots", 2, 4)
+            > entrenar_juez("/nuevos/humanos", "/nuevos/ciborgs", "/nuevos/bots", 2, 4, almacen="/almacen/juez")
             """
         import tools
         sc = self.sc
         juez_spam = self.modelo_spam
-        spark_session = self.spark_session
+        spark_session = self.sesion_directorio(",".join([humanos, ciborgs, bots]), "entrenar_juez")
 
         logger.info("Entrenando juez...")
 
         mongo_uri = (self.mongodb_host + ":" + self.mongodb_port + "/" + self.mongodb_db + "." +
                      self.mongodb_collection_trainingset)
 
+        tope, dias = self.limites(tope, dias)
         juez_timelines, accuracy, matrix = tools.entrenar_juez(sc, spark_session, juez_spam, humanos, ciborgs, bots,
                                                                dir_juez, mongo_uri, num_trees,
-                                                               max_depth)
+                                                               max_depth, tope, dias, almacen)
 
         self.juez_timelines = juez_timelines
 
@@ -109,13 +187,45 @@ class MotorClasificador:
 
         return accuracy, matrix
 
-    def evaluar(self, dir_timeline):
+    def entrenar_juez_almacen(self, almacen, dir_juez, num_trees, max_depth):
+        """
+            Entrena el juez con las caracteristicas ya guardadas en el almacen, sin extraerlas de los timelines
+            Parameters
+            ----------
+            almacen : str
+                Almacen de caracteristicas en Parquet generado por ``entrenar_juez``
+            Returns
+            -------
+            accuracy : Double
+                La exactitud del modelo y la matriz de confusion
+            Examples
+            --------
+            > entrenar_juez_almacen("/almacen/juez", "jueces/test2", 50, 10)
+            """
+        import tools
+        mongo_uri = (self.mongodb_host + ":" + self.mongodb_port + "/" + self.mongodb_db + "." +
+                     self.mongodb_collection_trainingset)
+        juez_timelines, accuracy, matrix = tools.entrenar_juez_almacen(self.spark_session, almacen, dir_juez,
+                                                                       mongo_uri, num_trees, max_depth)
+        self.juez_timelines = juez_timelines
+        return accuracy, matrix
+
+    def evaluar(self, dir_timeline, modo=None, tope=None, dias=None, id_evaluacion=None):
         """
             Evalua y clasifica los timelines
             Parameters
             ----------
             dir_timeline : str
                 Direccion en la que se encuentran los timelines a clasificar
+            modo : str
+                "spark", "local" o "aproximado" (ejecutor local con bocetos, ver ``evaluar_local``). Por defecto el
+                indicado en la seccion [ejecucion] de config.ini
+            tope : int
+                Maximo de tweets mas recientes por usuario. Por defecto tope_tweets de [ingesta]
+            dias : int
+                Ventana en dias previa al ultimo tweet de cada usuario. Por defecto ventana_dias de [ingesta]
+            id_evaluacion : str
+                Identificador con el que se guardan las predicciones, para leerlas luego con ``resultados``
             Returns
             -------
             Resultado : [int, ] list
@@ -123,28 +233,351 @@ class MotorClasificador:
             Examples
             --------
             > evaluar('{"directorio":"/carpeta/con/timelines/*"}')
+            > evaluar('{"directorio":"/carpeta/con/timelines/*", "modo": "local"}')
+            > evaluar('{"directorio":"/carpeta/con/timelines/*", "tope_tweets": 200, "ventana_dias": 90}')
+            """
+        modo = modo or self.modo_ejecucion
+        tope, dias = self.limites(tope, dias, modo == "aproximado")
+        if modo in MODOS_LOCALES:
+            return self.evaluar_local(dir_timeline, tope, dias, id_evaluacion, modo == "aproximado")
+        with self.predicciones(dir_timeline, tope, dias, id_evaluacion) as resultado:
+            with medir("recoleccion"):
+                filas = resultado.select(self.columnas_resultado()).collect()
+            return list(self.registrar_filas(filas))
+
+    def evaluar_flujo(self, dir_timeline, modo=None, tope=None, dias=None, id_evaluacion=None):
+        """
+            Igual que ``evaluar``, pero entrega los resultados a medida que se leen: con Spark se recorre una
+            particion a la vez con toLocalIterator, por lo que la memoria del driver no depende del total de usuarios.
+            El primer resultado se obtiene antes de devolver el iterador, de modo que la evaluacion con Spark
+            (incluida la escritura en mongo) o el primer archivo del ejecutor local ya terminaron y sus errores
+            son errores de la peticion; solo la lectura de los resultados restantes ocurre mientras se envian
+            Returns
+            -------
+            Resultado : iterator
+                Pares [user_id, probabilidades]
+            """
+        filas = self.filas_flujo(dir_timeline, modo, tope, dias, id_evaluacion)
+        for primera in filas:
+            return itertools.chain([primera], filas)
+        return iter([])
+
+    def filas_flujo(self, dir_timeline, modo=None, tope=None, dias=None, id_evaluacion=None):
+        modo = modo or self.modo_ejecucion
+        tope, dias = self.limites(tope, dias, modo == "aproximado")
+        if modo in MODOS_LOCALES:
+            for documento in self.documentos_locales(dir_timeline, tope, dias, id_evaluacion, modo == "aproximado"):
+                yield [documento["user_id"], documento["probabilidades"]]
+            return
+        with self.predicciones(dir_timeline, tope, dias, id_evaluacion) as resultado:
+            for fila in self.registrar_filas(resultado.select(self.columnas_resultado()).toLocalIterator()):
+                yield fila
+
+    def evaluar_sin_recolectar(self, dir_timeline, modo=None, tope=None, dias=None, id_evaluacion=None):
+        """
+            Evalua y guarda las predicciones sin traerlas al driver, para leerlas luego con ``resultados``
+            Returns
+            -------
+            usuarios : int
+                Cantidad de usuarios evaluados
             """
         import tools
-        sc = self.sc
-        juez_timeline = self.juez_timelines
-        juez_spam = self.modelo_spam
-        mongo_uri = self.mongodb_host + ":" + self.mongodb_port + "/" + self.mongodb_db + "." + self.mongodb_collection
-        spark_session = self.spark_session
-        resultado = tools.evaluar(sc, spark_session, juez_spam, juez_timeline, dir_timeline, mongo_uri)
-        return resultado.select("user_id", "probabilidades").collect()
+        modo = modo or self.modo_ejecucion
+        tope, dias = self.limites(tope, dias, modo == "aproximado")
+        if modo in MODOS_LOCALES:
+            return sum(1 for _ in self.documentos_locales(dir_timeline, tope, dias, id_evaluacion,
+                                                          modo == "aproximado"))
+        with self.predicciones(dir_timeline, tope, dias, id_evaluacion) as resultado:
+            if self.matriz is None:
+                return tools.contar_predicciones(resultado)
+            # Con la matriz activa los vectores se leen igual, y el conteo sale de la misma lectura
+            filas = resultado.select(self.columnas_resultado()).toLocalIterator()
+            return sum(1 for _ in self.registrar_filas(filas))
+
+    def evaluar_a_archivo(self, dir_timeline, formato, ruta, modo=None, tope=None, dias=None, id_evaluacion=None):
+        """
+            Evalua los timelines y escribe las predicciones en archivos en lugar de mongo, para evaluaciones masivas
+            Parameters
+            ----------
+            formato : str
+                "parquet" (particionado por Predicted_categoria) o "jsonl" (comprimido con gzip).
+                El ejecutor local solo escribe "jsonl"
+            ruta : str
+                Directorio de salida, no debe existir
+            Returns
+            -------
+            resumen : dict
+                Formato, ruta, usuarios por categoria predicha, total y segundos de la evaluacion
+            Examples
+            --------
+            > evaluar('{"directorio":"/carpeta/con/timelines/*", "salida": "parquet", "ruta": "/datos/2017-01-01"}')
+            """
+        import tools
+        error = self.validar_salida(formato, modo)
+        if error:
+            raise ValueError(error)
+        inicio = time.time()
+        modo = modo or self.modo_ejecucion
+        tope, dias = self.limites(tope, dias, modo == "aproximado")
+        if modo in MODOS_LOCALES:
+            import ejecutor_local
+            bosque_spam, bosque_juez = self.bosques_locales()
+            conteos = {}
+            generados = self.ejecutor().evaluar(ejecutor_local.expandir_directorio(dir_timeline), bosque_spam,
+                                                bosque_juez, tope, dias, conteos, modo == "aproximado")
+            with medir("escritura_jsonl"):
+                resumen = ejecutor_local.escribir_jsonl(generados, ruta)
+            tools.registrar_duplicados(conteos.get("duplicados", 0))
+        else:
+            with self.predicciones(dir_timeline, tope, dias, id_evaluacion, guardar=False) as predicciones:
+                resumen = tools.escribir_predicciones(predicciones, formato, ruta)
+        resumen["segundos"] = time.time() - inicio
+        resumen["tweets_duplicados"] = metricas.anotaciones_peticion().get("tweets_duplicados", 0)
+        return resumen
+
+    def validar_salida(self, formato, modo=None):
+        """Motivo por el que no se puede escribir la salida ``formato`` en el modo indicado, o None si se puede"""
+        modo = modo or self.modo_ejecucion
+        if formato not in FORMATOS_SALIDA:
+            return "Formato de salida desconocido: %s" % formato
+        if modo in MODOS_LOCALES and formato not in FORMATOS_SALIDA_LOCAL:
+            return "El ejecutor local solo escribe la salida %s" % ", ".join(FORMATOS_SALIDA_LOCAL)
+        return None
+
+    @contextmanager
+    def predicciones(self, dir_timeline, tope, dias, id_evaluacion, guardar=True):
+        """Predicciones de Spark, guardadas en mongo si ``guardar``; libera los DataFrames cacheados al salir"""
+        import tools
+        mongo_uri = None
+        if guardar:
+            mongo_uri = (self.mongodb_host + ":" + self.mongodb_port + "/" + self.mongodb_db + "." +
+                         self.mongodb_collection)
+        try:
+            spark_session = self.sesion_directorio(dir_timeline, "evaluar " + dir_timeline)
+            predicciones = tools.evaluar(self.sc, spark_session, self.modelo_spam, self.juez_timelines,
+                                         dir_timeline, mongo_uri, tope, dias, id_evaluacion)
+            yield predicciones
+        finally:
+            tools.liberar_cache()
+
+    def columnas_resultado(self):
+        """Columnas de las predicciones que se leen en el driver: el resultado, los tweets duplicados de cada usuario
+        y, si la matriz esta activa, su vector"""
+        return (["user_id", "probabilidades", "tweets_duplicados"] +
+                (self.matriz.claves if self.matriz is not None else []))
+
+    def registrar_filas(self, filas):
+        """
+        Pares [user_id, probabilidades] de filas con ``columnas_resultado``, guardando sus vectores en la matriz de
+        caracteristicas en lotes de ``LOTE_MATRIZ`` a medida que se leen, sin volver a recorrer las predicciones.
+        Al terminar registra la suma de tweets duplicados de los usuarios leidos
+        """
+        import tools
+        lote = []
+        duplicados = 0
+        for fila in filas:
+            duplicados += fila["tweets_duplicados"] or 0
+            if self.matriz is not None:
+                lote.append(fila.asDict())
+                if len(lote) >= LOTE_MATRIZ:
+                    self.actualizar_matriz(lote)
+                    lote = []
+            yield [fila["user_id"], fila["probabilidades"]]
+        if lote:
+            self.actualizar_matriz(lote)
+        tools.registrar_duplicados(duplicados)
+
+    def actualizar_matriz(self, documentos):
+        """Actualiza la matriz; el archivo de metadatos se escribe a lo sumo cada ``intervalo_guardado`` segundos"""
+        if self.matriz is None:
+            return
+        with medir("actualizar_matriz"):
+            self.matriz.actualizar(documentos)
+            self.matriz.guardar(self.intervalo_matriz)
+
+    def reevaluar(self, lote=None):
+        """
+            Aplica el juez actual a todos los usuarios de la matriz de caracteristicas y guarda sus predicciones, sin
+            volver a leer los timelines, en la coleccion ``coleccion`` de la seccion [matriz], una por usuario y sin
+            TTL, ya que la mayoria de las predicciones originales ya expiraron
+            Parameters
+            ----------
+            lote : int
+                Usuarios por lote, positivo. Por defecto el de la seccion [matriz] de config.ini
+            Returns
+            -------
+            resumen : dict
+                Usuarios reevaluados, usuarios por categoria predicha y segundos
+            Examples
+            --------
+            > reevaluar()
+            """
+        import ejecutor_local
+        if self.matriz is None:
+            raise ValueError("La matriz de caracteristicas no esta activa en la seccion [matriz] de config.ini")
+        lote = int(configParser.get("matriz", "lote") if lote is None else lote)
+        if lote <= 0:
+            raise ValueError("El lote debe ser positivo: %d" % lote)
+        _, bosque_juez = self.bosques_locales()
+        inicio = time.time()
+        categorias = {}
+        client = pymongo.MongoClient(self.mongodb_host + ":" + self.mongodb_port)
+        coleccion = client[self.mongodb_db][configParser.get("matriz", "coleccion")]
+        try:
+            for user_ids, caracteristicas in self.matriz.lotes(lote):
+                with medir("reevaluar"):
+                    probabilidades = ejecutor_local.probabilidades_lote(bosque_juez, caracteristicas,
+                                                                        self.matriz.columnas)
+                    predicciones = probabilidades.argmax(axis=1)
+                for categoria in predicciones:
+                    categorias[int(categoria)] = categorias.get(int(categoria), 0) + 1
+                ahora = datetime.datetime.utcnow()
+                operaciones = [UpdateOne(dict(user_id=int(user_id)),
+                                         {"$set": dict(Predicted_categoria=float(categoria),
+                                                       probabilidades=probabilidad.tolist(), reevaluado=ahora)},
+                                         upsert=True)
+                               for user_id, categoria, probabilidad in zip(user_ids, predicciones, probabilidades)]
+                with medir("escritura_mongo"):
+                    for i in range(0, len(operaciones), 1000):
+                        coleccion.bulk_write(operaciones[i:i + 1000], ordered=False)
+        finally:
+            client.close()
+        return dict(usuarios=len(self.matriz), categorias=categorias, segundos=time.time() - inicio)
+
+    def evaluar_local(self, dir_timeline, tope=None, dias=None, id_evaluacion=None, aproximado=False):
+        """
+            Evalua los timelines con el pool de procesos local, sin Spark. Cada archivo se procesa completo en un
+            proceso, por lo que los tweets de un usuario deben estar en un mismo archivo; los tweets repetidos en
+            otro archivo de la evaluacion se descartan.
+            Parameters
+            ----------
+            dir_timeline : str
+                Rutas locales, globs o directorios separados por comas, como en sc.textFile
+            tope : int
+                Maximo de tweets mas recientes por usuario, None para no limitar
+            dias : int
+                Ventana en dias previa al ultimo tweet de cada usuario, None para no limitar
+            id_evaluacion : str
+                Identificador con el que se guardan las predicciones
+            aproximado : bool
+                Calcula las caracteristicas con bocetos de memoria acotada por usuario, que se combinan entre
+                archivos (``ejecutor_local.BocetoUsuario``); no admite tope ni ventana
+            Returns
+            -------
+            Resultado : [[int, [float, ]], ] list
+                Mismo formato que la evaluacion con Spark
+            """
+        return [[documento["user_id"], documento["probabilidades"]]
+                for documento in self.documentos_locales(dir_timeline, tope, dias, id_evaluacion, aproximado)]
+
+    def documentos_locales(self, dir_timeline, tope=None, dias=None, id_evaluacion=None, aproximado=False):
+        """Documentos de prediccion del ejecutor local, guardados en mongo en lotes de 1000 a medida que llegan"""
+        import ejecutor_local
+        import tools
+        bosque_spam, bosque_juez = self.bosques_locales()
+        archivos = ejecutor_local.expandir_directorio(dir_timeline)
+        logger.info("Evaluando %d archivos con el ejecutor local", len(archivos))
+        client = pymongo.MongoClient(self.mongodb_host + ":" + self.mongodb_port)
+        coleccion = client[self.mongodb_db][self.mongodb_collection]
+        lote = []
+        conteos = {}
+        try:
+            with medir("ejecucion_local"):
+                for documento in self.ejecutor().evaluar(archivos, bosque_spam, bosque_juez, tope, dias, conteos,
+                                                         aproximado):
+                    if id_evaluacion:
+                        documento["id_evaluacion"] = id_evaluacion
+                    lote.append(documento)
+                    if len(lote) >= 1000:
+                        with medir("escritura_mongo"):
+                            coleccion.insert_many([documentos.preparar(d) for d in lote])
+                        self.actualizar_matriz(lote)
+                        lote = []
+                    yield documento
+            if lote:
+                with medir("escritura_mongo"):
+                    coleccion.insert_many([documentos.preparar(d) for d in lote])
+                self.actualizar_matriz(lote)
+            tools.registrar_duplicados(conteos.get("duplicados", 0))
+        finally:
+            client.close()
+
+    def resultados(self, id_evaluacion, despues=None, limite=1000):
+        """
+            Lee por paginas las predicciones guardadas de una evaluacion
+            Parameters
+            ----------
+            id_evaluacion : str
+                Identificador de la evaluacion, el X-Request-Id de la peticion a /evaluar/
+            despues : str
+                Cursor devuelto por la pagina anterior, None para la primera pagina
+            limite : int
+                Maximo de resultados por pagina
+            Returns
+            -------
+            resultado, siguiente : ([[int, [float, ]], ] list, str)
+                Pares [user_id, probabilidades] y el cursor de la pagina siguiente, None si no hay mas
+            Raises
+            ------
+            ValueError
+                Si ``despues`` no es un cursor valido
+            """
+        filtro = dict(id_evaluacion=id_evaluacion)
+        if despues:
+            if not ObjectId.is_valid(despues):
+                raise ValueError("Cursor de pagina invalido: %s" % despues)
+            filtro["_id"] = {"$gt": ObjectId(despues)}
+        client = pymongo.MongoClient(self.mongodb_host + ":" + self.mongodb_port)
+        try:
+            coleccion = client[self.mongodb_db][self.mongodb_collection]
+            pagina = list(coleccion.find(filtro, dict(user_id=1, probabilidades=1))
+                          .sort("_id", pymongo.ASCENDING).limit(limite))
+        finally:
+            client.close()
+        siguiente = str(pagina[-1]["_id"]) if len(pagina) == limite else None
+        return [[d["user_id"], d["probabilidades"]] for d in pagina], siguiente
+
+    def ejecutor(self):
+        """Pool del ejecutor local, creado en el primer uso"""
+        import ejecutor_local
+        with self.bloqueo_local:
+            if self.ejecutor_local is None:
+                self.ejecutor_local = ejecutor_local.EjecutorLocal(int(configParser.get("ejecucion", "procesos")),
+                                                                   int(configParser.get("aproximado", "muestra")),
+                                                                   int(configParser.get("aproximado", "precision")))
+            return self.ejecutor_local
+
+    def bosques_locales(self):
+        """Jueces exportados para el ejecutor local, regenerados solo cuando se carga o entrena otro juez"""
+        import ejecutor_local
+        with self.bloqueo_local:
+            if self.bosques[0] is not self.modelo_spam or self.bosques[1] is not self.juez_timelines:
+                logger.info("Exportando jueces para el ejecutor local...")
+                self.bosques = (self.modelo_spam, self.juez_timelines,
+                                (ejecutor_local.exportar_bosque(self.modelo_spam),
+                                 ejecutor_local.exportar_bosque(self.juez_timelines)))
+            return self.bosques[2]
 
     def features_importances_juez(self):
         import tools
         return tools.features_importances_juez(self.juez_timelines)
 
     # TODO codigo repetido, refactorizar con evaluar()
-    def evaluar_online(self, timeline):
+    def evaluar_online(self, timeline, tope=None, dias=None, incremental=False):
         """
             Evalua y clasifica un usuario
             Parameters
             ----------
             timeline : str
                 Timeline del usuario a clasificar
+            tope : int
+                Maximo de tweets mas recientes por usuario. Por defecto tope_tweets de [ingesta]
+            dias : int
+                Ventana en dias previa al ultimo tweet de cada usuario. Por defecto ventana_dias de [ingesta]
+            incremental : bool
+                Descarta los tweets ya recibidos en cargas incrementales anteriores del usuario, segun su filtro
+                de Bloom en la coleccion de la seccion [deduplicacion]. Las caracteristicas y la prediccion se
+                calculan solo con los tweets nuevos: no se combinan con las de cargas anteriores
             Returns
             -------
             Resultado : [int, ] list
@@ -158,9 +591,85 @@ class MotorClasificador:
         juez_timeline = self.juez_timelines
         juez_spam = self.modelo_spam
         mongo_uri = self.mongodb_host + ":" + self.mongodb_port + "/" + self.mongodb_db + "." + self.mongodb_collection
-        spark_session = self.spark_session
-        resultado = tools.evaluar_online(sc, spark_session, juez_spam, juez_timeline, timeline, mongo_uri)
-        return resultado.select("user_id", "probabilidades").collect()
+        try:
+            tope, dias = self.limites(tope, dias)
+            with self.tweets_vistos(incremental) as vistos:
+                if vistos is not None:
+                    with medir("filtro_vistos"):
+                        timeline, duplicados = vistos.filtrar_timeline(timeline)
+                    tools.registrar_duplicados(duplicados)
+                estimacion = plan.estimar_timeline(timeline)
+                if not estimacion.tweets:
+                    return []
+                spark_session = plan.sesion(self.spark_session, estimacion, "evaluar_online")
+                resultado = tools.evaluar_online(sc, spark_session, juez_spam, juez_timeline, timeline, mongo_uri,
+                                                 tope, dias)
+                filas = self.recolectar_online(resultado)
+                if vistos is not None:
+                    vistos.confirmar()
+                return filas
+        finally:
+            tools.liberar_cache()
+
+    def evaluar_online_tweets(self, tweets, bytes_entrada, tope=None, dias=None, incremental=False):
+        """
+            Evalua los tweets de un cuerpo NDJSON ya reducidos por ``ingesta.leer_ndjson``, igual que
+            ``evaluar_online``
+            Parameters
+            ----------
+            tweets : [tuple, ] list
+                Tuplas de ``ingesta.podar_tweet``
+            bytes_entrada : int
+                Tamano del cuerpo recibido, para el plan de ejecucion
+            Returns
+            -------
+            Resultado : [int, ] list
+                Mismo formato que ``evaluar_online``
+            """
+        import ingesta
+        import tools
+        mongo_uri = self.mongodb_host + ":" + self.mongodb_port + "/" + self.mongodb_db + "." + self.mongodb_collection
+        try:
+            tope, dias = self.limites(tope, dias)
+            with self.tweets_vistos(incremental) as vistos:
+                if vistos is not None:
+                    with medir("filtro_vistos"):
+                        tweets, duplicados = vistos.filtrar(tweets, ingesta.claves_tweet)
+                    tools.registrar_duplicados(duplicados)
+                if not tweets:
+                    return []
+                spark_session = plan.sesion(self.spark_session, plan.Estimacion(bytes_entrada, len(tweets)),
+                                            "evaluar_online")
+                resultado = tools.evaluar_tweets(self.sc, spark_session, self.modelo_spam, self.juez_timelines,
+                                                 tweets, mongo_uri, tope, dias)
+                filas = self.recolectar_online(resultado)
+                if vistos is not None:
+                    vistos.confirmar()
+                return filas
+        finally:
+            tools.liberar_cache()
+
+    def recolectar_online(self, resultado):
+        with medir("recoleccion"):
+            filas = resultado.select(self.columnas_resultado()).collect()
+        return list(self.registrar_filas(filas))
+
+    @contextmanager
+    def tweets_vistos(self, activo=True):
+        """Filtros de Bloom de la coleccion de la seccion [deduplicacion], con su conexion a mongo abierta, o None
+        si la carga no es incremental. Los tweets nuevos se registran con ``confirmar`` al terminar la evaluacion
+        """
+        import deduplicacion
+        if not activo:
+            yield None
+            return
+        client = pymongo.MongoClient(self.mongodb_host + ":" + self.mongodb_port)
+        try:
+            yield deduplicacion.TweetsVistos(client[self.mongodb_db][configParser.get("deduplicacion", "coleccion")],
+                                             int(configParser.get("deduplicacion", "capacidad")),
+                                             float(configParser.get("deduplicacion", "error")))
+        finally:
+            client.close()
 
     def guardar_juez(self, tipo_juez, path):
         """
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Conexion de py4j fija por hilo de Python, para que las propiedades locales de Spark sean por peticion.
+
+Spark guarda el job group y el pool del fair scheduler (``setJobGroup``, ``setLocalProperty``) en el hilo de la
+JVM que atiende la llamada, y en py4j cada conexion tiene su propio hilo en la JVM. El cliente de py4j de
+PySpark 2.0 reparte sus conexiones entre todos los hilos de Python, por lo que una peticion puede asignar su pool
+en una conexion y lanzar sus jobs por otra, con las propiedades de otra peticion. ``fijar`` hace que cada hilo
+de Python use siempre su propia conexion, y por lo tanto el mismo hilo de la JVM, como el modo de hilos fijos
+(``PYSPARK_PIN_THREAD``) de PySpark 3. Se activa con ``hilos_fijos`` en la seccion ``[spark]`` de config.ini.
+"""
+
+import logging
+import threading
+import weakref
+
+from py4j.java_gateway import GatewayClient
+
+from configuracion import opcion
+
+logger = logging.getLogger(__name__)
+
+ACTIVO = opcion("spark", "hilos_fijos", "true").lower() == "true"
+
+
+class ClienteFijo(GatewayClient):
+    """``GatewayClient`` que guarda la conexion de cada hilo en lugar de devolverla a la cola compartida. Una
+    conexion que falla no se devuelve, igual que en la cola, y el hilo abre otra en la llamada siguiente
+    """
+
+    def _get_connection(self):
+        conexion = getattr(self.fijas, "conexion", None)
+        if conexion is None:
+            conexion = self._create_connection()
+            self.abiertas.add(conexion)
+        self.fijas.conexion = None
+        return conexion
+
+    def _give_back_connection(self, connection):
+        self.fijas.conexion = connection
+
+    def close(self):
+        for conexion in list(self.abiertas):
+            try:
+                conexion.close()
+            except Exception:
+                pass
+        GatewayClient.close(self)
+
+
+def fijar(sc):
+    """
+    Fija una conexion de py4j por hilo en el gateway de ``sc``
+    Returns
+    -------
+    fijado : bool
+        False si esta desactivado o el gateway no usa el ``GatewayClient`` clasico, por ejemplo porque PySpark ya
+        corre en modo de hilos fijos
+    """
+    cliente = sc._gateway._gateway_client
+    if not ACTIVO or isinstance(cliente, ClienteFijo):
+        return isinstance(cliente, ClienteFijo)
+    if type(cliente) is not GatewayClient:
+        logger.info("El gateway de py4j (%s) ya fija los hilos o no se puede fijar", type(cliente).__name__)
+        return False
+    # Los atributos se agregan antes de cambiar la clase, para que ningun hilo vea un ClienteFijo incompleto
+    cliente.fijas = threading.local()
+    cliente.abiertas = weakref.WeakSet()
+    cliente.__class__ = ClienteFijo
+    logger.info("Conexiones de py4j fijas por hilo")
+    return True
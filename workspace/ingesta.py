@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Lectura incremental de timelines en JSON por lineas (NDJSON) recibidos en el cuerpo de una peticion.
+
+Cada linea se interpreta apenas se lee y del tweet solo se conservan, como tuplas, los campos que usan las
+caracteristicas (``CAMPOS_TWEET`` y ``CAMPOS_USUARIO``), de modo que la memoria de la peticion depende de esos
+campos y no del tamano del cuerpo, que nunca se guarda completo. ``tools.cargar_tweets`` arma con ellas un
+DataFrame con el mismo esquema que resultaria de ``read.json`` para esos campos.
+"""
+
+import json
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Campos del perfil del usuario que usa ``tools.usuarios_features``, en el orden de la tupla
+CAMPOS_USUARIO = [
+    ("id", "long"), ("screen_name", "string"), ("created_at", "string"), ("description", "string"),
+    ("verified", "boolean"), ("geo_enabled", "boolean"), ("default_profile_image", "boolean"),
+    ("profile_use_background_image", "boolean"), ("favourites_count", "long"), ("listed_count", "long"),
+    ("followers_count", "long"), ("friends_count", "long"), ("statuses_count", "long")
+]
+
+# Campos del tweet que usan ``preparar_df`` y ``normalizar_tweets``; de las entidades solo importa la cantidad,
+# por lo que se guarda una lista con el texto de cada url, hashtag o mencion
+CAMPOS_TWEET = [
+    ("id", "long"), ("text", "string"), ("created_at", "string"), ("source", "string"),
+    ("in_reply_to_status_id", "long"), ("entities", "entidades"), ("user", "usuario")
+]
+
+ENTIDADES = [("urls", "url"), ("hashtags", "text"), ("user_mentions", "screen_name")]
+
+ResumenNdjson = namedtuple("ResumenNdjson", ["bytes", "lineas", "tweets", "descartadas", "usuarios"])
+
+_CONVERSIONES = {
+    "long": lambda v: None if v is None else long(v),
+    "string": lambda v: None if v is None else unicode(v),
+    "boolean": lambda v: None if v is None else bool(v),
+}
+
+
+def _entidades(entidades):
+    entidades = entidades or {}
+    return tuple([(e or {}).get(campo) for e in entidades.get(nombre) or []] for nombre, campo in ENTIDADES)
+
+
+def _campos(objeto, campos):
+    return tuple(_CONVERSIONES[tipo](objeto.get(nombre)) for nombre, tipo in campos)
+
+
+def podar_tweet(tweet):
+    """
+    Tupla con los campos de ``CAMPOS_TWEET`` de un tweet decodificado
+    Returns
+    -------
+    tweet : tuple
+        None si el tweet no tiene id o usuario
+    """
+    usuario = tweet.get("user")
+    if tweet.get("id") is None or not isinstance(usuario, dict) or usuario.get("id") is None:
+        return None
+    return (long(tweet["id"]), _CONVERSIONES["string"](tweet.get("text")),
+            _CONVERSIONES["string"](tweet.get("created_at")), _CONVERSIONES["string"](tweet.get("source")),
+            _CONVERSIONES["long"](tweet.get("in_reply_to_status_id")), _entidades(tweet.get("entities")),
+            _campos(usuario, CAMPOS_USUARIO))
+
+
+def claves_tweet(tweet):
+    """user_id e id de una tupla de ``podar_tweet``, para ``deduplicacion.TweetsVistos.filtrar``"""
+    return tweet[6][0], tweet[0]
+
+
+def leer_ndjson(lineas):
+    """
+    Reduce un timeline NDJSON linea por linea
+    Parameters
+    ----------
+    lineas : iterable
+        Lineas en bytes, como las entrega ``request.stream``
+    Returns
+    -------
+    tweets, resumen : ([tuple, ] list, ResumenNdjson)
+        Tuplas de ``podar_tweet`` y bytes leidos, lineas, tweets, lineas descartadas (vacias, invalidas o sin id)
+        y user_ids distintos
+    """
+    tweets = []
+    usuarios = set()
+    leidos = 0
+    numero = 0
+    descartadas = 0
+    for numero, linea in enumerate(lineas, 1):
+        leidos += len(linea)
+        linea = linea.strip()
+        try:
+            tweet = podar_tweet(json.loads(linea)) if linea else None
+        except (ValueError, TypeError, AttributeError):
+            tweet = None
+        if tweet is None:
+            descartadas += 1
+            continue
+        tweets.append(tweet)
+        usuarios.add(tweet[6][0])
+    return tweets, ResumenNdjson(leidos, numero, len(tweets), descartadas, usuarios)
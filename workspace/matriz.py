@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Matriz de caracteristicas en disco para reevaluar usuarios sin volver a extraer sus timelines.
+
+Guarda el ultimo vector de ``COLUMNAS_CARACTERISTICAS`` de cada usuario evaluado como una fila float32 de un
+archivo mapeado en memoria, con los user_id en un archivo paralelo. Al cambiar el juez, ``MotorClasificador``
+recorre la matriz por lotes y actualiza las predicciones guardadas.
+"""
+
+from __future__ import division
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from calculos import COLUMNAS_CARACTERISTICAS
+
+ARCHIVO_CARACTERISTICAS = "caracteristicas.f32"
+ARCHIVO_USUARIOS = "usuarios.i64"
+ARCHIVO_META = "meta.json"
+
+CAPACIDAD_INICIAL = 1024
+
+
+class MatrizCaracteristicas(object):
+    """Filas float32 de ``COLUMNAS_CARACTERISTICAS`` indexadas por user_id
+    """
+
+    def __init__(self, directorio, columnas=COLUMNAS_CARACTERISTICAS):
+        self.directorio = directorio
+        self.columnas = list(columnas)
+        # Las columnas de horas se guardan en las predicciones como hora_N
+        self.claves = [("hora_" + c) if c.isdigit() else c for c in self.columnas]
+        self.bloqueo = threading.RLock()
+        self.guardado = time.time()
+        if not os.path.isdir(directorio):
+            os.makedirs(directorio)
+        meta = os.path.join(directorio, ARCHIVO_META)
+        if os.path.isfile(meta):
+            with open(meta) as f:
+                meta = json.load(f)
+            if meta["columnas"] != self.columnas:
+                raise ValueError("La matriz de %s tiene otras columnas, debe regenerarse" % directorio)
+            self.filas, capacidad = meta["filas"], meta["capacidad"]
+        else:
+            self.filas, capacidad = 0, CAPACIDAD_INICIAL
+        self._mapear(capacidad)
+        self.indice = dict((int(u), i) for i, u in enumerate(self.usuarios[:self.filas]))
+
+    def _ruta(self, nombre):
+        return os.path.join(self.directorio, nombre)
+
+    def _mapear(self, capacidad):
+        for nombre, tipo, ancho in ((ARCHIVO_CARACTERISTICAS, np.float32, len(self.columnas)),
+                                    (ARCHIVO_USUARIOS, np.int64, 1)):
+            tamano = capacidad * ancho * np.dtype(tipo).itemsize
+            with open(self._ruta(nombre), "ab") as f:
+                if f.tell() < tamano:
+                    f.truncate(tamano)
+        self.capacidad = capacidad
+        self.matriz = np.memmap(self._ruta(ARCHIVO_CARACTERISTICAS), np.float32, "r+",
+                                shape=(capacidad, len(self.columnas)))
+        self.usuarios = np.memmap(self._ruta(ARCHIVO_USUARIOS), np.int64, "r+", shape=(capacidad,))
+
+    def __len__(self):
+        return self.filas
+
+    def actualizar(self, documentos):
+        """
+        Reemplaza o agrega la fila de cada usuario
+        Parameters
+        ----------
+        documentos : iterable
+            Diccionarios con ``user_id`` y las columnas de la matriz con los nombres de las predicciones
+        """
+        with self.bloqueo:
+            for documento in documentos:
+                user_id = int(documento["user_id"])
+                fila = self.indice.get(user_id)
+                if fila is None:
+                    if self.filas == self.capacidad:
+                        self.matriz.flush()
+                        self.usuarios.flush()
+                        self._mapear(self.capacidad * 2)
+                    fila = self.indice[user_id] = self.filas
+                    self.usuarios[fila] = user_id
+                    self.filas += 1
+                self.matriz[fila] = [documento[c] or 0 for c in self.claves]
+
+    def guardar(self, intervalo=None):
+        """
+        Escribe las filas y los metadatos en disco. Con ``intervalo`` no hace nada si ya se guardo en los ultimos
+        ``intervalo`` segundos; las filas agregadas despues del ultimo guardado se pierden si el proceso termina
+        sin llamar a ``guardar``
+        Returns
+        -------
+        guardado : bool
+        """
+        if intervalo and time.time() - self.guardado < intervalo:
+            return False
+        with self.bloqueo:
+            self.guardado = time.time()
+            self.matriz.flush()
+            self.usuarios.flush()
+            with open(self._ruta(ARCHIVO_META), "w") as f:
+                json.dump(dict(columnas=self.columnas, filas=self.filas, capacidad=self.capacidad), f)
+        return True
+
+    def lotes(self, tamano=100000):
+        """
+        Recorre la matriz por bloques contiguos sin copiarla a memoria
+        Returns
+        -------
+        lotes : generator
+            Pares (user_ids, caracteristicas) de a lo sumo ``tamano`` filas
+        """
+        filas = self.filas
+        for inicio in range(0, filas, tamano):
+            fin = min(inicio + tamano, filas)
+            yield self.usuarios[inicio:fin], self.matriz[inicio:fin]
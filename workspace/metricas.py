@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Contadores, indicadores e histogramas de las etapas del clasificador, exportados en formato de texto de Prometheus.
+
+Solo se miden las etapas que ejecutan trabajo: las que disparan acciones de Spark (ingesta con inferencia de
+esquema, conteo de duplicados, escritura en Mongo, recoleccion de resultados) o trabajo en el driver. Las
+transformaciones perezosas (normalizacion, caracteristicas, joins, prediccion) se ejecutan dentro de esas acciones;
+su costo por etapa de Spark esta en ``/requests/<id>/spark``.
+"""
+
+from __future__ import division
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+_local = threading.local()
+
+
+def _etiquetas(etiquetas):
+    return tuple(sorted(etiquetas.items()))
+
+
+def _formato_etiquetas(etiquetas, extra=None):
+    pares = list(etiquetas) + list(extra or [])
+    if not pares:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pares) + "}"
+
+
+def _formato_numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor))
+
+
+class Histograma(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.conteos = [0] * len(buckets)
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                self.conteos[i] += 1
+        self.suma += valor
+        self.total += 1
+
+
+class Registro(object):
+    """Almacen en memoria de las metricas del proceso
+    """
+
+    def __init__(self):
+        self.bloqueo = threading.Lock()
+        self.ayudas = {}
+        self.contadores = defaultdict(dict)
+        self.indicadores = defaultdict(dict)
+        self.histogramas = defaultdict(dict)
+
+    def incrementar(self, nombre, valor=1, ayuda="", **etiquetas):
+        clave = _etiquetas(etiquetas)
+        with self.bloqueo:
+            self.ayudas.setdefault(nombre, ayuda)
+            self.contadores[nombre][clave] = self.contadores[nombre].get(clave, 0) + valor
+
+    def fijar(self, nombre, valor, ayuda="", **etiquetas):
+        """Asigna el valor actual de un indicador (gauge)"""
+        clave = _etiquetas(etiquetas)
+        with self.bloqueo:
+            self.ayudas.setdefault(nombre, ayuda)
+            self.indicadores[nombre][clave] = valor
+
+    def observar(self, nombre, valor, ayuda="", **etiquetas):
+        clave = _etiquetas(etiquetas)
+        with self.bloqueo:
+            self.ayudas.setdefault(nombre, ayuda)
+            histograma = self.histogramas[nombre].get(clave)
+            if histograma is None:
+                histograma = self.histogramas[nombre][clave] = Histograma()
+            histograma.observar(valor)
+
+    def exportar(self):
+        """
+        Serializa todas las metricas en el formato de exposicion de texto de Prometheus
+        Returns
+        -------
+        texto : str
+            Cuerpo para el endpoint /metrics
+        """
+        lineas = []
+        with self.bloqueo:
+            for nombre in sorted(self.contadores):
+                lineas.append("# HELP %s %s" % (nombre, self.ayudas.get(nombre, "")))
+                lineas.append("# TYPE %s counter" % nombre)
+                for clave, valor in sorted(self.contadores[nombre].items()):
+                    lineas.append("%s%s %s" % (nombre, _formato_etiquetas(clave), _formato_numero(valor)))
+            for nombre in sorted(self.indicadores):
+                lineas.append("# HELP %s %s" % (nombre, self.ayudas.get(nombre, "")))
+                lineas.append("# TYPE %s gauge" % nombre)
+                for clave, valor in sorted(self.indicadores[nombre].items()):
+                    lineas.append("%s%s %s" % (nombre, _formato_etiquetas(clave), _formato_numero(valor)))
+            for nombre in sorted(self.histogramas):
+                lineas.append("# HELP %s %s" % (nombre, self.ayudas.get(nombre, "")))
+                lineas.append("# TYPE %s histogram" % nombre)
+                for clave, h in sorted(self.histogramas[nombre].items()):
+                    for limite, conteo in zip(h.buckets, h.conteos):
+                        lineas.append("%s_bucket%s %d" % (nombre, _formato_etiquetas(clave, [("le", limite)]),
+                                                          conteo))
+                    lineas.append("%s_bucket%s %d" % (nombre, _formato_etiquetas(clave, [("le", "+Inf")]),
+                                                      h.total))
+                    lineas.append("%s_sum%s %s" % (nombre, _formato_etiquetas(clave), _formato_numero(h.suma)))
+                    lineas.append("%s_count%s %d" % (nombre, _formato_etiquetas(clave), h.total))
+        return "\n".join(lineas) + "\n"
+
+
+REGISTRO = Registro()
+
+
+def iniciar_peticion():
+    """Reinicia las etapas y anotaciones registradas para la peticion del hilo actual"""
+    _local.etapas = []
+    _local.anotaciones = {}
+
+
+def anotar(nombre, valor):
+    """Registra un dato de la peticion del hilo actual, como la cantidad de tweets duplicados descartados"""
+    anotaciones = getattr(_local, "anotaciones", None)
+    if anotaciones is not None:
+        anotaciones[nombre] = anotaciones.get(nombre, 0) + valor
+
+
+def anotaciones_peticion():
+    return dict(getattr(_local, "anotaciones", {}))
+
+
+def etapas_peticion():
+    """
+    Duracion de cada etapa medida en la peticion del hilo actual
+    Returns
+    -------
+    etapas : [dict, ] list
+        Lista ordenada de diccionarios con ``etapa`` y ``segundos``
+    """
+    return list(getattr(_local, "etapas", []))
+
+
+@contextmanager
+def medir(etapa):
+    """
+    Mide la duracion de una etapa y la registra en el histograma ``twitterjudge_etapa_segundos``
+    Examples
+    --------
+    > with medir("predecir"):
+    >     predicciones = predecir(juez, features)
+    """
+    inicio = time.time()
+    try:
+        yield
+    finally:
+        duracion = time.time() - inicio
+        REGISTRO.observar("twitterjudge_etapa_segundos", duracion, "Duracion de cada etapa del clasificador",
+                          etapa=etapa)
+        etapas = getattr(_local, "etapas", None)
+        if etapas is not None:
+            etapas.append(dict(etapa=etapa, segundos=duracion))
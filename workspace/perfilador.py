@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""Perfilado con cProfile del codigo Python del driver y de las UDFs que corren en los workers.
+
+Las UDFs de DataFrame no pasan por el profiler de workers de PySpark (solo cubre funciones de RDD), por lo que
+se envuelven en ``UDFPerfilable``, que aplica la misma tecnica: un cProfile por tarea cuyo resultado viaja al
+driver dentro de un acumulador y se combina con ``pstats``.
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import threading
+
+from pyspark.accumulators import AccumulatorParam
+from pyspark.sql import functions as F
+
+from configuracion import opcion
+
+logger = logging.getLogger(__name__)
+
+ACTIVO = opcion("perfil", "activo", "false").lower() == "true"
+UDF_ACTIVO = opcion("perfil", "udf", "false").lower() == "true"
+DIRECTORIO = opcion("perfil", "directorio", "perfiles")
+MAXIMO = int(opcion("perfil", "maximo", "100"))
+
+# Sufijo de los archivos con las estadisticas de los workers de una peticion
+SUFIJO_WORKERS = ".workers"
+
+_UDFS = []
+_contexto = None
+_bloqueo = threading.Lock()
+_bloqueo_udfs = threading.Lock()
+# Peticion cuyas tareas se estan acumulando en los workers; los acumuladores son globales, por lo que solo una
+# peticion perfilada a la vez puede medir los workers
+_peticion_workers = None
+
+
+class _Instantanea(object):
+    """Referencia al cProfile de una tarea; al serializarse al final de la tarea vuelca sus estadisticas"""
+
+    def __init__(self, perfil):
+        self.perfil = perfil
+
+    def create_stats(self):
+        if hasattr(self, "perfil"):
+            self.perfil.create_stats()
+            self.stats = self.perfil.stats
+
+    def __getstate__(self):
+        self.create_stats()
+        return dict(stats=self.stats)
+
+    def __setstate__(self, estado):
+        self.stats = estado["stats"]
+
+
+def _combinar(valores):
+    """Combina instantaneas ya serializadas o ``pstats.Stats`` en un ``pstats.Stats`` nuevo sin modificarlos"""
+    copias = []
+    for valor in valores:
+        copia = _Instantanea.__new__(_Instantanea)
+        copia.stats = dict(valor.stats)
+        copias.append(copia)
+    return pstats.Stats(*copias)
+
+
+class ParametroPerfil(AccumulatorParam):
+    """Acumulador que combina estadisticas de cProfile"""
+
+    def zero(self, valor):
+        return None
+
+    def addInPlace(self, valor1, valor2):
+        if valor1 is None:
+            return valor2
+        if valor2 is None:
+            return valor1
+        return _combinar([valor1, valor2])
+
+
+class UDFPerfilable(object):
+    """Envuelve la funcion de una UDF para medirla con cProfile en cada tarea del worker
+    """
+
+    def __init__(self, funcion, nombre, acumulador):
+        self.funcion = funcion
+        self.nombre = nombre
+        self.acumulador = acumulador
+        self._perfil = None
+
+    def __getstate__(self):
+        return dict(funcion=self.funcion, nombre=self.nombre, acumulador=self.acumulador)
+
+    def __setstate__(self, estado):
+        self.__dict__.update(estado)
+        self._perfil = None
+
+    def __call__(self, *args):
+        if self._perfil is None:
+            self._perfil = cProfile.Profile()
+            self.acumulador.add(_Instantanea(self._perfil))
+        self._perfil.enable()
+        try:
+            return self.funcion(*args)
+        finally:
+            self._perfil.disable()
+
+
+class UDFDiferida(object):
+    """UDF que se crea en Spark la primera vez que se usa en una columna, de modo que importar ``tools`` no crea
+    el SparkContext antes que ``tools.iniciar_spark_context`` ni los acumuladores antes de ``registrar``
+    """
+
+    def __init__(self, funcion, tipo, nombre):
+        self.funcion = funcion
+        self.tipo = tipo
+        self.nombre = nombre
+        self._udf = None
+
+    def _crear(self):
+        if not UDF_ACTIVO:
+            return F.udf(self.funcion, self.tipo)
+        if _contexto is None:
+            raise RuntimeError("La UDF %s se uso antes de perfilador.registrar(sc)" % self.nombre)
+        envoltura = UDFPerfilable(self.funcion, self.nombre, _contexto.accumulator(None, ParametroPerfil()))
+        _UDFS.append(envoltura)
+        return F.udf(envoltura, self.tipo)
+
+    def __call__(self, *columnas):
+        if self._udf is None:
+            with _bloqueo_udfs:
+                if self._udf is None:
+                    self._udf = self._crear()
+        return self._udf(*columnas)
+
+
+def udf(funcion, tipo, nombre):
+    """
+    Crea una UDF que se perfila en los workers si ``udf = true`` en la seccion ``[perfil]`` de config.ini
+    Parameters
+    ----------
+    funcion : function
+        Funcion Python de la UDF
+    tipo : DataType
+        Tipo de retorno
+    nombre : str
+        Nombre con el que se reporta el perfil
+    """
+    return UDFDiferida(funcion, tipo, nombre)
+
+
+def registrar(sc):
+    """Indica el SparkContext en el que se crean los acumuladores de las UDFs perfiladas; se llama despues de
+    crearlo con su configuracion"""
+    global _contexto
+    _contexto = sc
+
+
+def estadisticas_workers(sc, reiniciar=False):
+    """
+    Estadisticas combinadas de las UDFs perfiladas y, si ``spark.python.profile`` esta activo,
+    de las funciones de RDD medidas por el profiler de PySpark
+    Parameters
+    ----------
+    reiniciar : bool
+        Vacia los acumuladores y los profilers despues de leerlos, para que la siguiente lectura solo incluya
+        las tareas posteriores
+    Returns
+    -------
+    estadisticas : pstats.Stats
+        None si no hay datos
+    """
+    with _bloqueo_udfs:
+        valores = [envoltura.acumulador.value for envoltura in _UDFS]
+        if reiniciar:
+            for envoltura in _UDFS:
+                envoltura.acumulador.value = None
+        if sc.profiler_collector:
+            valores.extend(profiler.stats() for _, profiler, _ in sc.profiler_collector.profilers)
+            if reiniciar:
+                sc.profiler_collector.profilers = []
+    valores = [v for v in valores if v is not None]
+    return _combinar(valores) if valores else None
+
+
+def activo_para(solicitado):
+    """Indica si se debe perfilar una peticion: por configuracion global o porque la peticion lo solicito"""
+    return ACTIVO or bool(solicitado)
+
+
+def iniciar():
+    perfil = cProfile.Profile()
+    perfil.enable()
+    return perfil
+
+
+def ruta(nombre):
+    return os.path.join(DIRECTORIO, os.path.basename(nombre) + ".pstats")
+
+
+def finalizar(perfil, nombre):
+    """Detiene el perfil del driver y lo guarda como ``<directorio>/<nombre>.pstats``"""
+    perfil.disable()
+    guardar(perfil, nombre)
+
+
+def perfila_workers(sc):
+    """Indica si hay algo que medir en los workers: UDFs perfiladas o el profiler de RDD de PySpark"""
+    return UDF_ACTIVO or bool(sc.profiler_collector)
+
+
+def iniciar_workers(sc, nombre):
+    """
+    Descarta lo acumulado en los workers antes de la peticion perfilada ``nombre``
+    Returns
+    -------
+    iniciado : bool
+        False si otra peticion perfilada esta midiendo los workers, ya que reiniciar los acumuladores
+        corromperia sus estadisticas
+    """
+    global _peticion_workers
+    with _bloqueo:
+        if _peticion_workers is not None:
+            return False
+        _peticion_workers = nombre
+    estadisticas_workers(sc, reiniciar=True)
+    return True
+
+
+def finalizar_workers(sc, nombre):
+    """Guarda lo acumulado en los workers durante la peticion perfilada ``nombre`` como
+    ``<directorio>/<nombre>.workers.pstats``, incluidas las tareas de UDFs de peticiones concurrentes sin perfil"""
+    global _peticion_workers
+    try:
+        estadisticas = estadisticas_workers(sc, reiniciar=True)
+        if estadisticas is not None:
+            guardar(estadisticas, nombre + SUFIJO_WORKERS)
+    finally:
+        with _bloqueo:
+            if _peticion_workers == nombre:
+                _peticion_workers = None
+
+
+def estadisticas_peticion_workers(nombre):
+    """Estadisticas de los workers guardadas por ``finalizar_workers``"""
+    return estadisticas_driver(nombre + SUFIJO_WORKERS)
+
+
+def guardar(estadisticas, nombre):
+    """
+    Guarda un cProfile o ``pstats.Stats`` como ``<directorio>/<nombre>.pstats``,
+    conservando solo los ``maximo`` archivos mas recientes
+    """
+    with _bloqueo:
+        if not os.path.isdir(DIRECTORIO):
+            os.makedirs(DIRECTORIO)
+        estadisticas.dump_stats(ruta(nombre))
+        archivos = sorted((os.path.join(DIRECTORIO, a) for a in os.listdir(DIRECTORIO) if a.endswith(".pstats")),
+                          key=os.path.getmtime)
+        for archivo in archivos[:-MAXIMO] if len(archivos) > MAXIMO else []:
+            os.remove(archivo)
+
+
+def estadisticas_driver(nombre=None):
+    """Estadisticas de una peticion, o de todas las guardadas si no se indica ``nombre``"""
+    if nombre:
+        return pstats.Stats(ruta(nombre)) if os.path.isfile(ruta(nombre)) else None
+    if not os.path.isdir(DIRECTORIO):
+        return None
+    archivos = [os.path.join(DIRECTORIO, a) for a in os.listdir(DIRECTORIO)
+                if a.endswith(".pstats") and a != "workers.pstats" and not a.endswith(SUFIJO_WORKERS + ".pstats")]
+    return pstats.Stats(*archivos) if archivos else None
+
+
+def funciones_principales(estadisticas, limite=30):
+    """
+    Funciones con mayor tiempo acumulado
+    Returns
+    -------
+    funciones : [dict, ] list
+        Funcion, llamadas, tiempo propio y tiempo acumulado en segundos, ordenado por tiempo acumulado
+    """
+    if estadisticas is None:
+        return []
+    filas = []
+    for (archivo, linea, funcion), (_, llamadas, propio, acumulado, _) in estadisticas.stats.items():
+        filas.append(dict(funcion="%s:%d(%s)" % (archivo, linea, funcion), llamadas=llamadas,
+                          tiempo_propio=propio, tiempo_acumulado=acumulado))
+    filas.sort(key=lambda f: f["tiempo_acumulado"], reverse=True)
+    return filas[:limite]
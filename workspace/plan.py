@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Plan de ejecucion de Spark segun el tamano estimado de la entrada de cada peticion.
+
+Las agregaciones, pivots, joins y ventanas de ``tools`` usan ``spark.sql.shuffle.partitions`` particiones, 200 por
+defecto: un timeline de ``/evaluar_online/`` pasa la mayor parte del tiempo programando tareas vacias y un glob
+grande de ``/evaluar/`` queda con particiones enormes. Cada peticion estima los bytes y tweets de su entrada y
+ejecuta en una sesion propia (``SparkSession.newSession``, que comparte el SparkContext y la cache pero no la
+configuracion SQL) con las particiones de shuffle, el umbral de broadcast de los joins y la decision de cachear
+que corresponden a ese tamano. Los parametros se leen de la seccion ``[plan]`` de config.ini.
+"""
+
+from __future__ import division
+
+import logging
+import math
+from collections import namedtuple
+
+import compresion
+import metricas
+from configuracion import opcion
+
+logger = logging.getLogger(__name__)
+
+ACTIVO = opcion("plan", "activo", "true").lower() == "true"
+BYTES_POR_TWEET = int(opcion("plan", "bytes_por_tweet", 4000))
+EXPANSION_COMPRESION = float(opcion("plan", "expansion_compresion", 8))
+BYTES_POR_PARTICION = int(opcion("plan", "bytes_por_particion", 128 * 1024 * 1024))
+PARTICIONES_MINIMO = int(opcion("plan", "particiones_minimo", 2))
+PARTICIONES_MAXIMO = int(opcion("plan", "particiones_maximo", 2000))
+CACHE_MINIMO_TWEETS = int(opcion("plan", "cache_minimo_tweets", 1000))
+
+# Umbral de broadcast por defecto de Spark. Spark lo compara con su propia estimacion del tamano de cada lado del
+# join, no con la entrada, por lo que no se escala con ella: un umbral alto llevaria al driver tablas de cientos
+# de MB en cada peticion concurrente
+BROADCAST_SPARK = 10 * 1024 * 1024
+BROADCAST = int(opcion("plan", "broadcast", BROADCAST_SPARK))
+
+# Clave de la configuracion de la sesion que consulta ``tools.cachear``
+CLAVE_CACHEAR = "twitterjudge.cachear"
+
+Estimacion = namedtuple("Estimacion", ["bytes", "tweets"])
+
+Plan = namedtuple("Plan", ["particiones", "broadcast", "cachear"])
+
+
+def estimar_archivos(archivos):
+    """
+    Tamano sin comprimir y tweets de una entrada en archivos
+    Parameters
+    ----------
+    archivos : [(str, int), ] list
+        Ruta y tamano de cada archivo, como los devuelve ``tools.listar_archivos``
+    Returns
+    -------
+    estimacion : Estimacion
+        Los archivos comprimidos se cuentan ``expansion_compresion`` veces su tamano y los tweets a razon de
+        ``bytes_por_tweet``
+    """
+    total = 0
+    for ruta, tamano in archivos:
+        comprimido = not compresion.divisible(ruta) or ruta.lower().endswith(".bz2")
+        total += tamano * EXPANSION_COMPRESION if comprimido else tamano
+    total = int(total)
+    return Estimacion(total, total // BYTES_POR_TWEET)
+
+
+def estimar_timeline(timeline):
+    """Tamano y tweets de un timeline en JSON por lineas recibido en la peticion; los tweets se cuentan"""
+    return Estimacion(len(timeline), sum(1 for linea in timeline.splitlines() if linea.strip()))
+
+
+def elegir(estimacion):
+    """
+    Plan para el tamano estimado
+    Returns
+    -------
+    plan : Plan
+        Particiones de shuffle (una cada ``bytes_por_particion`` de entrada, entre ``particiones_minimo`` y
+        ``particiones_maximo``), umbral de broadcast (``broadcast``, el de Spark por defecto, igual para todas
+        las entradas) y si cachear los DataFrames intermedios (no vale la pena con menos de
+        ``cache_minimo_tweets``)
+    """
+    particiones = int(math.ceil(estimacion.bytes / BYTES_POR_PARTICION))
+    particiones = max(PARTICIONES_MINIMO, min(PARTICIONES_MAXIMO, particiones))
+    return Plan(particiones, BROADCAST, estimacion.tweets >= CACHE_MINIMO_TWEETS)
+
+
+def sesion(spark_session, estimacion, descripcion):
+    """
+    Sesion de Spark para una peticion, con el plan que corresponde a su entrada
+    Parameters
+    ----------
+    spark_session : SparkSession
+        Sesion compartida del motor; se devuelve sin cambios si el plan esta desactivado
+    estimacion : Estimacion
+        Tamano estimado de la entrada
+    descripcion : str
+        Peticion o entrada, para el log
+    """
+    if not ACTIVO:
+        return spark_session
+    plan = elegir(estimacion)
+    logger.info("Plan para %s: %d bytes, ~%d tweets -> %d particiones de shuffle, broadcast hasta %d bytes, %s",
+                descripcion, estimacion.bytes, estimacion.tweets, plan.particiones, plan.broadcast,
+                "con cache" if plan.cachear else "sin cache")
+    metricas.anotar("particiones_shuffle", plan.particiones)
+    nueva = spark_session.newSession()
+    nueva.conf.set("spark.sql.shuffle.partitions", str(plan.particiones))
+    nueva.conf.set("spark.sql.autoBroadcastJoinThreshold", str(plan.broadcast))
+    nueva.conf.set(CLAVE_CACHEAR, str(plan.cachear).lower())
+    return nueva
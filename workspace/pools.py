@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Pools del fair scheduler de Spark para aislar las clases de peticiones.
+
+Cada clase de ``admision`` (entrenamiento, lote, online) envia sus jobs a un pool con el mismo nombre, con el
+peso y la cuota minima de la seccion ``[pools]`` de config.ini. El archivo de asignacion de Spark se genera a
+partir de esa seccion al crear el SparkContext, en ``ARCHIVO``, que se reescribe en cada inicio. El pool se asigna
+por hilo, por lo que requiere las conexiones de py4j fijas de ``hilos``.
+"""
+
+import logging
+import os
+from xml.sax.saxutils import quoteattr
+
+import hilos
+from admision import CLASES, DEFECTOS
+from configuracion import opcion
+
+logger = logging.getLogger(__name__)
+
+ACTIVO = opcion("pools", "modo", "FAIR").upper() == "FAIR"
+
+ARCHIVO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pools.xml")
+
+
+def definiciones():
+    """
+    Pools configurados
+    Returns
+    -------
+    pools : [dict, ] list
+        Nombre, peso y cuota minima de cores de cada pool
+    """
+    return [dict(nombre=nombre, peso=int(opcion("pools", "peso_" + nombre, 1)),
+                 minimo=int(opcion("pools", "minimo_" + nombre, 0)))
+            for nombre in sorted(DEFECTOS)]
+
+
+def xml_asignacion(pools):
+    """Contenido del archivo ``spark.scheduler.allocation.file`` para los pools indicados"""
+    lineas = ['<?xml version="1.0"?>', "<allocations>"]
+    for pool in pools:
+        lineas.extend(["  <pool name=%s>" % quoteattr(pool["nombre"]),
+                       "    <schedulingMode>FIFO</schedulingMode>",
+                       "    <weight>%d</weight>" % pool["peso"],
+                       "    <minShare>%d</minShare>" % pool["minimo"],
+                       "  </pool>"])
+    lineas.append("</allocations>")
+    return "\n".join(lineas) + "\n"
+
+
+def configurar(conf):
+    """Activa el fair scheduler en ``conf`` con los pools de config.ini"""
+    if not ACTIVO:
+        return conf
+    with open(ARCHIVO, "w") as f:
+        f.write(xml_asignacion(definiciones()))
+    logger.info("Fair scheduler con los pools de %s", ARCHIVO)
+    conf.set("spark.scheduler.mode", "FAIR")
+    conf.set("spark.scheduler.allocation.file", ARCHIVO)
+    return conf
+
+
+def verificar(sc):
+    """Advierte si el SparkContext se creo sin el fair scheduler, por ejemplo porque ya existia al configurarlo, o
+    si las conexiones de py4j no estan fijas por hilo y los jobs pueden caer en el pool de otra peticion"""
+    if not ACTIVO:
+        return True
+    if sc.getConf().get("spark.scheduler.mode", "FIFO").upper() != "FAIR":
+        logger.warn("El SparkContext no usa el fair scheduler; los pools de [pools] no tendran efecto")
+        return False
+    if not isinstance(sc._gateway._gateway_client, hilos.ClienteFijo):
+        logger.warn("Las conexiones de py4j no estan fijas por hilo: con peticiones concurrentes un job puede "
+                    "ejecutarse en el pool de otra clase")
+        return False
+    return True
+
+
+def pool_endpoint(endpoint):
+    """Pool de los jobs de un endpoint, None para el pool por defecto"""
+    return CLASES.get(endpoint) if ACTIVO else None
+
+
+def estado(sc):
+    """
+    Estado de los pools segun el scheduler de Spark
+    Returns
+    -------
+    pools : dict
+        Por pool: modo, peso, cuota minima, tareas y etapas en ejecucion
+    """
+    resultado = {}
+    try:
+        iterador = sc._jsc.sc().getAllPools().iterator()
+        while iterador.hasNext():
+            pool = iterador.next()
+            resultado[pool.name()] = dict(peso=pool.weight(), minimo=pool.minShare(),
+                                          tareas_en_ejecucion=pool.runningTasks(),
+                                          etapas_activas=pool.schedulableQueue().size())
+    except Exception as e:
+        logger.debug("No se pudo consultar los pools de Spark: %s", e)
+    return resultado
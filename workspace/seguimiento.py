@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Perfil de costo en Spark de cada peticion HTTP.
+
+Cada peticion se ejecuta bajo su propio job group, de modo que los jobs que dispara pueden recuperarse con el
+status tracker. Las metricas de las etapas (shuffle, spill, tiempo de ejecucion) se leen del API REST de la
+interfaz web de Spark, que es la misma fuente que usa el Spark UI.
+"""
+
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import urllib2 as urllib_request
+except ImportError:
+    import urllib.request as urllib_request
+
+logger = logging.getLogger(__name__)
+
+ESTADOS_FINALES = ("SUCCEEDED", "FAILED")
+
+METRICAS_ETAPA = ("executorRunTime", "inputBytes", "outputBytes", "shuffleReadBytes", "shuffleWriteBytes",
+                  "memoryBytesSpilled", "diskBytesSpilled")
+
+
+def url_interfaz(sc):
+    """Direccion de la interfaz web del driver, None si no esta disponible"""
+    url = getattr(sc, "uiWebUrl", None)
+    if url:
+        return url
+    try:
+        ui = sc._jsc.sc().ui()
+        return ui.get().appUIAddress() if ui.isDefined() else None
+    except Exception:
+        return None
+
+
+class HistorialSpark(object):
+    """Historial acotado de los jobs y etapas de Spark atribuibles a cada peticion
+
+    En PySpark las propiedades locales se asignan al hilo de la JVM que atiende la llamada de py4j. Con la
+    conexion fija por hilo de ``hilos.fijar`` cada peticion usa siempre el mismo hilo de la JVM y sus jobs quedan
+    en su grupo; sin ella, con peticiones concurrentes algun job puede quedar asociado al grupo de otra, y los
+    perfiles lo indican con ``aislado`` en False.
+    """
+
+    def __init__(self, sc, capacidad=200):
+        import hilos
+        self.sc = sc
+        self.aislado = isinstance(sc._gateway._gateway_client, hilos.ClienteFijo)
+        self.capacidad = capacidad
+        self.peticiones = OrderedDict()
+        self.activas = {}
+        self.bloqueo = threading.Lock()
+
+    def iniciar(self, id_peticion, descripcion, pool=None):
+        """Asocia los jobs que se lancen desde el hilo actual al grupo ``id_peticion`` y al pool ``pool``"""
+        self.sc.setJobGroup(id_peticion, descripcion)
+        self.sc.setLocalProperty("spark.scheduler.pool", pool)
+        with self.bloqueo:
+            self.activas[id_peticion] = pool
+
+    def finalizar(self, id_peticion, descripcion=None):
+        """Registra la peticion si disparo algun job y libera el grupo del hilo actual.
+        Las metricas de las etapas se consultan recien al pedir el perfil, fuera del camino de la peticion.
+        """
+        self.sc.setLocalProperty("spark.jobGroup.id", None)
+        self.sc.setLocalProperty("spark.job.description", None)
+        self.sc.setLocalProperty("spark.scheduler.pool", None)
+        with self.bloqueo:
+            self.activas.pop(id_peticion, None)
+        if not self.sc.statusTracker().getJobIdsForGroup(id_peticion):
+            return
+        with self.bloqueo:
+            self.peticiones[id_peticion] = dict(id=id_peticion, descripcion=descripcion, finalizado=False)
+            while len(self.peticiones) > self.capacidad:
+                self.peticiones.popitem(last=False)
+
+    def jobs_por_pool(self):
+        """
+        Jobs activos de las peticiones en curso agrupados por pool. Un job esta en cola si ninguna de sus etapas
+        tiene tareas en ejecucion.
+        Returns
+        -------
+        pools : dict
+            Por pool: peticiones en curso, jobs en ejecucion y jobs en cola
+        """
+        tracker = self.sc.statusTracker()
+        activos = set(tracker.getActiveJobsIds())
+        with self.bloqueo:
+            activas = list(self.activas.items())
+        resultado = {}
+        for id_peticion, pool in activas:
+            estado = resultado.setdefault(pool or "default", dict(peticiones=0, jobs_en_ejecucion=0, jobs_en_cola=0))
+            estado["peticiones"] += 1
+            for job_id in activos.intersection(tracker.getJobIdsForGroup(id_peticion)):
+                info_job = tracker.getJobInfo(job_id)
+                etapas = [tracker.getStageInfo(s) for s in info_job.stageIds] if info_job else []
+                if any(e is not None and e.numActiveTasks > 0 for e in etapas):
+                    estado["jobs_en_ejecucion"] += 1
+                else:
+                    estado["jobs_en_cola"] += 1
+        return resultado
+
+    def consultar(self, id_peticion):
+        """
+        Perfil de Spark de una peticion. Se recalcula mientras tenga jobs en ejecucion; si el status tracker ya
+        descarto sus jobs (``spark.ui.retainedJobs``) antes de que terminaran de consultarse, el perfil no tiene
+        jobs, queda con ``finalizado`` en False y no se guarda.
+        Returns
+        -------
+        perfil : dict
+            Jobs, etapas y totales de la peticion. None si no esta en el historial.
+        """
+        with self.bloqueo:
+            perfil = self.peticiones.get(id_peticion)
+        if perfil and not perfil["finalizado"]:
+            perfil = self.perfil(id_peticion, perfil["descripcion"])
+            if perfil["jobs"]:
+                with self.bloqueo:
+                    if id_peticion in self.peticiones:
+                        self.peticiones[id_peticion] = perfil
+        return perfil
+
+    def perfil(self, id_peticion, descripcion=None):
+        tracker = self.sc.statusTracker()
+        detalle = DetalleEtapas(self.sc)
+        jobs = []
+        totales = dict((m, 0) for m in METRICAS_ETAPA)
+        totales["numTasks"] = 0
+        for job_id in sorted(tracker.getJobIdsForGroup(id_peticion)):
+            info_job = tracker.getJobInfo(job_id)
+            if info_job is None:
+                continue
+            etapas = []
+            for stage_id in info_job.stageIds:
+                info = tracker.getStageInfo(stage_id)
+                etapa = dict(stage_id=stage_id)
+                if info is not None:
+                    etapa.update(nombre=info.name, numTasks=info.numTasks, tareas_activas=info.numActiveTasks,
+                                 tareas_completadas=info.numCompletedTasks, tareas_fallidas=info.numFailedTasks)
+                    totales["numTasks"] += info.numTasks
+                metricas = detalle.etapa(stage_id)
+                etapa.update(metricas)
+                for m in METRICAS_ETAPA:
+                    totales[m] += metricas.get(m, 0)
+                etapas.append(etapa)
+            jobs.append(dict(job_id=job_id, estado=info_job.status, etapas=etapas))
+        return dict(id=id_peticion, descripcion=descripcion, jobs=jobs, totales=totales, aislado=self.aislado,
+                    finalizado=bool(jobs) and all(j["estado"] in ESTADOS_FINALES for j in jobs))
+
+
+class DetalleEtapas(object):
+    """Consulta las metricas de tareas agregadas por etapa en el API REST ``/api/v1`` del driver
+    """
+
+    def __init__(self, sc):
+        url = url_interfaz(sc)
+        self.base = "%s/api/v1/applications/%s/stages/" % (url, sc.applicationId) if url else None
+
+    def etapa(self, stage_id):
+        if not self.base:
+            return {}
+        try:
+            intentos = json.loads(urllib_request.urlopen(self.base + str(stage_id), timeout=5).read())
+        except Exception as e:
+            logger.debug("No se pudo consultar la etapa %s: %s", stage_id, e)
+            return {}
+        resultado = dict((m, sum(intento.get(m, 0) for intento in intentos)) for m in METRICAS_ETAPA)
+        resultado["intentos"] = len(intentos)
+        if intentos:
+            resultado.update(self.sesgo(stage_id, intentos[0].get("attemptId", 0)))
+        return resultado
+
+    def sesgo(self, stage_id, intento):
+        """Mediana y maximo del tiempo de ejecucion de las tareas, para detectar particiones desbalanceadas"""
+        url = "%s%s/%s/taskSummary?quantiles=0.5,1.0" % (self.base, stage_id, intento)
+        try:
+            resumen = json.loads(urllib_request.urlopen(url, timeout=5).read())
+            mediana, maximo = resumen["executorRunTime"]
+        except Exception as e:
+            logger.debug("No se pudo consultar el resumen de tareas de la etapa %s: %s", stage_id, e)
+            return {}
+        return dict(tarea_mediana_ms=mediana, tarea_maxima_ms=maximo)
@@ -11,7 +11,16 @@ configParser = ConfigParser.RawConfigParser()
 configParser.read("config.ini")
 
 
-def run_server(app):
+def montar_servidor(app, opciones=None):
+    """Monta la aplicacion en CherryPy sin iniciar el servidor.
+
+    Parameters
+    ----------
+    app : Flask
+        Aplicacion creada por ``create_app``
+    opciones : dict
+        Configuracion de CherryPy que sobreescribe la leida de ``config.ini``
+    """
     # Enable WSGI access logging via Paste
     app_logged = TransLogger(app)
 
@@ -19,12 +28,20 @@ def run_server(app):
     cherrypy.tree.graft(app_logged, '/')
 
     # Set the configuration of the web server
-    cherrypy.config.update({
-        'engine.autoreload.on': True,
+    configuracion = {
+        'engine.autoreload.on': configParser.getboolean("server", "autoreload"),
         'log.screen': True,
         'server.socket_port': int(configParser.get("server", "port")),
-        'server.socket_host': configParser.get("server", "host")
-    })
+        'server.socket_host': configParser.get("server", "host"),
+        'server.thread_pool': int(configParser.get("server", "hilos")),
+        'server.socket_queue_size': int(configParser.get("server", "cola_conexiones"))
+    }
+    configuracion.update(opciones or {})
+    cherrypy.config.update(configuracion)
+
+
+def run_server(app):
+    montar_servidor(app)
 
     # Start the CherryPy WSGI web server
     cherrypy.engine.start()
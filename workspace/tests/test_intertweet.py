@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""La serie intertweet de ``tools.series_intertweet`` (sort_array sobre collect_list) contra la que armaba
+``preparar_df`` con una ventana ``lag`` ordenada por created_at_ts y collect_list de los intervalos. Las pruebas
+con Spark se omiten si pyspark no esta disponible."""
+
+from __future__ import division
+
+import random
+
+import pytest
+
+import ejecutor_local
+from calculos import correc_cond_en, intertweet
+
+
+def serie_ventana(tiempos):
+    """Intervalos con lag sobre la ventana ordenada; collect_list descarta el nulo del primer tweet"""
+    ordenados = sorted(tiempos)
+    intervalos = [None] + [ordenados[i] - ordenados[i - 1] for i in range(1, len(ordenados))]
+    return [intervalo for intervalo in intervalos if intervalo is not None]
+
+
+def serie_ordenada(tiempos):
+    return intertweet(sorted(tiempos))
+
+
+def entropia(serie):
+    """Mismo recorte que la UDF ``tools.entropia``"""
+    return float(correc_cond_en(serie[1:110], len(serie[1:110]), len(serie[1:110])))
+
+
+def timeline(n, semilla):
+    aleatorio = random.Random(semilla)
+    tiempos = [1443000000]
+    for _ in range(n - 1):
+        # Rafagas con intervalos repetidos y pausas largas, como en los bots
+        tiempos.append(tiempos[-1] + aleatorio.choice([0, 5, 5, 60, 60, 300, aleatorio.randint(1, 86400)]))
+    aleatorio.shuffle(tiempos)
+    return tiempos
+
+
+@pytest.fixture(scope="module")
+def spark():
+    pytest.importorskip("pyspark")
+    from pyspark.sql import SparkSession
+    sesion = SparkSession.builder.master("local[4]").appName("PruebasIntertweet").getOrCreate()
+    yield sesion
+    sesion.stop()
+
+
+def series_spark(spark, timelines):
+    """``tools.series_intertweet`` sobre tweets desordenados y repartidos en varias particiones"""
+    tools = pytest.importorskip("tools")
+    filas = [(user_id, tiempo) for user_id, tiempos in timelines.items() for tiempo in tiempos]
+    random.Random(7).shuffle(filas)
+    tweets = spark.createDataFrame(filas, ["user_id", "epoch"]).repartition(8)
+    return dict((fila.user_id, fila.lista_intertweet) for fila in tools.series_intertweet(tweets).collect())
+
+
+def test_series_intertweet_ordena_los_tiempos(spark):
+    timelines = dict((user_id, timeline(n, user_id)) for user_id, n in ((1, 5), (2, 40), (3, 111), (4, 500)))
+    series = series_spark(spark, timelines)
+    assert sorted(series) == sorted(timelines)
+    for user_id, tiempos in timelines.items():
+        assert series[user_id] == serie_ventana(tiempos)
+        assert entropia(series[user_id]) == entropia(serie_ventana(tiempos))
+
+
+def test_series_intertweet_descarta_usuarios_con_pocos_intervalos(spark):
+    series = series_spark(spark, {1: timeline(4, 5), 2: timeline(5, 5)})
+    assert list(series) == [2]
+
+
+def test_usuarios_con_pocos_intervalos_se_descartan():
+    # preparar_df filtraba size(lista_intertweet) > 3 y el ejecutor local devuelve None en ese caso
+    usuario = ejecutor_local.Usuario(dict(id=1, created_at="Mon Oct 19 00:45:35 +0000 2015"))
+    usuario.tiempos = timeline(4, 5)
+    assert len(serie_ordenada(usuario.tiempos)) == 3
+    assert usuario.caracteristicas() is None
+
+
+def test_ejecutor_local_no_depende_del_orden_de_llegada():
+    tiempos = timeline(200, 6)
+    entropias = set()
+    for semilla in range(3):
+        usuario = ejecutor_local.Usuario(dict(id=1, created_at="Mon Oct 19 00:45:35 +0000 2015"))
+        usuario.tiempos = list(tiempos)
+        random.Random(semilla).shuffle(usuario.tiempos)
+        usuario.n = len(tiempos)
+        entropias.add(usuario.caracteristicas()["entropia"])
+    assert entropias == set([entropia(serie_ventana(tiempos))])
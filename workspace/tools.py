@@ -3,14 +3,11 @@
 from __future__ import division
 
 import logging
-import math
 import os
-import sys
 import tempfile
+import threading
 
-import numpy as np
 import pymongo_spark
-from dateutil import parser
 from pyspark import SparkContext
 from pyspark.conf import SparkConf
 from pyspark.mllib.feature import HashingTF
@@ -26,6 +23,18 @@ from pyspark.ml import Pipeline, PipelineModel
 from pyspark.ml.tuning import CrossValidator, ParamGridBuilder
 from pyspark.ml.evaluation import MulticlassClassificationEvaluator
 
+import compresion
+import documentos
+import hilos
+import ingesta
+import perfilador
+import plan
+import pools
+from calculos import (COLUMNAS_CARACTERISTICAS, FUENTES_MOVILES, NUM_CARACTERISTICAS_SPAM, VERSION_CARACTERISTICAS,
+                      correc_cond_en, intertweet, month_map)
+import metricas
+from metricas import medir
+
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 pymongo_spark.activate()
 
@@ -37,10 +46,20 @@ def iniciar_spark_context(app_name=None, py_files=None, level="ERROR"):
     if not app_name:
         app_name = "ExtraerCaracteristicas"
     if not py_files:
-        py_files = ['workspace/engine.py', 'workspace/app.py', 'workspace/tools.py']
+        py_files = ['workspace/engine.py', 'workspace/app.py', 'workspace/tools.py', 'workspace/metricas.py',
+                    'workspace/seguimiento.py', 'workspace/perfilador.py', 'workspace/calculos.py',
+                    'workspace/compresion.py', 'workspace/pools.py', 'workspace/admision.py',
+                    'workspace/documentos.py', 'workspace/plan.py', 'workspace/ingesta.py',
+                    'workspace/configuracion.py', 'workspace/hilos.py']
     conf = SparkConf()
     conf.setAppName(app_name)
+    if perfilador.UDF_ACTIVO:
+        conf.set("spark.python.profile", "true")
+    pools.configurar(conf)
     sc = SparkContext.getOrCreate(conf=conf)
+    hilos.fijar(sc)
+    perfilador.registrar(sc)
+    pools.verificar(sc)
     #sc.setLogLevel(level)
     for file in py_files:
         sc.addPyFile(file)
@@ -51,194 +70,111 @@ def spark_session():
     return SparkSession.builder.getOrCreate()
 
 
-def quantize(signal, partitions, codebook):
-    indices = []
-    quanta = []
-    for datum in signal:
-        index = 0
-        while index < len(partitions) and datum > partitions[index]:
-            index += 1
-        indices.append(index)
-        quanta.append(codebook[index])
-    return indices, quanta
-
-
-def pattern_mat(x, m):
+def listar_archivos(sc, directorio):
     """
-    Construct a matrix of `m`-length segments of `x`.
-    Parameters
-    ----------
-    x : (N, ) array_like
-        Array of input data.
-    m : int
-        Length of segment. Must be at least 1. In the case that `m` is 1, the
-        input array is returned.
+    Archivos que leeria ``sc.textFile(directorio)``, expandiendo globs y directorios con el FileSystem de Hadoop
     Returns
     -------
-    patterns : (m, N-m+1)
-        Matrix whose first column is the first `m` elements of `x`, the second
-        column is `x[1:m+1]`, etc.
-    Examples
-    --------
-    > p = pattern_mat([1, 2, 3, 4, 5, 6, 7], 3])
-    array([[ 1.,  2.,  3.,	4.,	 5.],
-           [ 2.,  3.,  4.,	5.,	 6.],
-           [ 3.,  4.,  5.,	6.,	 7.]])
+    archivos : [(str, int), ] list
+        Ruta y tamano en bytes de cada archivo
     """
-    x = np.asarray(x).ravel()
-    if m == 1:
-        return x
-    else:
-        n = len(x)
-        patterns = np.zeros((m, n - m + 1))
-        for i in range(m):
-            patterns[i, :] = x[i:n - m + i + 1]
-        return patterns
-
-
-def en_shannon(series, l, num_int):
-    if not series:
-        raise ValueError("No hay serie definida")
-    if not l:
-        raise ValueError("No hay dimension (L) definida")
-    if not num_int:
-        raise ValueError("num_int sin definir")
-    # Normalizacion
-    series = (series - np.mean(series)) / np.std(series)
-    # We the values of the parameters required for the quantification:
-    epsilon = (max(series) - min(series)) / num_int
-    partition = np.arange(min(series), math.ceil(max(series)), epsilon)
-    codebook = np.arange(-1, num_int + 1)
-    # Uniform quantification of the time series:
-    _, quants = quantize(series, partition, codebook)
-    # The minimum value of the signal quantified assert passes -1 to 0:
-    quants = [0 if x == -1 else x for x in quants]
-    n = len(quants)
-    # We compose the patterns of length 'L':
-    X = pattern_mat(quants, l)
-    # We get the number of repetitions of each pattern:
-    num = np.ones(n - l + 1)
-    # This loop goes over the columns of 'X':
-    if l == 1:
-        X = np.atleast_2d(X)
-    for j in range(0, n - l + 1):
-        for i2 in range(j + 1, n - l + 1):
-            tmp = [0 if x == -1 else 1 for x in X[:, j]]
-            if (tmp[0] == 1) and (X[:, j] == X[:, i2]).all():
-                num[j] += 1
-                X[:, i2] = -1
-            tmp = -1
-
-    # We get those patterns which are not NaN:
-    aux = [0 if x == -1 else 1 for x in X[0, :]]
-    # Now, we can compute the number of different patterns:
-    new_num = []
-    for j, a in enumerate(aux):
-        if a != 0:
-            new_num.append(num[j])
-    new_num = np.asarray(new_num)
-
-    # We get the number of patterns which have appeared only once:
-    unique = sum(new_num[new_num == 1])
-    # We compute the probability of each pattern:
-    p_i = new_num / (n - l + 1)
-    # Finally, the Shannon Entropy is computed as:
-    SE = np.dot((- 1) * p_i, np.log(p_i))
-
-    return SE, unique
-
-
-def cond_en(series, l, num_int):
-    if not series:
-        raise ValueError("No hay serie definida")
-    if not l:
-        raise ValueError("No hay dimension (L) definida")
-    if not num_int:
-        raise ValueError("num_int sin definir")
-    # Processing:
-    # First, we call the Shannon Entropy function:
-    # 'L' as embedding dimension:
-    se, unique = en_shannon(series, l, num_int)
-    # 'L-1' as embedding dimension:
-    se_1, _ = en_shannon(series, l - 1, num_int)
-    # The Conditional Entropy is defined as a differential entropy:
-    ce = se - se_1
-    return ce, unique
-
-
-def correc_cond_en(series, lmax, num_int):
-    if not series:
-        raise ValueError("No hay serie definida")
-    if not lmax:
-        raise ValueError("No hay dimension (L) definida")
-    if not num_int:
-        raise ValueError("num_int sin definir")
-    N = len(series)
-    # We will use this for the correction term: (L=1)
-    e_est_1, _ = en_shannon(series, 1, num_int)
-    # Incializacin de la primera posicin del vector que almacena la CCE a un
-    # numero elevado para evitar que se salga del bucle en L=2 (primera
-    # iteracin):
-    # CCE is a vector that will contian the several CCE values computed:
-    CCE = sys.maxsize * np.ones(lmax + 1)
-    CCE[0] = 100
-    CE = np.ones(lmax + 1)
-    uniques = np.ones(lmax + 1)
-    correc_term = np.ones(lmax + 1)
-    for L in range(2, lmax + 1):
-        # First, we compute the CE for the current embedding dimension: ('L')
-        CE[L], uniques[L] = cond_en(series, L, num_int)
-        # Second, we compute the percentage of patterns which are not repeated:
-        perc_l = uniques[L] / (N - L + 1)
-        correc_term[L] = perc_l * e_est_1
-        # Third, the CCE is the CE plus the correction term:
-        CCE[L] = CE[L] + correc_term[L]
-
-    # Finally, the best estimation of the CCE is the minimum value of all the
-    # CCE that have been computed:
-    cce_min = min(CCE)
-    return cce_min
-
-
-def fuente(source):
-    mobil = ["http://twitter.com/download/android", "Twitter for Android", "http://blackberry.com/twitter",
-             "Twitter for BlackBerry", "https://mobile.twitter.com", "Mobile Web", "http://twitter.com/download/iphone",
-             "iOS", "http://twitter.com/#!/download/ipad", "Huawei Social Phone", "Windows Phone",
-             "Twitter for Nokia S40"]
-
-    if "Twitter Web Client" in source:
-        return 'uso_web'
-    elif any(string in source for string in mobil):
-        return 'uso_mobil'
+    jvm = sc._jvm
+    configuracion = sc._jsc.hadoopConfiguration()
+    archivos = []
+    for patron in directorio.split(","):
+        ruta = jvm.org.apache.hadoop.fs.Path(patron)
+        fs = ruta.getFileSystem(configuracion)
+        for estado in fs.globStatus(ruta) or []:
+            estados = fs.listStatus(estado.getPath()) if estado.isDirectory() else [estado]
+            for archivo in estados:
+                nombre = archivo.getPath().getName()
+                if archivo.isFile() and not nombre.startswith((".", "_")):
+                    archivos.append((archivo.getPath().toString(), archivo.getLen()))
+    return archivos
+
+
+def leer_lineas(sc, directorio):
+    """
+    RDD con las lineas de los archivos de ``directorio``, en texto plano o comprimidos con gzip, bzip2 o zstd.
+    Si la mayor parte de la entrada esta en codecs no divisibles se reparte entre todos los executors.
+    """
+    archivos = listar_archivos(sc, directorio)
+    zstd = [ruta for ruta, _ in archivos if compresion.es_zstd(ruta)]
+    if not zstd:
+        lineas = sc.textFile(directorio)
     else:
-        return 'uso_terceros'
-
-
-month_map = {
-    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6, 'Jul': 7,
-    'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
-}
+        lineas = sc.binaryFiles(",".join(zstd)).flatMap(lambda archivo: compresion.lineas_zstd(archivo[1]))
+        otros = [ruta for ruta, _ in archivos if not compresion.es_zstd(ruta)]
+        if otros:
+            lineas = sc.textFile(",".join(otros)).union(lineas)
+    grandes = [ruta for ruta, tamano in archivos
+               if not compresion.divisible(ruta) and tamano > compresion.TAMANO_BLOQUE]
+    if grandes:
+        logger.warn("%d archivos de mas de %d MB con un codec no divisible se leeran en una sola tarea cada uno; "
+                    "bzip2 permite dividirlos", len(grandes), compresion.TAMANO_BLOQUE // (1024 * 1024))
+    no_divisible = sum(tamano for ruta, tamano in archivos if not compresion.divisible(ruta))
+    if no_divisible > sum(tamano for _, tamano in archivos) // 2 and \
+            lineas.getNumPartitions() < sc.defaultParallelism:
+        lineas = lineas.repartition(sc.defaultParallelism)
+    return lineas
+
+
+_cacheados = threading.local()
+
+
+def cachear(df):
+    """Cachea un DataFrame intermedio de la peticion actual para liberarlo con ``liberar_cache``, salvo que el plan
+    de su sesion lo descarte por ser una entrada pequena"""
+    if df.sql_ctx.sparkSession.conf.get(plan.CLAVE_CACHEAR, "true") == "false":
+        return df
+    if not hasattr(_cacheados, "dfs"):
+        _cacheados.dfs = []
+    _cacheados.dfs.append(df)
+    return df.cache()
+
+
+def liberar_cache():
+    """Libera los DataFrames cacheados con ``cachear`` desde el hilo actual"""
+    for df in getattr(_cacheados, "dfs", []):
+        df.unpersist()
+    _cacheados.dfs = []
+
+
+def fecha_twitter(columna):
+    """
+    Convierte una fecha de Twitter ("Mon Oct 19 00:45:35 +0000 2015") a timestamp con funciones nativas de Spark,
+    con el mismo resultado que ``calculos.parse_time`` pero sin pasar por Python
+    """
+    columna = F.col(columna)
+    meses = F.create_map(*[F.lit(valor) for mes, numero in sorted(month_map.items(), key=lambda m: m[1])
+                           for valor in (mes, "%02d" % numero)])
+    return F.concat(F.substring(columna, -4, 4), F.lit("-"), meses[F.substring(columna, 5, 3)], F.lit("-"),
+                    F.substring(columna, 9, 2), F.lit(" "), F.substring(columna, 12, 8)).cast("timestamp")
 
 
-def parse_time(s):
-    return "{0:04d}-{1:02d}-{2:02d} {3:02d}:{4:02d}:{5:02d}".format(
-        int(s[-4:]),
-        month_map[s[4:7]],
-        int(s[8:10]),
-        int(s[11:13]),
-        int(s[14:16]),
-        int(s[17:19])
-    )
+def bandera(condicion):
+    """1 si la condicion o columna booleana es verdadera, 0 si es falsa o nula, con funciones nativas de Spark"""
+    if isinstance(condicion, basestring):
+        condicion = F.col(condicion)
+    return F.coalesce(condicion.cast("int"), F.lit(0))
 
 
-u_parse_time = F.udf(parse_time)
+def fuente_nativa(columna):
+    """Clasificacion de ``fuente`` con funciones nativas de Spark"""
+    columna = F.col(columna)
+    movil = None
+    for cadena in FUENTES_MOVILES:
+        movil = columna.contains(cadena) if movil is None else movil | columna.contains(cadena)
+    return (F.when(columna.contains("Twitter Web Client"), "uso_web")
+            .when(movil, "uso_mobil")
+            .otherwise("uso_terceros"))
 
 
 def avg_spam(juez, tweets):
     tokenizer = Tokenizer(inputCol="text", outputCol="words")
     wordsData = tokenizer.transform(tweets)
 
-    hashingTF = HashingTF(inputCol="words", outputCol="rawFeatures", numFeatures=140)
+    hashingTF = HashingTF(inputCol="words", outputCol="rawFeatures", numFeatures=NUM_CARACTERISTICAS_SPAM)
     featurizedData = hashingTF.transform(wordsData)
 
     """idf = IDF(inputCol="rawFeatures", outputCol="features")
@@ -251,51 +187,126 @@ def avg_spam(juez, tweets):
     return predictionsAndLabelsDF
 
 
-def preparar_df(df):
+def preparar_df(df, tope=None, dias=None):
     df.repartition(df.user.id)
 
-    df = df.where(F.length(df.text) > 0)
-    df = df.select("*", u_parse_time(df['created_at']).cast('timestamp').alias('created_at_ts'))
+    df = deduplicar_tweets(df.where(F.length(df.text) > 0))
+    df = df.select("*", fecha_twitter('created_at').alias('created_at_ts'))
+
+    return limitar_tweets(df, tope, dias)
 
-    df_intertweet = df.select(df.user.id.alias("user_id"), (
-        df.created_at_ts.cast('bigint') - F.lag(df.created_at_ts.cast('bigint'), ).over(
-            Window.partitionBy("user.id").orderBy("created_at_ts"))).cast("bigint").alias("time_intertweet"))
 
-    df_list_intertweet = df_intertweet.groupby(df_intertweet.user_id).agg(
-        F.collect_list("time_intertweet").alias("lista_intertweet"))
+def deduplicar_tweets(df):
+    """
+    Conserva una copia de cada tweet id. Antes de agrupar por id (un shuffle sobre el id del tweet) se descartan
+    las columnas que no estan en ``ingesta.CAMPOS_TWEET``, para no mover el resto del JSON crudo.
+    La columna ``copias_tweet`` indica cuantas veces aparecia el tweet en la entrada; ``tweets_features`` la suma
+    por usuario, de modo que el conteo de duplicados sale de la misma agregacion, sin otro job.
+    """
+    columnas = [F.first(c).alias(c) for c, _ in ingesta.CAMPOS_TWEET if c != "id"]
+    return df.groupBy("id").agg(F.count(F.lit(1)).alias("copias_tweet"), *columnas)
 
-    df_list_intertweet = df_list_intertweet.filter(F.size(df_list_intertweet.lista_intertweet) > 3)
 
-    df = df.join(df_list_intertweet, df["user.id"] == df_list_intertweet["user_id"])
+def tweets_duplicados(features):
+    """
+    Cantidad de copias descartadas por ``deduplicar_tweets``. Se registra en el contador
+    ``twitterjudge_tweets_duplicados_total`` y en las anotaciones de la peticion.
+    Parameters
+    ----------
+    features : DataFrame
+        Caracteristicas por usuario de ``tweets_features``, con la columna tweets_duplicados, idealmente ya
+        cacheadas
+    """
+    with medir("conteo_duplicados"):
+        duplicados = features.agg(F.sum("tweets_duplicados")).first()[0] or 0
+    return registrar_duplicados(duplicados)
 
+
+def registrar_duplicados(duplicados):
+    logger.info("%d tweets duplicados descartados", duplicados)
+    metricas.REGISTRO.incrementar("twitterjudge_tweets_duplicados_total", duplicados,
+                                  "Copias de tweets descartadas por id en la ingesta")
+    metricas.anotar("tweets_duplicados", duplicados)
+    return duplicados
+
+
+def limitar_tweets(df, tope=None, dias=None):
+    """
+    Conserva por usuario solo sus ``tope`` tweets mas recientes y/o los publicados en los ``dias`` previos a su
+    ultimo tweet. Se aplica en ``preparar_df``, antes de cualquier calculo de caracteristicas.
+    Parameters
+    ----------
+    df : DataFrame
+        Tweets con la columna created_at_ts
+    tope : int
+        Maximo de tweets por usuario, None o 0 para no limitar
+    dias : int
+        Ventana en dias contada hacia atras desde el ultimo tweet del usuario, None o 0 para no limitar
+    """
+    if not tope and not dias:
+        return df
+    ventana = Window.partitionBy(df.user.id)
+    if tope:
+        df = df.withColumn("_orden", F.row_number().over(ventana.orderBy(df.created_at_ts.desc())))
+        df = df.where(df._orden <= tope).drop("_orden")
+    if dias:
+        df = df.withColumn("_ultimo", F.max(df.created_at_ts.cast("bigint")).over(ventana))
+        df = df.where(df.created_at_ts.cast("bigint") >= df._ultimo - int(dias) * 86400).drop("_ultimo")
     return df
 
 
-lengthOfArray = F.udf(lambda arr: len(arr), IntegerType())
+def registrar_tope(predicciones, tope=None, dias=None):
+    """Agrega a las predicciones el tope de tweets y la ventana con los que se calcularon"""
+    return (predicciones
+            .withColumn("tope_tweets", F.lit(tope or None).cast("int"))
+            .withColumn("ventana_dias", F.lit(dias or None).cast("int")))
+
+
+def series_intertweet(tweets):
+    """
+    Serie de segundos entre tweets consecutivos de cada usuario, en orden cronologico garantizado.
+    Se arma con una sola agregacion ordenada por usuario y queda en su propia tabla, que solo consume
+    ``usuarios_features``. Los usuarios con 3 intervalos o menos se descartan.
+    Parameters
+    ----------
+    tweets : DataFrame
+        Tabla de ``normalizar_tweets``
+    Returns
+    -------
+    series : DataFrame
+        user_id, lista_intertweet
+    """
+    series = (tweets.groupBy("user_id")
+              .agg(F.sort_array(F.collect_list("epoch")).alias("tiempos"))
+              .select("user_id", intertweetUDF("tiempos").alias("lista_intertweet")))
+    return series.filter(F.size(series.lista_intertweet) > 3)
 
-nullToInt = F.udf(lambda e: 1 if e else 0, IntegerType())  # BooleanToInt, StringISEmpty
 
-stringToDate = F.udf(lambda date: parser.parse(date), TimestampType())
+def usuarios_unicos(df):
+    """Un registro por usuario con el perfil de uno de sus tweets"""
+    return df.select(df.user.id.alias("user_id"), df.user).dropDuplicates(["user_id"])
 
-reputacion = F.udf(lambda followers, friends:
-                   float(followers) / (followers + friends) if (followers + friends > 0)  else 0, DoubleType())
 
-followersRatio = F.udf(lambda followers, friends:
-                       float(followers) / friends if (friends > 0)  else 0, DoubleType())
+reputacion = perfilador.udf(lambda followers, friends:
+                            float(followers) / (followers + friends) if (followers + friends > 0)  else 0,
+                            DoubleType(), "reputacion")
 
-diversidadLexicograficaUDF = F.udf(lambda str: float(len(set(str))) / len(str) if str else 0, DoubleType())
+followersRatio = perfilador.udf(lambda followers, friends:
+                                float(followers) / friends if (friends > 0)  else 0, DoubleType(), "followersRatio")
 
-cantPalabras = F.udf(lambda text: len(text.split(" ")), IntegerType())
+diversidadLexicograficaUDF = perfilador.udf(lambda str: float(len(set(str))) / len(str) if str else 0, DoubleType(),
+                                            "diversidadLexicografica")
 
-fuentesUDF = F.udf(lambda source: fuente(source), StringType())
+entropia = perfilador.udf(lambda lista_intertweet:
+                          float(correc_cond_en(lista_intertweet[1:110], len(lista_intertweet[1:110]),
+                                               len(lista_intertweet[1:110]))), DoubleType(), "entropia")
 
-entropia = F.udf(lambda lista_intertweet:
-                 float(correc_cond_en(lista_intertweet[1:110], len(lista_intertweet[1:110]),
-                                      len(lista_intertweet[1:110]))), DoubleType())
+diversidadPalabras = perfilador.udf(lambda text: len(set(text.split(" "))) / len(text.split(" ")), DoubleType(),
+                                    "diversidadPalabras")
 
-diversidadPalabras = F.udf(lambda text: len(set(text.split(" "))) / len(text.split(" ")), DoubleType())
+intertweetUDF = perfilador.udf(intertweet, ArrayType(LongType()), "intertweet")
 
-denseToList = F.udf(lambda den: den.tolist(), ArrayType(DoubleType()))
+denseToList = perfilador.udf(lambda den: den.tolist(), ArrayType(DoubleType()), "denseToList")
 
 def tweets_en_semana(df):
     return (df.groupBy("user_id", "nroTweets")
@@ -313,28 +324,46 @@ def fuente_tweets(df):
             .agg(F.count("text") / df["nroTweets"]))
 
 
-def df_para_tweets(df):
+def normalizar_tweets(df):
+    """
+    Tabla compacta y tipada con los campos de cada tweet que usan las caracteristicas.
+    La fecha se interpreta una sola vez en ``preparar_df``; aqui se derivan hora, dia y epoch, y las metricas de
+    texto que requieren Python se calculan una vez por tweet.
+    Parameters
+    ----------
+    df : DataFrame
+        Tweets crudos devueltos por ``preparar_df``
+    Returns
+    -------
+    tweets : DataFrame
+        user_id, id, copias_tweet, text, epoch, hora, dia, fuente, longitud, palabras, diversidad_lex,
+        diversidad_palabras, n_urls, n_hashtags, n_menciones, es_respuesta
+    """
     return df.select(df.user.id.alias("user_id"),
+                     df.id,
+                     df.copias_tweet,
                      df.text,
-                     df.in_reply_to_status_id,
-                     df.entities.urls.alias("entities_url"),
-                     df.entities.hashtags.alias("entities_hashtags"),
-                     df.entities.user_mentions.alias("entities_user_mentions"),
-                     df.created_at,
-                     df.source)
+                     df.created_at_ts.cast("bigint").alias("epoch"),
+                     F.hour(df.created_at_ts).alias("hora"),
+                     F.date_format(df.created_at_ts, "EEEE").alias("dia"),
+                     fuente_nativa("source").alias("fuente"),
+                     F.length(df.text).alias("longitud"),
+                     F.size(F.split(df.text, " ")).alias("palabras"),
+                     diversidadLexicograficaUDF(df.text).alias("diversidad_lex"),
+                     diversidadPalabras(df.text).alias("diversidad_palabras"),
+                     F.size(df.entities.urls).alias("n_urls"),
+                     F.size(df.entities.hashtags).alias("n_hashtags"),
+                     F.size(df.entities.user_mentions).alias("n_menciones"),
+                     df.in_reply_to_status_id.isNotNull().cast("int").alias("es_respuesta"))
 
 
 def tweets_features(df, juez):
-    nro_tweets_df = df.groupBy("user_id").agg(F.count("text").alias("nroTweets"))
+    nro_tweets_df = df.groupBy("user_id").agg(F.count("text").alias("nroTweets"),
+                                              F.sum(df.copias_tweet - 1).alias("tweets_duplicados"))
 
     logger.info("Calculando features para tweets...")
 
     df = (df.join(nro_tweets_df, nro_tweets_df.user_id == df.user_id)
-          .withColumn("fecha_tweet", u_parse_time("created_at").cast('timestamp'))
-          .withColumn("mes", F.month("fecha_tweet"))
-          .withColumn("dia", F.date_format("fecha_tweet", "EEEE"))
-          .withColumn("hora", F.hour("fecha_tweet"))
-          .withColumn("fuente", fuentesUDF("source"))
           .drop(nro_tweets_df.user_id))
 
     tweets_en_semana_df = tweets_en_semana(df)
@@ -343,15 +372,15 @@ def tweets_features(df, juez):
 
     tweets_fuentes_df = fuente_tweets(df)
 
-    featuresDF = df.groupBy("user_id", "nroTweets").agg(
-        (F.sum(F.size("entities_url")) / F.col("nroTweets")).alias("url_ratio"),
-        (F.sum(diversidadLexicograficaUDF("text")) / F.col("nroTweets")).alias("avg_diversidad_lex"),
-        (F.sum(F.length("text")) / F.col("nroTweets")).alias("avg_long_tweets"),
-        (F.sum(nullToInt("in_reply_to_status_id")) / F.col("nroTweets")).alias("reply_ratio"),
-        (F.sum(lengthOfArray("entities_hashtags")) / F.col("nroTweets")).alias("avg_hashtags"),
-        (F.sum(lengthOfArray("entities_user_mentions")) / F.col("nroTweets")).alias("mention_ratio"),
-        (F.sum(cantPalabras("text")) / F.col("nroTweets")).alias("avg_palabras"),
-        (F.sum(diversidadPalabras("text")) / F.col("nroTweets")).alias("avg_diversidad_palabras"))
+    featuresDF = df.groupBy("user_id", "nroTweets", "tweets_duplicados").agg(
+        (F.sum("n_urls") / F.col("nroTweets")).alias("url_ratio"),
+        (F.sum("diversidad_lex") / F.col("nroTweets")).alias("avg_diversidad_lex"),
+        (F.sum("longitud") / F.col("nroTweets")).alias("avg_long_tweets"),
+        (F.sum("es_respuesta") / F.col("nroTweets")).alias("reply_ratio"),
+        (F.sum("n_hashtags") / F.col("nroTweets")).alias("avg_hashtags"),
+        (F.sum("n_menciones") / F.col("nroTweets")).alias("mention_ratio"),
+        (F.sum("palabras") / F.col("nroTweets")).alias("avg_palabras"),
+        (F.sum("diversidad_palabras") / F.col("nroTweets")).alias("avg_diversidad_palabras"))
 
     spam_df = avg_spam(juez, df)
 
@@ -379,19 +408,21 @@ def tweets_features(df, juez):
     return resultado
 
 
-def usuarios_features(df, categoria=-1.0):
+def usuarios_features(df, series, categoria=-1.0):
     logger.info("Calculando features para usuarios...")
 
+    df = df.join(series, df.user_id == series.user_id).drop(series.user_id)
+
     resultado = (df.select(df["user.id"].alias("user_id"),
-                           nullToInt("user.profile_use_background_image").alias("con_imagen_fondo"),
-                           u_parse_time("user.created_at").cast('timestamp').alias("cuenta_creada"),
+                           bandera("user.profile_use_background_image").alias("con_imagen_fondo"),
+                           fecha_twitter("user.created_at").alias("cuenta_creada"),
                            df["user.favourites_count"].alias("n_favoritos"),
-                           nullToInt("user.description").alias("con_descripcion"),
+                           bandera(F.length("user.description") > 0).alias("con_descripcion"),
                            F.length("user.description").alias("longitud_descripcion"),
-                           nullToInt("user.verified").alias("con_perfil_verificado"),
-                           nullToInt("user.default_profile_image").alias("con_imagen_default"),
+                           bandera("user.verified").alias("con_perfil_verificado"),
+                           bandera("user.default_profile_image").alias("con_imagen_default"),
                            df["user.listed_count"].alias("n_listas"),
-                           nullToInt("user.geo_enabled").alias("con_geo_activo"),
+                           bandera("user.geo_enabled").alias("con_geo_activo"),
                            reputacion("user.followers_count", "user.friends_count").alias("reputacion"),
                            df["user.statuses_count"].alias("n_tweets"),
                            followersRatio("user.followers_count", "user.friends_count").alias("followers_ratio"),
@@ -406,8 +437,8 @@ def usuarios_features(df, categoria=-1.0):
 
 
 def entrenar_spam(sc, sql_context, dir_spam, dir_no_spam, num_trees=20, max_depth=8):
-    input_spam = sc.textFile(dir_spam)
-    input_no_spam = sc.textFile(dir_no_spam)
+    input_spam = leer_lineas(sc, dir_spam)
+    input_no_spam = leer_lineas(sc, dir_no_spam)
 
     spam = sql_context.read.json(input_spam).select("text").withColumn("label", F.lit(1.0))
     no_spam = sql_context.read.json(input_no_spam).select("text").withColumn("label", F.lit(0.0))
@@ -417,7 +448,7 @@ def entrenar_spam(sc, sql_context, dir_spam, dir_no_spam, num_trees=20, max_dept
     tokenizer = Tokenizer(inputCol="text", outputCol="words")
     wordsData = tokenizer.transform(training_data)
 
-    hashingTF = HashingTF(inputCol="words", outputCol="rawFeatures", numFeatures=140)
+    hashingTF = HashingTF(inputCol="words", outputCol="rawFeatures", numFeatures=NUM_CARACTERISTICAS_SPAM)
     featurizedData = hashingTF.transform(wordsData)
 
     """idf = IDF(inputCol="rawFeatures", outputCol="features")
@@ -455,69 +486,152 @@ def entrenar_spam(sc, sql_context, dir_spam, dir_no_spam, num_trees=20, max_dept
     return modelo, accuracy
 
 
-def cargar_datos(sc, sql_context, directorio):
-    timeline = sc.textFile(directorio)
-    logger.info("Cargando arhcivos...")
-    df = sql_context.read.json(timeline)
-    df = preparar_df(df)
-    return df
+def cargar_datos(sc, sql_context, directorio, tope=None, dias=None):
+    with medir("ingesta"):
+        timeline = leer_lineas(sc, directorio)
+        logger.info("Cargando arhcivos...")
+        df = sql_context.read.json(timeline)
+    return preparar_df(df, tope, dias)
 
 
-def cargar_timeline(sc, sql_context, timeline):
-    logger.info("Creando archivo temporal...")
-    tf = tempfile.NamedTemporaryFile(delete=False, suffix='.json')
-    file = tf.name
-    tf.write(timeline.encode('utf-8'))
-    tf.close()
-    df = sql_context.read.json(file)
-    df = preparar_df(df)
-    return df
+def cargar_timeline(sc, sql_context, timeline, tope=None, dias=None):
+    with medir("ingesta"):
+        logger.info("Creando archivo temporal...")
+        tf = tempfile.NamedTemporaryFile(delete=False, suffix='.json')
+        file = tf.name
+        tf.write(timeline.encode('utf-8'))
+        tf.close()
+        df = sql_context.read.json(file)
+    return preparar_df(df, tope, dias)
+
+
+TIPOS_INGESTA = {"long": LongType(), "string": StringType(), "boolean": BooleanType()}
+
+
+def esquema_tweets():
+    """Esquema de las tuplas de ``ingesta.podar_tweet``"""
+    entidades = StructType([StructField(nombre, ArrayType(StringType())) for nombre, _ in ingesta.ENTIDADES])
+    usuario = StructType([StructField(nombre, TIPOS_INGESTA[tipo]) for nombre, tipo in ingesta.CAMPOS_USUARIO])
+    tipos = dict(TIPOS_INGESTA, entidades=entidades, usuario=usuario)
+    return StructType([StructField(nombre, tipos[tipo]) for nombre, tipo in ingesta.CAMPOS_TWEET])
+
+
+def cargar_tweets(sc, sql_context, tweets, tope=None, dias=None):
+    """Como ``cargar_timeline``, con los tweets ya reducidos por ``ingesta.leer_ndjson``"""
+    with medir("ingesta"):
+        particiones = int(sql_context.conf.get("spark.sql.shuffle.partitions"))
+        df = sql_context.createDataFrame(sc.parallelize(tweets, max(1, min(particiones, len(tweets)))),
+                                         esquema_tweets())
+    return preparar_df(df, tope, dias)
 
 
 # TODO agregar features faltantes (safety, diversidad url)
-def entrenar_juez(sc, sql_context, juez_spam, humanos, ciborgs, bots, dir_juez, mongo_uri=None, num_trees=20, max_depth=8):
+def entrenar_juez(sc, sql_context, juez_spam, humanos, ciborgs, bots, dir_juez, mongo_uri=None, num_trees=20, max_depth=8,
+                  tope=None, dias=None, almacen=None):
 
     logger.info("Entrenando juez...")
-    df_humanos = cargar_datos(sc, sql_context, humanos)
-    df_bots = cargar_datos(sc, sql_context, bots)
-    df_ciborgs = cargar_datos(sc, sql_context, ciborgs)
+    try:
+        set_datos = extraer_set_datos(sc, sql_context, juez_spam, humanos, ciborgs, bots, tope, dias)
+        if almacen:
+            agregar_almacen(sc, set_datos, almacen, tope, dias)
+            set_datos = cachear(leer_almacen(sql_context, almacen))
+        return ajustar_juez(set_datos, dir_juez, mongo_uri, num_trees, max_depth)
+    finally:
+        liberar_cache()
+
+
+def extraer_set_datos(sc, sql_context, juez_spam, humanos, ciborgs, bots, tope=None, dias=None):
+    """Caracteristicas de los usuarios etiquetados, con la categoria en la columna ``categoria``"""
+    df_humanos = cargar_datos(sc, sql_context, humanos, tope, dias)
+    df_bots = cargar_datos(sc, sql_context, bots, tope, dias)
+    df_ciborgs = cargar_datos(sc, sql_context, ciborgs, tope, dias)
+
+    tweets_humanos = normalizar_tweets(df_humanos)
+    tweets_bots = normalizar_tweets(df_bots)
+    tweets_ciborgs = normalizar_tweets(df_ciborgs)
 
-    tweets_humanos = df_para_tweets(df_humanos)
-    tweets_bots = df_para_tweets(df_bots)
-    tweets_ciborgs = df_para_tweets(df_ciborgs)
+    tweets_df = cachear(tweets_humanos.union(tweets_bots).union(tweets_ciborgs))
 
-    tweets_df = tweets_humanos.union(tweets_bots).union(tweets_ciborgs)
+    series = cachear(series_intertweet(tweets_df))
 
-    df_humanos = df_humanos.dropDuplicates(["user_id"])
-    df_bots = df_bots.dropDuplicates(["user_id"])
-    df_ciborgs = df_ciborgs.dropDuplicates(["user_id"])
+    df_humanos = usuarios_unicos(df_humanos)
+    df_bots = usuarios_unicos(df_bots)
+    df_ciborgs = usuarios_unicos(df_ciborgs)
 
-    tweets = tweets_features(tweets_df, juez_spam)
-    tweets.cache()
+    tweets = cachear(tweets_features(tweets_df, juez_spam))
+    tweets_duplicados(tweets)
+    # El conteo de duplicados no es una caracteristica ni se guarda en el almacen
+    tweets = tweets.drop("tweets_duplicados")
 
-    usuarios_features_humanos = usuarios_features(df_humanos, 0.0)
-    usuarios_features_ciborgs = usuarios_features(df_bots, 1.0)
-    usuarios_features_bots = usuarios_features(df_ciborgs, 2.0)
+    usuarios_features_humanos = usuarios_features(df_humanos, series, 0.0)
+    usuarios_features_ciborgs = usuarios_features(df_bots, series, 1.0)
+    usuarios_features_bots = usuarios_features(df_ciborgs, series, 2.0)
 
-    usuarios = usuarios_features_ciborgs.union(usuarios_features_bots).union(usuarios_features_humanos).cache()
+    usuarios = cachear(usuarios_features_ciborgs.union(usuarios_features_bots).union(usuarios_features_humanos))
 
-    set_datos = usuarios.join(tweets, tweets.user_id == usuarios.user_id).drop(tweets.user_id).fillna(0).cache()
+    return cachear(usuarios.join(tweets, tweets.user_id == usuarios.user_id).drop(tweets.user_id).fillna(0))
 
+
+def existe_ruta(sc, ruta):
+    ruta = sc._jvm.org.apache.hadoop.fs.Path(ruta)
+    return ruta.getFileSystem(sc._jsc.hadoopConfiguration()).exists(ruta)
+
+
+def agregar_almacen(sc, set_datos, almacen, tope=None, dias=None):
+    """
+    Agrega al almacen de caracteristicas (Parquet particionado por ``version_caracteristicas``) los usuarios que
+    aun no estan en la version actual, conservando la primera aparicion de cada user_id
+    Returns
+    -------
+    agregados : int
+        Cantidad de usuarios nuevos
+    """
+    nuevos = set_datos.dropDuplicates(["user_id"])
+    if existe_ruta(sc, ruta_version(almacen)):
+        existentes = leer_almacen(spark_session(), almacen).select("user_id")
+        nuevos = nuevos.join(existentes, "user_id", "leftanti")
+    nuevos = registrar_tope(nuevos, tope, dias).withColumn("fecha_extraccion", F.current_timestamp()).cache()
+    agregados = nuevos.count()
+    with medir("escritura_almacen"):
+        (nuevos.withColumn("version_caracteristicas", F.lit(VERSION_CARACTERISTICAS))
+         .write.mode("append").partitionBy("version_caracteristicas").parquet(almacen))
+    nuevos.unpersist()
+    logger.info("%d usuarios agregados al almacen %s", agregados, almacen)
+    return agregados
+
+
+def ruta_version(almacen):
+    """Particion del almacen con la version actual de las caracteristicas; las demas versiones pueden tener
+    otro esquema y no se leen"""
+    return "%s/version_caracteristicas=%d" % (almacen.rstrip("/"), VERSION_CARACTERISTICAS)
+
+
+def leer_almacen(sql_context, almacen):
+    """Usuarios del almacen de caracteristicas calculados con la version actual"""
+    with medir("lectura_almacen"):
+        return sql_context.read.parquet(ruta_version(almacen))
+
+
+def entrenar_juez_almacen(sql_context, almacen, dir_juez, mongo_uri=None, num_trees=20, max_depth=8):
+    """Entrena el juez directamente con las caracteristicas guardadas en el almacen, sin volver a extraerlas"""
+    logger.info("Entrenando juez desde el almacen %s...", almacen)
+    try:
+        return ajustar_juez(cachear(leer_almacen(sql_context, almacen)), dir_juez, mongo_uri, num_trees, max_depth)
+    finally:
+        liberar_cache()
+
+
+def ajustar_juez(set_datos, dir_juez, mongo_uri=None, num_trees=20, max_depth=8):
+    """Ajusta el Random Forest del juez con validacion cruzada sobre el 80% de ``set_datos`` y lo evalua con el
+    20% restante"""
     seed = 1800009193L
     (split_20_df, split_80_df) = set_datos.randomSplit([20.0, 80.0], seed)
 
-    test_set_df = split_20_df.cache()
-    training_set_df = split_80_df.cache()
+    test_set_df = cachear(split_20_df)
+    training_set_df = cachear(split_80_df)
 
     vectorizer = VectorAssembler()
-    vectorizer.setInputCols([
-        "ano_registro", "con_descripcion", "con_geo_activo", "con_imagen_default", "con_imagen_fondo",
-        "con_perfil_verificado", "entropia", "followers_ratio", "n_favoritos", "n_listas", "n_tweets", "reputacion",
-        "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday", "0", "1", "2", "3", "4", "5", "6",
-        "7", "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20", "21", "22", "23", "uso_mobil",
-        "uso_terceros", "uso_web", "avg_diversidad_lex", "avg_long_tweets", "reply_ratio", "avg_hashtags",
-        "mention_ratio", "avg_palabras", "avg_diversidad_palabras", "url_ratio", "avg_spam"
-    ])
+    vectorizer.setInputCols(COLUMNAS_CARACTERISTICAS)
 
     vectorizer.setOutputCol("features")
 
@@ -552,12 +666,11 @@ def entrenar_juez(sc, sql_context, juez_spam, humanos, ciborgs, bots, dir_juez,
     logger.info("Guardando en Mongo el set de entrenamiento")
 
     if mongo_uri:
-        training_set_df.rdd.map(lambda t: t.asDict()).saveToMongoDB(mongo_uri)
+        guardar_mongo(training_set_df, mongo_uri)
 
     logger.info("Evaluando set de prueba")
 
-    predictions_and_labels_df = rf_model.transform(test_set_df)
-    predictions_and_labels_df.cache()
+    predictions_and_labels_df = cachear(rf_model.transform(test_set_df))
 
     accuracy = reg_eval.evaluate(predictions_and_labels_df)
 
@@ -579,10 +692,11 @@ def entrenar_juez(sc, sql_context, juez_spam, humanos, ciborgs, bots, dir_juez,
 
 
 def timeline_features(juez_spam, df):
-    tweets_df = df_para_tweets(df)
+    tweets_df = cachear(normalizar_tweets(df))
     tweets_features_df = tweets_features(tweets_df, juez_spam)
-    df = df.dropDuplicates(["user_id"])
-    usuarios_features_df = usuarios_features(df)
+    df = usuarios_unicos(df)
+    series = series_intertweet(tweets_df)
+    usuarios_features_df = usuarios_features(df, series)
     logger.info("Realizando join de usuarios con tweets...")
     set_datos = (usuarios_features_df
                  .join(tweets_features_df, tweets_features_df.user_id == usuarios_features_df.user_id)
@@ -610,30 +724,98 @@ def predecir(juez_usuario, features):
                             F.col("22").alias("hora_22"), F.col("23").alias("hora_23"), "uso_mobil", "uso_terceros",
                             "uso_web", "avg_diversidad_lex", "avg_long_tweets", "reply_ratio", "avg_hashtags",
                             "mention_ratio", "avg_palabras", "avg_diversidad_palabras",
-                            "createdAt", "cuenta_creada", "url_ratio", "avg_spam", "Predicted_categoria", "nombre_usuario", denseToList("probability").alias("probabilidades")))
+                            "createdAt", "cuenta_creada", "url_ratio", "avg_spam", "Predicted_categoria", "nombre_usuario",
+                            "tweets_duplicados", denseToList("probability").alias("probabilidades")))
     return predicciones
 
 
-def evaluar(sc, sql_context, juez_spam, juez_usuario, dir_timeline, mongo_uri=None):
-    df = cargar_datos(sc, sql_context, dir_timeline)
-    features = timeline_features(juez_spam, df).cache()
-    predicciones = predecir(juez_usuario, features)
+def evaluar(sc, sql_context, juez_spam, juez_usuario, dir_timeline, mongo_uri=None, tope=None, dias=None,
+            id_evaluacion=None):
+    df = cargar_datos(sc, sql_context, dir_timeline, tope, dias)
+    features = cachear(timeline_features(juez_spam, df))
+    predicciones = registrar_tope(predecir(juez_usuario, features), tope, dias)
+    if id_evaluacion:
+        predicciones = predicciones.withColumn("id_evaluacion", F.lit(id_evaluacion))
     if mongo_uri:
-        predicciones.rdd.map(lambda t: t.asDict()).saveToMongoDB(mongo_uri)
+        with medir("escritura_mongo"):
+            guardar_mongo(predicciones, mongo_uri)
 
     return predicciones
 
 
-def evaluar_online(sc, sql_context, juez_spam, juez_usuario, timeline, mongo_uri=None):
-    df = cargar_timeline(sc, sql_context, timeline)
-    features = timeline_features(juez_spam, df).cache()
-    predicciones = predecir(juez_usuario, features)
+def contar_predicciones(predicciones):
+    """Cantidad de usuarios evaluados; los tweets duplicados se suman en la misma lectura y se registran"""
+    with medir("conteo"):
+        conteo = predicciones.agg(F.count(F.lit(1)), F.sum("tweets_duplicados")).first()
+    registrar_duplicados(conteo[1] or 0)
+    return conteo[0]
+
+
+FORMATOS_SALIDA = ("parquet", "jsonl")
+
+
+def escribir_predicciones(predicciones, formato, ruta):
+    """
+    Escribe las predicciones directamente desde los executors, sin pasar por el driver ni por mongo
+    Parameters
+    ----------
+    predicciones : DataFrame
+        Resultado de ``evaluar`` sin mongo_uri
+    formato : str
+        "parquet", particionado por Predicted_categoria, o "jsonl", JSON por lineas comprimido con gzip
+    ruta : str
+        Directorio de salida, no debe existir
+    Returns
+    -------
+    resumen : dict
+        Formato, ruta, usuarios por categoria predicha y total
+    """
+    if formato not in FORMATOS_SALIDA:
+        raise ValueError("Formato de salida desconocido: %s" % formato)
+    with medir("escritura_" + formato):
+        if formato == "parquet":
+            predicciones.drop("tweets_duplicados").write.partitionBy("Predicted_categoria").parquet(ruta)
+        else:
+            predicciones.drop("tweets_duplicados").write.option("compression", "gzip").json(ruta)
+    with medir("resumen_categorias"):
+        conteos = (predicciones.groupBy("Predicted_categoria")
+                   .agg(F.count(F.lit(1)).alias("count"), F.sum("tweets_duplicados").alias("duplicados")).collect())
+    registrar_duplicados(sum(fila.duplicados or 0 for fila in conteos))
+    categorias = dict((int(fila.Predicted_categoria), fila["count"]) for fila in conteos)
+    return dict(formato=formato, ruta=ruta, categorias=categorias, usuarios=sum(categorias.values()))
+
+
+def evaluar_online(sc, sql_context, juez_spam, juez_usuario, timeline, mongo_uri=None, tope=None, dias=None):
+    df = cargar_timeline(sc, sql_context, timeline, tope, dias)
+    return predecir_online(juez_spam, juez_usuario, df, mongo_uri, tope, dias)
+
+
+def evaluar_tweets(sc, sql_context, juez_spam, juez_usuario, tweets, mongo_uri=None, tope=None, dias=None):
+    """``evaluar_online`` sobre los tweets reducidos de un cuerpo NDJSON"""
+    df = cargar_tweets(sc, sql_context, tweets, tope, dias)
+    return predecir_online(juez_spam, juez_usuario, df, mongo_uri, tope, dias)
+
+
+def predecir_online(juez_spam, juez_usuario, df, mongo_uri=None, tope=None, dias=None):
+    features = cachear(timeline_features(juez_spam, df))
+    predicciones = registrar_tope(predecir(juez_usuario, features), tope, dias)
     if mongo_uri:
-        predicciones.rdd.map(lambda t: t.asDict()).saveToMongoDB(mongo_uri)
+        with medir("escritura_mongo"):
+            guardar_mongo(predicciones, mongo_uri)
 
     return predicciones
 
 
+def guardar_mongo(df, mongo_uri):
+    """Guarda las filas del DataFrame en mongo con el formato de documentos de la seccion [database]"""
+    df = df.drop("tweets_duplicados")
+    if documentos.COMPACTO:
+        filas = df.rdd.map(lambda t: documentos.compactar(t.asDict()))
+    else:
+        filas = df.rdd.map(lambda t: t.asDict())
+    filas.saveToMongoDB(mongo_uri)
+
+
 def features_importances_juez(juez):
     return juez.stages[1].featureImportances
 
@@ -646,5 +828,5 @@ def guardar_juez(juez, path):
 def cargar_juez(path, tipo, mongo_uri=None):
     if tipo == 1 and mongo_uri:
         df = spark_session().read.json(path+"_trainingset")
-        df.rdd.map(lambda t: t.asDict()).saveToMongoDB(mongo_uri)
+        guardar_mongo(df, mongo_uri)
     return PipelineModel.load(path)
\ No newline at end of file